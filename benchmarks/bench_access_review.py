@@ -0,0 +1,119 @@
+#! /usr/bin/env python3
+'''
+Time `tinyauth access-review` over 50k users with different numbers of
+worker processes
+
+Users are spread over 500 groups, each granting a service's actions on its
+own resources, and every thousandth user is an administrator. Users in the
+same groups share an effective policy, which is only reviewed once per
+process, so the run is repeated with a personal statement for every user.
+Effective policies are written directly rather than through the API, to
+keep setup quick.
+
+Run from the repository root with `PYTHONPATH=. python benchmarks/bench_access_review.py`.
+'''
+
+import multiprocessing
+import os
+import time
+
+from tinyauth import access_review
+from tinyauth.app import create_app, db
+from tinyauth.models import (
+    EffectivePolicy,
+    Group,
+    GroupPolicy,
+    User,
+    group_users,
+    hash_policy,
+)
+
+USERS = 50000
+GROUPS = 500
+SERVICES = 40
+
+ACTIONS = [f'service{i}:{verb}Thing' for i in range(0, SERVICES, 4) for verb in ('Get', 'Delete')] + ['tinyauth:DeleteUser']
+RESOURCES = [f'arn:tinyauth:service{i}:::things/*' for i in range(0, SERVICES, 4)] + ['arn:tinyauth:tinyauth:::users/*']
+
+
+def group_policy(i):
+    service = f'service{i % SERVICES}'
+    return {
+        'Statement': [{
+            'Action': [f'{service}:Get*', f'{service}:List*'],
+            'Resource': f'arn:tinyauth:{service}:::things/*',
+            'Effect': 'Allow',
+        }, {
+            'Action': f'{service}:Delete*',
+            'Resource': f'arn:tinyauth:{service}:::things/*',
+            'Effect': 'Allow',
+            'Condition': {'IpAddress': {'SourceIp': '10.0.0.0/8'}},
+        }],
+    }
+
+
+def populate(personal):
+    db.drop_all()
+    db.create_all()
+
+    policies = [group_policy(i) for i in range(GROUPS)]
+    admin = {'Statement': [{'Action': 'tinyauth:*', 'Resource': '*', 'Effect': 'Allow'}]}
+
+    db.session.bulk_insert_mappings(Group, [{'id': i + 1, 'name': f'group{i}'} for i in range(GROUPS)])
+    db.session.bulk_insert_mappings(GroupPolicy, [
+        {'name': 'default', 'group_id': i + 1, 'policy': policy} for i, policy in enumerate(policies)
+    ])
+    db.session.bulk_insert_mappings(User, [{'id': i + 1, 'username': f'user{i:05d}'} for i in range(USERS)])
+
+    memberships = []
+    effective = []
+    for i in range(USERS):
+        groups = [i % GROUPS, (i * 7 + 1) % GROUPS]
+        memberships.extend({'group_id': g + 1, 'user_id': i + 1} for g in groups)
+
+        policy = {'Statement': [s for g in groups for s in policies[g]['Statement']]}
+        if i % 1000 == 0:
+            policy['Statement'].extend(admin['Statement'])
+        if personal:
+            policy['Statement'].append({'Action': '*', 'Resource': f'arn:tinyauth:tinyauth:::users/user{i:05d}', 'Effect': 'Allow'})
+        effective.append({'user_id': i + 1, 'policy': policy, 'hash': hash_policy(policy)})
+
+    db.session.execute(group_users.insert(), memberships)
+    db.session.bulk_insert_mappings(EffectivePolicy, effective)
+    db.session.commit()
+
+
+def main():
+    os.environ.setdefault('DATABASE_URI', 'sqlite://')
+    os.environ.setdefault('SECRET_SIGNING_KEY', 'benchmark')
+
+    app = create_app(None)
+
+    with app.test_request_context():
+        for personal in (False, True):
+            populate(personal)
+
+            print(
+                f'{USERS} users with {"personal" if personal else "shared"} policies, '
+                f'{len(ACTIONS)} actions x {len(RESOURCES)} resources'
+            )
+
+            baseline = None
+            for processes in sorted({1, 2, 4, multiprocessing.cpu_count()}):
+                with open(os.devnull, 'w') as output:
+                    start = time.monotonic()
+                    users, decisions = access_review.run(output, ACTIONS, RESOURCES, processes=processes)
+                    elapsed = time.monotonic() - start
+
+                baseline = baseline or elapsed
+                print(
+                    f'{processes:>3} processes: '
+                    f'{elapsed:7.2f}s, '
+                    f'{users / elapsed:8.0f} users/s, '
+                    f'{decisions} decisions, '
+                    f'speedup {baseline / elapsed:5.1f}x'
+                )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#! /usr/bin/env python3
+'''
+Compare authorizing a batch pair by pair against identifying once
+
+`batch_service_authorize` used to call `external_authorize` for every
+(action, resource) pair, verifying the signature and loading the policy
+each time. `external_authorize_many` does both once per batch.
+
+Run from the repository root with `PYTHONPATH=. python benchmarks/bench_batch_authorize.py`.
+'''
+
+import base64
+import os
+import timeit
+
+from werkzeug.datastructures import Headers
+
+from tinyauth.app import create_app, db
+from tinyauth.authorize import external_authorize, external_authorize_many
+from tinyauth.models import AccessKey, EffectivePolicy, User, UserPolicy
+
+
+def populate():
+    db.create_all()
+
+    user = User(username='charles')
+    db.session.add(user)
+    db.session.add(AccessKey(access_key_id='AKIDEXAMPLE', secret_access_key='password', user=user))
+    db.session.add(UserPolicy(name='rockets', user=user, policy={
+        'Statement': [{
+            'Action': [f'myservice:Action{i}' for i in range(0, 100, 2)],
+            'Resource': 'arn:tinyauth:myservice:::rockets/*',
+            'Effect': 'Allow',
+        }],
+    }))
+    db.session.flush()
+    EffectivePolicy.refresh([user.id])
+    db.session.commit()
+
+
+def legacy(permits, headers):
+    # What batch_service_authorize did before, one full authorization per pair
+    return [
+        external_authorize('europe', 'myservice', action, resource, Headers(headers), {})
+        for action, resource in permits
+    ]
+
+
+def batched(permits, headers):
+    return external_authorize_many('europe', 'myservice', permits, Headers(headers), {})
+
+
+def main():
+    os.environ.setdefault('DATABASE_URI', 'sqlite://')
+    os.environ.setdefault('SECRET_SIGNING_KEY', 'benchmark')
+
+    app = create_app(None)
+    headers = [('Authorization', 'Basic {}'.format(base64.b64encode(b'AKIDEXAMPLE:password').decode('utf-8')))]
+
+    with app.test_request_context():
+        populate()
+
+        for size in (1, 10, 100):
+            permits = [(f'myservice:Action{i}', f'arn:tinyauth:myservice:::rockets/{i}') for i in range(size)]
+            assert legacy(permits, headers) == batched(permits, headers)
+
+            number = max(1, 2000 // size)
+            before = min(timeit.repeat(lambda: legacy(permits, headers), number=number, repeat=3)) / number
+            after = min(timeit.repeat(lambda: batched(permits, headers), number=number, repeat=3)) / number
+
+            print(
+                f'{size:>4} permits: '
+                f'per pair {before * 1e3:8.3f}ms/request, '
+                f'batched {after * 1e3:8.3f}ms/request, '
+                f'speedup {before / after:6.1f}x'
+            )
+
+
+if __name__ == '__main__':
+    main()
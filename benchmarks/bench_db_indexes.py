@@ -0,0 +1,112 @@
+#! /usr/bin/env python3
+'''
+Time the hot lookups against a 100k user SQLite database with and without
+the indexes on user, access_key, group_users and the policy tables
+
+Run from the repository root with `PYTHONPATH=. python benchmarks/bench_db_indexes.py`.
+'''
+
+import os
+import random
+import tempfile
+import timeit
+
+from sqlalchemy import create_engine, text
+
+from tinyauth import models  # noqa: F401
+from tinyauth.app import db
+
+USERS = 100000
+GROUPS = 1000
+
+LOOKUPS = {
+    'user by username': (
+        'SELECT id FROM user WHERE username = :username',
+        lambda i: {'username': f'user{i}'},
+    ),
+    'access key by id': (
+        'SELECT user.username FROM access_key JOIN user ON user.id = access_key.user_id '
+        'WHERE access_key.access_key_id = :access_key_id',
+        lambda i: {'access_key_id': f'AKID{i:016d}'},
+    ),
+    'groups for user': (
+        'SELECT group_id FROM group_users WHERE user_id = :user_id',
+        lambda i: {'user_id': i + 1},
+    ),
+    'user policy by name': (
+        'SELECT policy FROM user_policy WHERE user_id = :user_id AND name = :name',
+        lambda i: {'user_id': i + 1, 'name': 'default'},
+    ),
+}
+
+INDEXES = [
+    'ix_user_username',
+    'ix_access_key_access_key_id',
+    'ix_group_users_user_id',
+    'ix_user_policy_user_id_name',
+]
+
+
+def populate(engine):
+    db.metadata.create_all(engine)
+
+    with engine.begin() as conn:
+        conn.execute(text('INSERT INTO "group" (id, name) VALUES (:id, :name)'), [
+            {'id': i + 1, 'name': f'group{i}'} for i in range(GROUPS)
+        ])
+        conn.execute(text('INSERT INTO user (id, username) VALUES (:id, :username)'), [
+            {'id': i + 1, 'username': f'user{i}'} for i in range(USERS)
+        ])
+        conn.execute(text('INSERT INTO access_key (access_key_id, user_id) VALUES (:access_key_id, :user_id)'), [
+            {'access_key_id': f'AKID{i:016d}', 'user_id': i + 1} for i in range(USERS)
+        ])
+        conn.execute(text('INSERT INTO group_users (group_id, user_id) VALUES (:group_id, :user_id)'), [
+            {'group_id': (i % GROUPS) + 1, 'user_id': i + 1} for i in range(USERS)
+        ])
+        conn.execute(text('INSERT INTO user_policy (user_id, name, policy) VALUES (:user_id, :name, :policy)'), [
+            {'user_id': i + 1, 'name': 'default', 'policy': '{"Statement": []}'} for i in range(USERS)
+        ])
+
+
+def run(engine, number):
+    rng = random.Random(0)
+    samples = [rng.randrange(USERS) for _ in range(number)]
+
+    results = {}
+    with engine.connect() as conn:
+        for name, (sql, params) in LOOKUPS.items():
+            query = text(sql)
+
+            def lookups():
+                for i in samples:
+                    assert conn.execute(query, params(i)).fetchall()
+
+            results[name] = timeit.timeit(lookups, number=1) / number
+    return results
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine('sqlite:///' + os.path.join(tmp, 'bench.db'))
+        populate(engine)
+
+        indexed = run(engine, number=2000)
+
+        with engine.begin() as conn:
+            for index in INDEXES:
+                conn.execute(text(f'DROP INDEX {index}'))
+
+        unindexed = run(engine, number=20)
+
+        print(f'{USERS} users, {GROUPS} groups')
+        for name in LOOKUPS:
+            print(
+                f'{name:>20}: '
+                f'no index {unindexed[name] * 1e3:8.3f}ms/lookup, '
+                f'indexed {indexed[name] * 1e3:8.3f}ms/lookup, '
+                f'speedup {unindexed[name] / indexed[name]:8.1f}x'
+            )
+
+
+if __name__ == '__main__':
+    main()
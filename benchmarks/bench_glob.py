@@ -0,0 +1,55 @@
+#! /usr/bin/env python3
+'''
+Show that glob matching stays linear for adversarial policy patterns
+
+A pattern like `*a*a*a*a*b` translated to `.*a.*a.*a.*a.*b` (which is what
+`fnmatch` produces on the Python versions we deploy) backtracks
+polynomially in the length of the input. The matcher in `tinyauth.policy`
+should grow linearly instead.
+
+Run from the repository root with `PYTHONPATH=. python benchmarks/bench_glob.py`.
+'''
+
+import re
+import timeit
+
+from tinyauth.policy import _compile_glob
+
+PATTERN = '*a*a*a*a*b'
+
+
+def backtracking_regex(pattern):
+    return re.compile('(?s:' + '.*'.join(re.escape(p) for p in pattern.split('*')) + r')\Z').match
+
+
+def best_of(fn, number=3):
+    return min(timeit.repeat(fn, number=1, repeat=number))
+
+
+def main():
+    backtracking = backtracking_regex(PATTERN)
+    linear = _compile_glob(PATTERN)
+
+    print(f'pattern {PATTERN!r} against "a" * n')
+
+    for n in (25, 50, 100, 150):
+        value = 'a' * n
+        assert not backtracking(value) and not linear(value)
+        print(
+            f'n={n:>7}: '
+            f'backtracking regex {best_of(lambda: backtracking(value)) * 1e3:10.3f}ms, '
+            f'linear glob {best_of(lambda: linear(value)) * 1e3:8.3f}ms'
+        )
+
+    # The worst case for the linear matcher is a value that forces a full
+    # scan for the first middle chunk
+    print(f'pattern {PATTERN!r} against "c" * n + "b"')
+
+    for n in (1000, 10000, 100000, 1000000):
+        value = 'c' * n + 'b'
+        assert not linear(value)
+        print(f'n={n:>7}: linear glob {best_of(lambda: linear(value)) * 1e3:8.3f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+#! /usr/bin/env python3
+'''
+Compare policy evaluation against a raw policy document and a CompiledPolicy
+
+Run from the repository root with `PYTHONPATH=. python benchmarks/bench_policy.py`.
+'''
+
+import fnmatch
+import timeit
+
+from tinyauth.policy import (
+    ResourceTrie,
+    allow,
+    allow_matrix,
+    compile_policy,
+    filter_resources,
+)
+
+
+def legacy_allow(policy, action, resource):
+    # The per-call fnmatch walk that `allow` used before policies were compiled
+    def get_list(d, key):
+        value = d.get(key, [])
+        return value if isinstance(value, list) else [value]
+
+    retval = 'Default'
+    for statement in get_list(policy, 'Statement'):
+        if not any(fnmatch.fnmatch(action, a) for a in get_list(statement, 'Action')):
+            continue
+        if not any(fnmatch.fnmatch(resource, r) for r in get_list(statement, 'Resource')):
+            continue
+        if statement['Effect'] == 'Deny':
+            return 'Deny'
+        retval = 'Allow'
+    return retval
+
+
+def make_policy(statements):
+    policy = {'Statement': []}
+    for i in range(statements):
+        service = f'service{i % 40}'
+        policy['Statement'].append({
+            'Action': [f'{service}:Get{i}', f'{service}:List*'],
+            'Resource': [
+                f'arn:tinyauth:{service}:::things/{i}/*',
+                f'arn:tinyauth:{service}:::others/{i}',
+            ],
+            'Effect': 'Deny' if i % 17 == 0 else 'Allow',
+        })
+    return policy
+
+
+def bench_resource_trie(number=200):
+    for patterns in (50, 500, 5000):
+        resource_patterns = [f'arn:tinyauth:service{i % 40}:::things/{i}/*' for i in range(patterns)]
+
+        trie = ResourceTrie()
+        for pattern in resource_patterns:
+            trie.add(pattern, pattern)
+
+        resource = 'arn:tinyauth:service3:::things/3/abc'
+        assert trie.match(resource) == [p for p in resource_patterns if fnmatch.fnmatch(resource, p)]
+
+        linear = timeit.timeit(lambda: [p for p in resource_patterns if fnmatch.fnmatch(resource, p)], number=number)
+        fast = timeit.timeit(lambda: trie.match(resource), number=number)
+
+        print(
+            f'{patterns:>5} resource patterns: '
+            f'fnmatch {linear / number * 1e6:9.1f}us/resource, '
+            f'trie {fast / number * 1e6:9.1f}us/resource, '
+            f'speedup {linear / fast:6.1f}x'
+        )
+
+
+def bench_filter_resources(number=3):
+    policy = compile_policy(make_policy(500))
+    action = 'service3:ListThings'
+
+    for count in (100, 1000, 10000):
+        resources = [f'arn:tinyauth:service3:::things/{i % 600}/item{i}' for i in range(count)]
+
+        expected = [r for r in resources if allow(policy, action, r) == 'Allow']
+        assert filter_resources(policy, action, resources) == expected
+
+        per_item = min(timeit.repeat(lambda: [r for r in resources if allow(policy, action, r) == 'Allow'], number=1, repeat=number))
+        filtered = min(timeit.repeat(lambda: filter_resources(policy, action, resources), number=1, repeat=number))
+
+        print(
+            f'{count:>5} resources: '
+            f'allow per item {per_item * 1e3:8.2f}ms, '
+            f'filter_resources {filtered * 1e3:8.2f}ms, '
+            f'speedup {per_item / filtered:6.1f}x'
+        )
+
+
+def bench_allow_matrix(number=3):
+    policy = compile_policy(make_policy(500))
+    actions = [f'service3:Get{i}' for i in range(3, 500, 40)] + ['service3:ListThings', 'service3:Delete']
+
+    for count in (100, 1000, 10000):
+        resources = [f'arn:tinyauth:service3:::things/{i % 600}/item{i}' for i in range(count)]
+
+        def per_pair():
+            return [[allow(policy, action, r) for r in resources] for action in actions]
+
+        assert allow_matrix(policy, actions, resources) == per_pair()
+
+        pairs = min(timeit.repeat(per_pair, number=1, repeat=number))
+        matrix = min(timeit.repeat(lambda: allow_matrix(policy, actions, resources), number=1, repeat=number))
+
+        print(
+            f'{len(actions)} actions x {count:>5} resources: '
+            f'allow per pair {pairs * 1e3:8.2f}ms, '
+            f'allow_matrix {matrix * 1e3:8.2f}ms, '
+            f'speedup {pairs / matrix:6.1f}x'
+        )
+
+
+def main():
+    number = 200
+
+    for statements in (50, 500, 2000):
+        policy = make_policy(statements)
+        compiled = compile_policy(policy)
+
+        checks = [
+            ('service3:Get3', 'arn:tinyauth:service3:::things/3/abc'),
+            ('service7:ListThings', 'arn:tinyauth:service7:::others/7'),
+            ('service9:Delete', 'arn:tinyauth:service9:::things/9/abc'),
+        ]
+
+        for action, resource in checks:
+            assert legacy_allow(policy, action, resource) == allow(compiled, action, resource)
+
+        def run(fn, p):
+            for action, resource in checks:
+                fn(p, action, resource)
+
+        legacy = timeit.timeit(lambda: run(legacy_allow, policy), number=number)
+        compile_time = timeit.timeit(lambda: compile_policy(policy), number=1)
+        fast = timeit.timeit(lambda: run(allow, compiled), number=number)
+
+        per_call = len(checks) * number
+        print(
+            f'{statements:>5} statements: '
+            f'legacy {legacy / per_call * 1e6:9.1f}us/decision, '
+            f'compiled {fast / per_call * 1e6:9.1f}us/decision, '
+            f'compile once {compile_time * 1e3:7.1f}ms, '
+            f'speedup {legacy / fast:6.1f}x'
+        )
+
+    bench_resource_trie()
+    bench_filter_resources()
+    bench_allow_matrix()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#! /usr/bin/env python3
+'''
+Compare answering "who can do X on Y" by evaluating every user's policy
+against looking up the candidates in the policy index
+
+Run from the repository root with `PYTHONPATH=. python benchmarks/bench_who_can.py`.
+'''
+
+import os
+import timeit
+
+from tinyauth.app import create_app, db
+from tinyauth.models import (
+    EffectivePolicy,
+    Group,
+    GroupPolicy,
+    PolicyIndex,
+    User,
+    UserPolicy,
+)
+from tinyauth.policy import allow
+
+USERS = 10000
+GROUPS = 200
+SERVICES = 40
+
+
+def populate():
+    db.create_all()
+
+    groups = []
+    for i in range(GROUPS):
+        service = f'service{i % SERVICES}'
+        group = Group(name=f'group{i}')
+        group.policies.append(GroupPolicy(name='default', policy={
+            'Statement': [{
+                'Action': [f'{service}:Get*', f'{service}:List*'],
+                'Resource': f'arn:tinyauth:{service}:::things/*',
+                'Effect': 'Allow',
+            }, {
+                'Action': f'{service}:Delete*',
+                'Resource': f'arn:tinyauth:{service}:::things/{i}/*',
+                'Effect': 'Allow',
+            }],
+        }))
+        groups.append(group)
+    db.session.add_all(groups)
+
+    for i in range(USERS):
+        user = User(username=f'user{i}', groups=[groups[i % GROUPS], groups[(i * 7 + 1) % GROUPS]])
+        if i % 1000 == 0:
+            user.policies.append(UserPolicy(name='admin', policy={
+                'Statement': [{'Action': 'tinyauth:*', 'Resource': '*', 'Effect': 'Allow'}],
+            }))
+        db.session.add(user)
+    db.session.flush()
+
+    user_ids = [user_id for (user_id, ) in db.session.query(User.id)]
+    for i in range(0, len(user_ids), 500):
+        EffectivePolicy.refresh(user_ids[i:i + 500])
+    db.session.commit()
+
+
+def scan(action, resource):
+    # Load and evaluate every user's policy, like a review script would
+    return sorted(
+        user.username for user in User.query_with_policies()
+        if allow(user.merged_policy(), action, resource) == 'Allow'
+    )
+
+
+def main():
+    os.environ.setdefault('DATABASE_URI', 'sqlite://')
+    os.environ.setdefault('SECRET_SIGNING_KEY', 'benchmark')
+
+    app = create_app(None)
+
+    with app.test_request_context():
+        populate()
+
+        queries = [
+            ('service3:DeleteThing', 'arn:tinyauth:service3:::things/43/x'),
+            ('tinyauth:DeleteUser', 'arn:tinyauth:tinyauth:::users/*'),
+        ]
+
+        for action, resource in queries:
+            allowed, conditional = PolicyIndex.who_can(action, resource)
+            assert allowed == scan(action, resource)
+
+            before = min(timeit.repeat(lambda: scan(action, resource), number=1, repeat=3))
+            after = min(timeit.repeat(lambda: PolicyIndex.who_can(action, resource), number=1, repeat=3))
+
+            print(
+                f'{action} on {resource} ({len(allowed)} users): '
+                f'scan {before * 1e3:8.1f}ms, '
+                f'index {after * 1e3:8.1f}ms, '
+                f'speedup {before / after:6.1f}x'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+import collections
+import csv
+import io
+import json
+import multiprocessing
+
+from .models import EffectivePolicy
+from .policy import review_matrix
+
+CSV_HEADER = ('user', 'action', 'resource', 'decision')
+
+BATCH_SIZE = 500
+
+# Users in the same groups share an effective policy, so each process keeps
+# the decisions for the policies it has already reviewed
+DECISIONS_CACHE_SIZE = 10000
+
+# Set in each worker by `_init_worker`
+_worker_args = None
+
+
+def iter_policies(batch_size=BATCH_SIZE):
+    '''
+    Yield every user's effective policy as lists of `(username, hash, policy)`
+
+    See `EffectivePolicy.iter_users`.
+    '''
+    return EffectivePolicy.iter_users(batch_size=batch_size)
+
+
+def _decisions(policy, actions, resources):
+    decisions = []
+    for action, row in zip(actions, review_matrix(policy, actions, resources)):
+        for resource, decision in zip(resources, row):
+            if decision != 'Default':
+                decisions.append((action, resource, decision))
+    return decisions
+
+
+def format_batch(batch, actions, resources, output_format='ndjson', cache=None):
+    '''
+    Review a batch of users and format every decision other than "Default"
+
+    Returns the number of decisions and the formatted text, one line per
+    user, action and resource. `cache` is a dict of decisions by policy hash
+    that can be shared between batches.
+    '''
+    if cache is None:
+        cache = {}
+
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n') if output_format == 'csv' else None
+    count = 0
+
+    for username, digest, policy in batch:
+        try:
+            decisions = cache[digest]
+        except KeyError:
+            if len(cache) >= DECISIONS_CACHE_SIZE:
+                cache.clear()
+            decisions = cache[digest] = _decisions(policy, actions, resources)
+
+        count += len(decisions)
+        for action, resource, decision in decisions:
+            if writer:
+                writer.writerow((username, action, resource, decision))
+            else:
+                out.write(json.dumps({'user': username, 'action': action, 'resource': resource, 'decision': decision}))
+                out.write('\n')
+
+    return count, out.getvalue()
+
+
+def _init_worker(actions, resources, output_format):
+    global _worker_args
+    _worker_args = (actions, resources, output_format, {})
+
+
+def _format_batch_in_worker(batch):
+    return len(batch), format_batch(batch, *_worker_args)
+
+
+def run(output, actions, resources, output_format='ndjson', processes=None, batch_size=BATCH_SIZE):
+    '''
+    Write an access review of every user to the `output` file
+
+    Batches of users are reviewed on a pool of `processes` workers, one per
+    CPU by default, or in this process if that is 1. At most two batches per
+    worker are in flight at a time, so neither the policies nor the results
+    are all held in memory. Batches are written in order. Returns the number
+    of users and decisions.
+    '''
+    actions = list(actions)
+    resources = list(resources)
+    processes = processes or multiprocessing.cpu_count()
+    users = decisions = 0
+
+    if output_format == 'csv':
+        csv.writer(output, lineterminator='\n').writerow(CSV_HEADER)
+
+    if processes == 1:
+        cache = {}
+        for batch in iter_policies(batch_size):
+            count, text = format_batch(batch, actions, resources, output_format, cache)
+            output.write(text)
+            users += len(batch)
+            decisions += count
+        return users, decisions
+
+    with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(actions, resources, output_format)) as pool:
+        window = 2 * processes
+        pending = collections.deque()
+
+        def drain(limit):
+            nonlocal users, decisions
+            while len(pending) > limit:
+                reviewed, (count, text) = pending.popleft().get()
+                output.write(text)
+                users += reviewed
+                decisions += count
+
+        for batch in iter_policies(batch_size):
+            pending.append(pool.apply_async(_format_batch_in_worker, (batch, )))
+            drain(window)
+        drain(0)
+
+    return users, decisions
@@ -1,8 +1,10 @@
 #! /usr/bin/env python3
 
+import datetime
 import logging
 import os
 import secrets
+import time
 
 import click
 from flask import Flask
@@ -30,6 +32,9 @@ def configure_backend_db(app):
     else:
         app.config['SECRET_SIGNING_KEY'] = os.environ['SECRET_SIGNING_KEY']
 
+    app.config['TINYAUTH_POLICY_CACHE_SIZE'] = int(os.environ.get('TINYAUTH_POLICY_CACHE_SIZE', '1000'))
+    app.config['TINYAUTH_POLICY_CACHE_CHECK_INTERVAL'] = float(os.environ.get('TINYAUTH_POLICY_CACHE_CHECK_INTERVAL', '0'))
+
     db.init_app(app)
     Migrate(app, db)
 
@@ -40,12 +45,18 @@ def configure_backend_db(app):
     app.register_blueprint(resources.group_blueprint)
     app.register_blueprint(resources.group_policy_blueprint)
     app.register_blueprint(resources.service_blueprint)
+    app.register_blueprint(resources.change_blueprint)
+    app.register_blueprint(resources.snapshot_blueprint)
+    app.register_blueprint(resources.who_can_blueprint)
 
     from . import frontend
     app.register_blueprint(frontend.frontend_blueprint)
 
     from .backends.db import Backend
-    app.auth_backend = Backend()
+    app.auth_backend = Backend(
+        cache_size=app.config['TINYAUTH_POLICY_CACHE_SIZE'],
+        cache_check_interval=app.config['TINYAUTH_POLICY_CACHE_CHECK_INTERVAL'],
+    )
 
 
 def configure_backend_proxy(app):
@@ -57,8 +68,51 @@ def configure_backend_proxy(app):
     from . import resources
     app.register_blueprint(resources.service_blueprint)
 
+    # Optional on-disk cache shared by all workers on the host, so that a
+    # restarted node doesn't have to ask the upstream about every user at once
+    app.config['TINYAUTH_CACHE_PATH'] = os.environ.get('TINYAUTH_CACHE_PATH')
+
+    store = None
+    if app.config['TINYAUTH_CACHE_PATH']:
+        import sqlite3
+
+        from .utils.store import SqliteStore
+
+        # The store is only an optimisation, so don't refuse to start without it
+        try:
+            store = SqliteStore(app.config['TINYAUTH_CACHE_PATH'])
+        except (OSError, ValueError, sqlite3.Error):
+            logger.warning('Unable to open cache %s, running without it', app.config['TINYAUTH_CACHE_PATH'], exc_info=True)
+
     from .backends import proxy
-    app.auth_backend = proxy.Backend()
+
+    # How long expired entries can be served while the upstream is unreachable
+    app.config['TINYAUTH_CACHE_MAX_STALE'] = float(os.environ.get('TINYAUTH_CACHE_MAX_STALE', proxy.MAX_STALE))
+    proxy.Backend.set_max_stale(app.config['TINYAUTH_CACHE_MAX_STALE'])
+
+    app.auth_backend = proxy.Backend(store=store)
+
+    # Poll the upstream for changed identities, so that cache entries are
+    # dropped as soon as they go out of date rather than when they expire
+    if os.environ.get('TINYAUTH_CHANGES_POLL_INTERVAL'):
+        app.config['TINYAUTH_CHANGES_POLL_INTERVAL'] = float(os.environ['TINYAUTH_CHANGES_POLL_INTERVAL'])
+        app.change_poller = proxy.ChangePoller(app, app.auth_backend, app.config['TINYAUTH_CHANGES_POLL_INTERVAL'])
+        app.before_request(app.change_poller.start)
+
+
+def configure_backend_snapshot(app):
+    # One or more files written by `tinyauth export-snapshot`, separated like $PATH
+    app.config['TINYAUTH_SNAPSHOT_PATH'] = os.environ['TINYAUTH_SNAPSHOT_PATH']
+    app.config['TINYAUTH_SNAPSHOT_CHECK_INTERVAL'] = float(os.environ.get('TINYAUTH_SNAPSHOT_CHECK_INTERVAL', '5'))
+
+    from . import resources
+    app.register_blueprint(resources.service_blueprint)
+
+    from .backends.snapshot import Backend
+    app.auth_backend = Backend(
+        app.config['TINYAUTH_SNAPSHOT_PATH'].split(os.pathsep),
+        check_interval=app.config['TINYAUTH_SNAPSHOT_CHECK_INTERVAL'],
+    )
 
 
 def create_app(info):
@@ -83,6 +137,8 @@ def create_app(info):
         configure_backend_db(app)
     elif app.config['TINYAUTH_AUTH_MODE'] == 'proxy':
         configure_backend_proxy(app)
+    elif app.config['TINYAUTH_AUTH_MODE'] == 'snapshot':
+        configure_backend_snapshot(app)
 
     return app
 
@@ -109,3 +165,101 @@ def createdevuser():
     db.session.commit()
 
     click.echo("'root' account created")
+
+
+@cli.command('rebuild-effective-policies')
+def rebuild_effective_policies():
+    """Recompute every user's materialized effective policy and policy index."""
+    from .models import EffectivePolicy, PolicyVersion, User, db
+
+    user_ids = [user_id for (user_id, ) in db.session.query(User.id).order_by(User.id)]
+
+    batch_size = 500
+    for i in range(0, len(user_ids), batch_size):
+        PolicyVersion.bump()
+        EffectivePolicy.refresh(user_ids[i:i + batch_size], reindex=True)
+        db.session.commit()
+
+    click.echo(f'Rebuilt effective policies for {len(user_ids)} users')
+
+
+@cli.command('who-can')
+@click.argument('action')
+@click.argument('resource')
+def who_can(action, resource):
+    """List the users that can do ACTION on RESOURCE."""
+    from .models import PolicyIndex
+
+    allowed, conditional = PolicyIndex.who_can(action, resource)
+
+    for username in allowed:
+        click.echo(username)
+    for username in conditional:
+        click.echo(f'{username} (conditional)')
+
+
+@cli.command('access-review')
+@click.option('--action', 'actions', multiple=True, required=True, help='An action to review, may be repeated.')
+@click.option('--resource', 'resources', multiple=True, required=True, help='A resource to review, may be repeated.')
+@click.option('--format', 'output_format', type=click.Choice(['ndjson', 'csv']), default='ndjson', help='Output format.')
+@click.option('--processes', type=int, default=None, help='Worker processes, defaults to one per CPU.')
+@click.option('--batch-size', type=int, default=500, help='Users reviewed per task.')
+@click.argument('output', type=click.File('w'), default='-')
+def access_review(actions, resources, output_format, processes, batch_size, output):
+    """Write every user's decision on each action and resource.
+
+    A resource like arn:tinyauth:tinyauth:::users/* is matched literally, so it
+    asks about every resource of that class. Decisions are Allow, Deny or
+    Conditional, and users with no decision aren't listed.
+    """
+    from .access_review import run
+
+    start = time.monotonic()
+    users, decisions = run(output, actions, resources, output_format, processes, batch_size)
+    elapsed = time.monotonic() - start
+
+    click.echo(f'Reviewed {users} users, {decisions} decisions in {elapsed:.2f}s', err=True)
+
+
+@cli.command('prune-changes')
+@click.option('--days', default=7, help='Keep changes from this many days.')
+def prune_changes(days):
+    """Delete old entries from the change feed."""
+    from .models import Change, db
+
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+
+    # Always keep the newest entry so the head cursor survives pruning
+    pruned = Change.query.filter(Change.created < cutoff, Change.id < Change.head()).delete(synchronize_session=False)
+    db.session.commit()
+
+    click.echo(f'Pruned {pruned} changes')
+
+
+@cli.command('export-snapshot')
+@click.option('--region', default='global', help='Region to export signing keys for.')
+@click.option('--service', default='tinyauth', help='Service to export signing keys for.')
+@click.option('--start', default=None, help='First day of signing keys (YYYYMMDD), defaults to today.')
+@click.option('--end', default=None, help='Last day of signing keys (YYYYMMDD), defaults to a week from the start.')
+@click.argument('path')
+def export_snapshot(region, service, start, end, path):
+    """Write a snapshot for a proxy running in snapshot mode."""
+    from flask import current_app
+
+    from . import snapshot
+
+    try:
+        dates = snapshot.date_range(start, end)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+    data = snapshot.dumps(snapshot.build(region, service, dates, current_app.config['SECRET_SIGNING_KEY']))
+
+    # Move the file into place so a proxy never sees it half written. It holds
+    # every signing key, so only the owner may read it.
+    tmp = f'{path}.tmp'
+    with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as fp:
+        fp.write(data)
+    os.replace(tmp, path)
+
+    click.echo(f'Exported snapshot for {region}/{service} from {dates[0]:%Y%m%d} to {dates[-1]:%Y%m%d} to {path}')
@@ -7,7 +7,13 @@ from . import const
 from .exceptions import AuthenticationError, AuthorizationError, IdentityError
 from .identity import identify
 from .models import User
-from .policy import allow
+from .policy import allow, filter_resources
+from .utils.cache import Cache
+
+# Identities and policies looked up while authorizing a bulk request or a
+# stream are reused for this long, so that a long stream still sees changes
+MEMO_TTL = 60
+MEMO_SIZE = 10000
 
 
 def get_arn_base():
@@ -30,11 +36,12 @@ def format_arn(resource_class, resource=''):
 
 
 def _authorize_user(region, service, user, action, resource, headers, context):
-    policy = current_app.auth_backend.get_policies(region, service, user)
+    policy = current_app.auth_backend.get_compiled_policies(region, service, user)
+    return _evaluate(policy, user, action, resource, dict(context))
 
-    ctx = dict(context)
 
-    if allow(policy, action, resource, ctx) != 'Allow':
+def _evaluate(policy, user, action, resource, context):
+    if allow(policy, action, resource, context) != 'Allow':
         return {
             'Authorized': False,
             'ErrorCode': 'NotPermitted',
@@ -60,6 +67,55 @@ def _authorize_access_key(region, service, action, resource, headers, context):
     return _authorize_user(region, service, username, action, resource, headers, context)
 
 
+def _identify_or_error(region, service, headers):
+    try:
+        return identify(region, service, headers)
+    except IdentityError as e:
+        return e
+
+
+def _memoize(memo, key, fn):
+    try:
+        expires_in, value = memo.lookup(key)
+    except KeyError:
+        pass
+    else:
+        if expires_in > 0:
+            return value
+
+    value = fn()
+    memo.set(key, value, datetime.datetime.utcnow() + datetime.timedelta(seconds=MEMO_TTL))
+    return value
+
+
+def _authorize_access_key_many(region, service, permits, headers, context, identities=None, policies=None):
+    # `identities` and `policies` can be shared between calls, so a caller
+    # that appears more than once is only checked once
+    identities = Cache(max_size=MEMO_SIZE) if identities is None else identities
+    policies = Cache(max_size=MEMO_SIZE) if policies is None else policies
+
+    identity = _memoize(
+        identities,
+        (region, service, tuple(headers.items())),
+        lambda: _identify_or_error(region, service, headers),
+    )
+    if isinstance(identity, IdentityError):
+        return [identity.asdict() for _ in permits]
+
+    username, mfa = identity
+
+    context = dict(context)
+    context['Mfa'] = mfa
+
+    policy = _memoize(
+        policies,
+        (region, service, username),
+        lambda: current_app.auth_backend.get_compiled_policies(region, service, username),
+    )
+
+    return [_evaluate(policy, username, action, resource, context) for action, resource in permits]
+
+
 def _authorize_login(region, service, action, resource, headers, context):
     if 'Authorization' not in headers:
         return {
@@ -102,6 +158,90 @@ def external_authorize(region, service, action, resource, headers, context):
     return _authorize_access_key(region, service, action, resource, headers, context)
 
 
+def external_authorize_many(region, service, permits, headers, context):
+    '''
+    Like `external_authorize` for a list of `(action, resource)` pairs
+
+    The request is identified and the policy loaded only once. Returns a
+    result for each pair, in order.
+    '''
+    return _authorize_access_key_many(region, service, permits, headers, context)
+
+
+def external_authorize_bulk(service, requests):
+    '''
+    Authorize many independent requests, e.g. from different callers
+
+    Each request is a dict with the `region`, `permits`, `headers` and
+    `context` that `external_authorize_many` takes, and gets a list of
+    results back, in order. Requests with the same region and headers are
+    only identified once, and each identity's policy is only loaded once.
+    '''
+    identities = Cache(max_size=MEMO_SIZE)
+    policies = Cache(max_size=MEMO_SIZE)
+
+    return [
+        _authorize_access_key_many(
+            r['region'],
+            service,
+            r['permits'],
+            r['headers'],
+            r['context'],
+            identities=identities,
+            policies=policies,
+        ) for r in requests
+    ]
+
+
+def external_authorizer():
+    '''
+    Return a function like `external_authorize` that remembers identities and policies
+
+    For authorizing a long run of requests, e.g. from a stream. Lookups are
+    reused for up to `MEMO_TTL` seconds, and at most `MEMO_SIZE` of each are
+    kept, so memory stays flat however many requests there are.
+    '''
+    identities = Cache(max_size=MEMO_SIZE)
+    policies = Cache(max_size=MEMO_SIZE)
+
+    def authorize(region, service, action, resource, headers, context):
+        return _authorize_access_key_many(
+            region,
+            service,
+            [(action, resource)],
+            headers,
+            context,
+            identities=identities,
+            policies=policies,
+        )[0]
+
+    return authorize
+
+
+def external_filter_resources(region, service, action, resources, headers, context):
+    '''
+    Return which of `resources` the caller identified by `headers` may `action`
+
+    The result has the `Identity` and the `Allowed` resources, in order. If
+    the caller can't be identified it is the error from `external_authorize`
+    with nothing allowed.
+    '''
+    try:
+        username, mfa = identify(region, service, headers)
+    except IdentityError as e:
+        return dict(e.asdict(), Allowed=[])
+
+    context = dict(context)
+    context['Mfa'] = mfa
+
+    policy = current_app.auth_backend.get_compiled_policies(region, service, username)
+
+    return {
+        'Identity': username,
+        'Allowed': filter_resources(policy, action, resources, context),
+    }
+
+
 def internal_authorize(action, resource, ctx=None):
     context = {
         'SourceIp': request.remote_addr,
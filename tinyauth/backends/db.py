@@ -1,29 +1,70 @@
-from flask import current_app
+import time
+
+from flask import current_app, g
 from sqlalchemy.orm.exc import NoResultFound
 
 from .. import exceptions
-from ..models import AccessKey, User
+from ..models import AccessKey, EffectivePolicy, PolicyVersion, User
+from ..policy import compile_policy
 from ..subkey import make_basic_auth_key, make_jwt_key
+from ..utils.cache import Cache
 
 
 class Backend(object):
 
-    def get_policies(self, region, service, username):
-        user = User.query.filter(User.username == username).one()
+    def __init__(self, cache_size=1000, cache_check_interval=0):
+        self.policies = Cache(max_size=cache_size)
+        self.cache_check_interval = cache_check_interval
+        self.policy_version = None
+        self.policy_version_checked = None
 
-        policy = {
-            'Statement': []
-        }
+    def _check_policy_version(self):
+        '''
+        Find out if any policies have changed since they were cached
+
+        The version row is read at most once per request, and no more than
+        once every `cache_check_interval` seconds.
+        '''
+        if 'tinyauth_policy_version' in g:
+            return g.tinyauth_policy_version
+
+        now = time.monotonic()
+        if self.policy_version_checked is None or now - self.policy_version_checked >= self.cache_check_interval:
+            version = PolicyVersion.current()
+            if version != self.policy_version:
+                self.policies.clear()
+                self.policy_version = version
+            self.policy_version_checked = now
 
-        for group in user.groups:
-            for p in group.policies:
-                policy['Statement'].extend(p.policy.get('Statement', []))
+        g.tinyauth_policy_version = self.policy_version
+        return self.policy_version
 
-        for p in user.policies:
-            policy['Statement'].extend(p.policy.get('Statement', []))
+    def get_compiled_policies(self, region, service, username):
+        version = self._check_policy_version()
+
+        try:
+            _, (cached_version, policy) = self.policies.get(username)
+        except KeyError:
+            pass
+        else:
+            # An entry loaded under an older version can still be stored by a
+            # request that raced with the version being bumped
+            if cached_version == version:
+                return policy
+
+        policy = compile_policy(self._load_policies(username))
+        self.policies.set(username, (version, policy), None)
 
         return policy
 
+    def get_policies(self, region, service, username):
+        return self.get_compiled_policies(region, service, username).document
+
+    def _load_policies(self, username):
+        for batch in EffectivePolicy.iter_users(User.username == username):
+            return batch[0][2]
+        raise NoResultFound(f'No user {username}')
+
     def get_user_key(self, protocol, region, service, date, username):
         try:
             User.query.filter(User.username == username).one()
@@ -1,100 +1,374 @@
 import base64
+import collections
 import datetime
+import functools
+import logging
+import os
+import threading
 
 import requests
 from flask import current_app
 
 from tinyauth import exceptions
-from tinyauth.utils.cache import cache
+from tinyauth.policy import compile_policy
+from tinyauth.utils.cache import Cache, cache
+
+# Refresh entries this many seconds before they expire, so requests don't
+# wait on the upstream once an entry is hot
+REFRESH_AHEAD = 15
+
+# Remember unknown identities for this long, so bogus or deleted keys don't
+# each cost an upstream request
+NEGATIVE_TTL = 30
+NEGATIVE_SIZE = 10000
+
+# Expired entries are served while the upstream can't be reached, but not
+# for longer than this. A sweep drops them once they are that stale.
+MAX_STALE = 60 * 60
+
+# The most identities the upstream accepts in one identity bundles request
+BUNDLE_SIZE = 100
+
+CHANGES_CURSOR_KEY = 'changes-cursor'
+
+# How many ETags to remember for revalidating expired entries
+VALIDATORS_SIZE = 10000
+
+# How many compiled policies to keep alongside the cached documents
+COMPILED_SIZE = 10000
+
+logger = logging.getLogger('tinyauth.proxy')
+
+
+def _app_context():
+    return current_app._get_current_object().app_context()
+
+
+cached = functools.partial(
+    cache,
+    refresh_ahead=REFRESH_AHEAD,
+    refresh_context=_app_context,
+    negative=exceptions.NoSuchKey,
+    negative_ttl=NEGATIVE_TTL,
+    negative_size=NEGATIVE_SIZE,
+    max_stale=MAX_STALE,
+)
+
+
+def _signing_token_uri(kind, protocol, region, service, date, identity):
+    token_id = '/'.join((
+        identity,
+        protocol,
+        date.strftime('%Y%m%d'),
+    ))
+    return f'/api/v1/regions/{region}/services/{service}/{kind}-signing-tokens/{token_id}'
+
+
+def _user_policies_uri(region, service, username):
+    return f'/api/v1/regions/{region}/services/{service}/user-policies/{username}'
+
+
+def _decode_token(token):
+    return dict(token, key=base64.b64decode(token['key']))
 
 
 class Backend(object):
 
-    def __init__(self):
+    def __init__(self, store=None):
         self.session = requests.Session()
+        self.store = store
+        self.change_cursor = None
 
-    @cache()
-    def get_policies(self, region, service, username):
+        # The ETag and body last seen for each uri, so that an unchanged
+        # body only costs a 304 once it expires
+        self.validators = Cache(max_size=VALIDATORS_SIZE)
+
+        # The document each policy was compiled from, so it is only compiled
+        # again once the cached document is replaced
+        self.compiled = Cache(max_size=COMPILED_SIZE)
+
+        # Cleared once the upstream turns out not to have the identity
+        # bundles endpoint, so that keys are fetched one at a time from then on
+        self.bundles_supported = True
+
+    def _request(self, method, uri, headers=None, **kwargs):
         endpoint = current_app.config['TINYAUTH_ENDPOINT']
-        uri = f'/api/v1/regions/{region}/services/{service}/user-policies/{username}'
 
-        response = self.session.get(
+        return getattr(self.session, method)(
             f'{endpoint}{uri}',
             auth=(
                 current_app.config['TINYAUTH_ACCESS_KEY_ID'],
                 current_app.config['TINYAUTH_SECRET_ACCESS_KEY'],
             ),
-            headers={
+            headers=dict({
                 'Accept': 'application/json',
-            },
+            }, **(headers or {})),
             verify=current_app.config.get('TINYAUTH_VERIFY', True),
+            **kwargs
         )
 
+    def _stored(self, uri):
+        # Another worker on this host (or this one before a restart) may
+        # already have fetched this. Entries that are about to expire are
+        # fetched again, so that refreshing ahead of expiry isn't a no-op.
+        if not self.store:
+            return None
+
+        stored = self.store.get(uri)
+        refresh_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=REFRESH_AHEAD)
+        if stored and stored[0] > refresh_at:
+            return stored
+
+        return None
+
+    def _fetch(self, uri, identity):
+        stored = self._stored(uri)
+        if stored:
+            return stored
+
+        try:
+            _, (etag, cached_body) = self.validators.get(uri)
+        except KeyError:
+            etag = None
+
+        response = self._request('get', uri, headers={'If-None-Match': etag} if etag else None)
+
         if response.status_code == 404:
-            raise exceptions.NoSuchKey(identity=username)
+            self.validators.delete(uri)
+            raise exceptions.NoSuchKey(identity=identity)
 
         expires = datetime.datetime.strptime(response.headers['Expires'], '%a, %d %b %Y %H:%M:%S GMT')
 
-        return expires, response.json()
+        if etag and response.status_code == 304:
+            body = cached_body
+        else:
+            body = response.json()
+            if response.headers.get('ETag'):
+                self.validators.set(uri, (response.headers['ETag'], body), None)
 
-    @cache()
-    def get_user_key(self, protocol, region, service, date, username):
-        endpoint = current_app.config['TINYAUTH_ENDPOINT']
-        token_id = '/'.join((
-            username,
-            protocol,
-            date.strftime('%Y%m%d'),
-        ))
-        uri = f'/api/v1/regions/{region}/services/{service}/user-signing-tokens/{token_id}'
-
-        response = self.session.get(
-            f'{endpoint}{uri}',
-            auth=(
-                current_app.config['TINYAUTH_ACCESS_KEY_ID'],
-                current_app.config['TINYAUTH_SECRET_ACCESS_KEY'],
-            ),
-            headers={
-                'Accept': 'application/json',
+        if self.store:
+            self.store.set(uri, body, expires, identity=identity)
+
+        return expires, body
+
+    def _fetch_bundles(self, protocol, region, service, date, identities):
+        '''
+        Fetch signing keys and policies for many identities in one request
+
+        `identities` maps `access-keys` and `users` to lists of ids. Everything
+        that comes back is primed into the caches. Returns `None` if the
+        upstream is too old to have the identity bundles endpoint, or fails
+        the request, so that the caller can fall back to fetching each key.
+        '''
+        if not self.bundles_supported:
+            return None
+
+        response = self._request(
+            'post',
+            f'/api/v1/regions/{region}/services/{service}/identity-bundles',
+            json={
+                'protocol': protocol,
+                'date': date.strftime('%Y%m%d'),
+                'access-keys': identities.get('access-keys', []),
+                'users': identities.get('users', []),
             },
-            verify=current_app.config.get('TINYAUTH_VERIFY', True),
         )
 
         if response.status_code == 404:
-            raise exceptions.NoSuchKey(identity=username)
+            logger.info('Upstream has no identity bundles endpoint, fetching keys one at a time')
+            self.bundles_supported = False
+            return None
 
-        expires = datetime.datetime.strptime(response.headers['Expires'], '%a, %d %b %Y %H:%M:%S GMT')
+        if response.status_code >= 400:
+            logger.warning('Unable to fetch identity bundles: HTTP %s', response.status_code)
+            return None
+
+        body = response.json()
+
+        now = datetime.datetime.utcnow()
+        key_expires = now + datetime.timedelta(seconds=body['key-max-age'])
+        policy_expires = now + datetime.timedelta(seconds=body['policy-max-age'])
+
+        for kind, get_key in (('access-key', Backend.get_access_key), ('user', Backend.get_user_key)):
+            for identity, bundle in body[f'{kind}s'].items():
+                if not bundle:
+                    continue
+
+                token = {'key': bundle['key'], 'identity': bundle['identity']}
+                get_key.prime(key_expires, _decode_token(token), self, protocol, region, service, date, identity)
+                Backend.get_policies.prime(policy_expires, bundle['policy'], self, region, service, bundle['identity'])
+
+                if self.store:
+                    token_uri = _signing_token_uri(kind, protocol, region, service, date, identity)
+                    self.store.set(token_uri, token, key_expires, identity=identity)
+                    policies_uri = _user_policies_uri(region, service, bundle['identity'])
+                    self.store.set(policies_uri, bundle['policy'], policy_expires, identity=bundle['identity'])
 
-        token = response.json()
-        token['key'] = base64.b64decode(token['key'])
-        return expires, token
+        return body
 
-    @cache()
+    def _get_key(self, kind, protocol, region, service, date, identity):
+        uri = _signing_token_uri(kind, protocol, region, service, date, identity)
+
+        stored = self._stored(uri)
+        if stored:
+            expires, token = stored
+            return expires, _decode_token(token)
+
+        bundles = self._fetch_bundles(protocol, region, service, date, {f'{kind}s': [identity]})
+        if bundles is None:
+            expires, token = self._fetch(uri, identity)
+            return expires, _decode_token(token)
+
+        bundle = bundles[f'{kind}s'][identity]
+        if not bundle:
+            raise exceptions.NoSuchKey(identity=identity)
+
+        expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=bundles['key-max-age'])
+        return expires, _decode_token({'key': bundle['key'], 'identity': bundle['identity']})
+
+    def prefetch(self, protocol, region, service, date, access_keys=(), users=()):
+        '''
+        Warm the caches for many identities with as few requests as possible
+        '''
+        identities = [('access-keys', a) for a in access_keys] + [('users', u) for u in users]
+
+        for i in range(0, len(identities), BUNDLE_SIZE):
+            batch = collections.defaultdict(list)
+            for kind, identity in identities[i:i + BUNDLE_SIZE]:
+                batch[kind].append(identity)
+            if self._fetch_bundles(protocol, region, service, date, batch) is None:
+                return
+
+    def invalidate(self, users=(), access_keys=()):
+        '''
+        Drop everything cached about the given users and access keys
+        '''
+        users = set(users)
+        access_keys = set(access_keys)
+
+        Backend.get_policies.invalidate(lambda key: key[0] is self and key[-1] in users)
+        Backend.get_user_key.invalidate(lambda key: key[0] is self and key[-1] in users)
+        Backend.get_access_key.invalidate(lambda key: key[0] is self and key[-1] in access_keys)
+
+        if self.store:
+            self.store.delete_identities(users | access_keys)
+
+    @classmethod
+    def set_max_stale(cls, max_stale):
+        for fn in (cls.get_policies, cls.get_user_key, cls.get_access_key):
+            fn.cache.max_stale = max_stale
+
+    def invalidate_all(self):
+        for fn in (Backend.get_policies, Backend.get_user_key, Backend.get_access_key):
+            fn.invalidate(lambda key: key[0] is self)
+
+        if self.store:
+            self.store.clear()
+
+    def poll_changes(self, max_pages=10):
+        '''
+        Drop the cache entries the upstream change feed says are out of date
+
+        The first poll only finds out where the feed currently is, unless the
+        on-disk store remembers where it had got to.
+        '''
+        if self.change_cursor is None and self.store:
+            stored = self.store.get(CHANGES_CURSOR_KEY)
+            if stored:
+                self.change_cursor = stored[1]
+
+        for i in range(max_pages):
+            uri = '/api/v1/changes'
+            if self.change_cursor is not None:
+                uri += f'?since={self.change_cursor}'
+
+            response = self._request('get', uri)
+            response.raise_for_status()
+            body = response.json()
+
+            if body['reset']:
+                self.invalidate_all()
+            elif body['changes']:
+                self.invalidate(
+                    users=(change['user'] for change in body['changes'] if not change['access-key']),
+                    access_keys=(change['access-key'] for change in body['changes'] if change['access-key']),
+                )
+
+            self.change_cursor = body['cursor']
+            if self.store:
+                self.store.set(CHANGES_CURSOR_KEY, self.change_cursor, datetime.datetime.max)
+
+            if not body['more']:
+                break
+
+    @cached()
+    def get_policies(self, region, service, username):
+        return self._fetch(_user_policies_uri(region, service, username), username)
+
+    def get_compiled_policies(self, region, service, username):
+        document = self.get_policies(region, service, username)
+        key = (region, service, username)
+
+        try:
+            _, (compiled_from, compiled) = self.compiled.get(key)
+        except KeyError:
+            compiled_from = None
+
+        if compiled_from is not document:
+            compiled = compile_policy(document)
+            self.compiled.set(key, (document, compiled), None)
+
+        return compiled
+
+    @cached()
+    def get_user_key(self, protocol, region, service, date, username):
+        return self._get_key('user', protocol, region, service, date, username)
+
+    @cached()
     def get_access_key(self, protocol, region, service, date, access_key_id):
-        endpoint = current_app.config['TINYAUTH_ENDPOINT']
-        token_id = '/'.join((
-            access_key_id,
-            protocol,
-            date.strftime('%Y%m%d'),
-        ))
-        uri = f'/api/v1/regions/{region}/services/{service}/access-key-signing-tokens/{token_id}'
-
-        response = self.session.get(
-            f'{endpoint}{uri}',
-            auth=(
-                current_app.config['TINYAUTH_ACCESS_KEY_ID'],
-                current_app.config['TINYAUTH_SECRET_ACCESS_KEY'],
-            ),
-            headers={
-                'Accept': 'application/json',
-            },
-            verify=current_app.config.get('TINYAUTH_VERIFY', True),
-        )
+        return self._get_key('access-key', protocol, region, service, date, access_key_id)
 
-        if response.status_code == 404:
-            raise exceptions.NoSuchKey(identity=access_key_id)
 
-        expires = datetime.datetime.strptime(response.headers['Expires'], '%a, %d %b %Y %H:%M:%S GMT')
+class ChangePoller(object):
+
+    '''
+    Poll the upstream change feed from a background thread
+
+    `start` is safe to call on every request. The thread is only started once
+    per process, so it is also started in each worker after a fork.
+    '''
+
+    def __init__(self, app, backend, interval):
+        self.app = app
+        self.backend = backend
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pid = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        if self.pid == os.getpid():
+            return
+
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+
+            thread = threading.Thread(target=self.run, name='tinyauth-changes', daemon=True)
+            thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def poll(self):
+        with self.app.app_context():
+            try:
+                self.backend.poll_changes()
+            except Exception:
+                logger.warning('Unable to poll for changes', exc_info=True)
 
-        token = response.json()
-        token['key'] = base64.b64decode(token['key'])
-        return expires, token
+    def run(self):
+        while not self.stopped.is_set():
+            self.poll()
+            self.stopped.wait(self.interval)
@@ -0,0 +1,155 @@
+import base64
+import logging
+import os
+import threading
+import time
+
+from tinyauth import exceptions
+from tinyauth.policy import compile_policy
+from tinyauth.snapshot import InvalidSnapshot, loads
+
+logger = logging.getLogger('tinyauth.snapshot')
+
+
+class Snapshot(object):
+
+    '''
+    A loaded snapshot, indexed for lookups by identity
+    '''
+
+    def __init__(self, body):
+        self.region = body['region']
+        self.service = body['service']
+        self.dates = body['dates']
+        self.created = body['created']
+        self.policies = body['policies']
+        self.users = body['users']
+        self.access_keys = body['access-keys']
+        self.compiled = {}
+
+    def __repr__(self):
+        return f'<Snapshot {self.region!r} {self.service!r} {self.dates[0]}-{self.dates[-1]}>'
+
+
+class SnapshotFile(object):
+
+    '''
+    A snapshot file that is loaded again whenever it is replaced
+
+    The file is checked at most every `check_interval` seconds. A replacement
+    that can't be read or fails its corruption check is logged and ignored, and the
+    last good snapshot is kept, so new files should be moved into place
+    rather than written in place.
+    '''
+
+    def __init__(self, path, check_interval=5):
+        self.path = path
+        self.check_interval = check_interval
+        self.snapshot = None
+        self.stat = None
+        self.checked = None
+        self.lock = threading.Lock()
+
+    def _load(self, stat):
+        try:
+            with open(self.path, 'rb') as fp:
+                snapshot = Snapshot(loads(fp.read()))
+        except (OSError, InvalidSnapshot, KeyError):
+            logger.warning('Unable to load snapshot %s, keeping %r', self.path, self.snapshot, exc_info=True)
+            return
+
+        self.snapshot = snapshot
+        self.stat = stat
+        logger.info('Loaded %r from %s', snapshot, self.path)
+
+    def current(self):
+        now = time.monotonic()
+        if self.checked is not None and now - self.checked < self.check_interval:
+            return self.snapshot
+
+        with self.lock:
+            if self.checked is not None and now - self.checked < self.check_interval:
+                return self.snapshot
+            self.checked = now
+
+            try:
+                st = os.stat(self.path)
+            except OSError:
+                logger.warning('Unable to stat snapshot %s', self.path, exc_info=True)
+                return self.snapshot
+
+            stat = (st.st_ino, st.st_mtime_ns, st.st_size)
+            if stat != self.stat:
+                self._load(stat)
+
+        return self.snapshot
+
+
+class Backend(object):
+
+    '''
+    Answer entirely from snapshot files exported by `tinyauth export-snapshot`
+
+    Each file covers one region and service. Policies aren't scoped, so they
+    are taken from the file for the region and service if there is one and
+    from any other file otherwise.
+    '''
+
+    def __init__(self, paths, check_interval=5):
+        self.files = [SnapshotFile(path, check_interval=check_interval) for path in paths]
+
+    def _snapshots(self, region, service):
+        snapshots = [snapshot for snapshot in (f.current() for f in self.files) if snapshot]
+        return sorted(snapshots, key=lambda s: (s.region, s.service) != (region, service))
+
+    def _scoped(self, region, service, identity):
+        for snapshot in self._snapshots(region, service):
+            if (snapshot.region, snapshot.service) == (region, service):
+                return snapshot
+        raise exceptions.NoSuchKey(identity=identity)
+
+    def _find_policies(self, region, service, username):
+        for snapshot in self._snapshots(region, service):
+            if username in snapshot.policies:
+                return snapshot
+        raise exceptions.NoSuchKey(identity=username)
+
+    def get_policies(self, region, service, username):
+        return self._find_policies(region, service, username).policies[username]
+
+    def get_compiled_policies(self, region, service, username):
+        snapshot = self._find_policies(region, service, username)
+
+        # Compiled policies belong to the snapshot, so a reload drops them
+        try:
+            return snapshot.compiled[username]
+        except KeyError:
+            policy = snapshot.compiled[username] = compile_policy(snapshot.policies[username])
+            return policy
+
+    def get_user_key(self, protocol, region, service, date, username):
+        snapshot = self._scoped(region, service, username)
+
+        try:
+            key = snapshot.users[username][protocol][date.strftime('%Y%m%d')]
+        except KeyError:
+            raise exceptions.NoSuchKey(identity=username)
+
+        return {
+            'identity': username,
+            'key': base64.b64decode(key),
+        }
+
+    def get_access_key(self, protocol, region, service, date, access_key_id):
+        snapshot = self._scoped(region, service, access_key_id)
+
+        try:
+            access_key = snapshot.access_keys[access_key_id]
+            key = access_key[protocol][date.strftime('%Y%m%d')]
+        except KeyError:
+            raise exceptions.NoSuchKey(identity=access_key_id)
+
+        return {
+            'identity': access_key['identity'],
+            'key': base64.b64decode(key),
+        }
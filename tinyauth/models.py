@@ -1,11 +1,14 @@
 import binascii
+import datetime
 import hashlib
 import json
 import secrets
 
 import sqlalchemy.types as types
+from sqlalchemy.orm import joinedload, subqueryload
 
 from tinyauth.app import db
+from tinyauth.policy import _compile_glob, _get_list, _get_service, review
 
 
 class StringyJSON(types.TypeDecorator):
@@ -32,12 +35,17 @@ MagicJSON = types.JSON().with_variant(StringyJSON, 'sqlite')
 group_users = db.Table(
     'group_users',
     db.Column('group_id', db.Integer, db.ForeignKey('group.id'), primary_key=True),
-    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Index('ix_group_users_user_id', 'user_id'),
 )
 
 
 class GroupPolicy(db.Model):
 
+    __table_args__ = (
+        db.Index('ix_group_policy_group_id_name', 'group_id', 'name', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128))
     policy = db.Column(MagicJSON)
@@ -50,9 +58,9 @@ class GroupPolicy(db.Model):
 class Group(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(128))
+    name = db.Column(db.String(128), index=True, unique=True)
 
-    policies = db.relationship('GroupPolicy', backref='group', lazy=True)
+    policies = db.relationship('GroupPolicy', backref='group', lazy=True, order_by='GroupPolicy.id')
 
     def __repr__(self):
         return f'<Group {self.name!r}>'
@@ -60,6 +68,10 @@ class Group(db.Model):
 
 class UserPolicy(db.Model):
 
+    __table_args__ = (
+        db.Index('ix_user_policy_user_id_name', 'user_id', 'name', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128))
     policy = db.Column(MagicJSON)
@@ -72,7 +84,7 @@ class UserPolicy(db.Model):
 class User(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(128))
+    username = db.Column(db.String(128), index=True, unique=True)
     password = db.Column(db.String(64))
     salt = db.Column(db.LargeBinary(length=16))
 
@@ -83,9 +95,43 @@ class User(db.Model):
         backref=db.backref('users', lazy=True)
     )
 
-    policies = db.relationship('UserPolicy', backref='user', lazy=True)
+    policies = db.relationship('UserPolicy', backref='user', lazy=True, order_by='UserPolicy.id')
     access_keys = db.relationship('AccessKey', backref='user', lazy=True)
 
+    effective_policy = db.relationship(
+        'EffectivePolicy',
+        backref='user',
+        uselist=False,
+        lazy=True,
+        cascade='all, delete-orphan',
+    )
+
+    policy_index = db.relationship('PolicyIndex', lazy=True, cascade='all, delete-orphan')
+
+    @classmethod
+    def query_with_policies(cls):
+        # Load everything up front so the number of queries doesn't grow with
+        # the number of groups. Group policies use a subquery load rather
+        # than a join so the rows don't multiply with the user's own policies.
+        return cls.query.options(
+            joinedload(cls.policies),
+            subqueryload(cls.groups).subqueryload(Group.policies),
+        )
+
+    def merged_policy(self):
+        policy = {
+            'Statement': []
+        }
+
+        for group in self.groups:
+            for p in group.policies:
+                policy['Statement'].extend(p.policy.get('Statement', []))
+
+        for p in self.policies:
+            policy['Statement'].extend(p.policy.get('Statement', []))
+
+        return policy
+
     def _hash_password(self, password):
         dk = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), self.salt, 100000)
         return binascii.hexlify(dk).decode('utf-8')
@@ -105,10 +151,248 @@ class AccessKey(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
 
-    access_key_id = db.Column(db.String(128))
+    access_key_id = db.Column(db.String(128), index=True, unique=True)
     secret_access_key = db.Column(db.String(128))
 
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
     def __repr__(self):
         return f'<AccessKey {self.access_key_id!r}>'
+
+
+class PolicyVersion(db.Model):
+
+    '''
+    A single counter that is bumped by every write that can change a user's
+    effective policy, so that workers know when cached policies are stale.
+    '''
+
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def current(cls):
+        return db.session.query(cls.version).filter(cls.id == 1).scalar() or 0
+
+    @classmethod
+    def bump(cls):
+        updated = cls.query.filter(cls.id == 1).update(
+            {cls.version: cls.version + 1},
+            synchronize_session=False,
+        )
+        if not updated:
+            db.session.add(cls(id=1, version=1))
+
+    def __repr__(self):
+        return f'<PolicyVersion {self.version!r}>'
+
+
+def hash_policy(policy):
+    canonical = json.dumps(policy, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class EffectivePolicy(db.Model):
+
+    '''
+    A user's group and user policies flattened into a single document
+
+    This is kept up to date by the API whenever a policy or group membership
+    changes, so that authorizing a user is a single row lookup.
+    '''
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    policy = db.Column(MagicJSON)
+    hash = db.Column(db.String(64))
+
+    @classmethod
+    def refresh(cls, user_ids, reindex=False):
+        '''
+        Recompute the effective policy of the given users
+
+        Pending changes are flushed first and the users are reloaded, so
+        policies and memberships that were just added or removed are seen.
+        The `PolicyIndex` rows of a user are rewritten whenever their policy
+        changes, or always with `reindex`.
+
+        Call `PolicyVersion.bump` first. Its row lock makes concurrent writes
+        wait for each other, so each merge sees the changes committed before
+        it rather than overwriting them with an older merge.
+        '''
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+
+        db.session.flush()
+
+        users = User.query_with_policies().options(
+            joinedload(User.effective_policy),
+            subqueryload(User.policy_index),
+        ).populate_existing().filter(User.id.in_(user_ids))
+
+        for user in users:
+            policy = user.merged_policy()
+            digest = hash_policy(policy)
+
+            if user.effective_policy is None:
+                user.effective_policy = cls(policy=policy, hash=digest)
+            elif user.effective_policy.hash != digest:
+                user.effective_policy.policy = policy
+                user.effective_policy.hash = digest
+            else:
+                if reindex:
+                    user.policy_index = PolicyIndex.for_policy(policy)
+                continue
+
+            user.policy_index = PolicyIndex.for_policy(policy)
+            Change.record(user.username)
+
+    @classmethod
+    def iter_users(cls, *criterion, batch_size=500):
+        '''
+        Yield the users matching `criterion` as lists of `(username, hash, policy)`
+
+        Users are loaded `batch_size` at a time in username order. Users whose
+        effective policy hasn't been materialized yet, e.g. before `tinyauth
+        rebuild-effective-policies` has been run on an existing deployment,
+        have theirs merged from their user and group policies, a batch at a time.
+        '''
+        rows = db.session.query(User.username, cls.hash, cls.policy).outerjoin(
+            cls, cls.user_id == User.id,
+        ).filter(*criterion).order_by(User.username).yield_per(batch_size)
+
+        batch = []
+        for row in rows:
+            batch.append(tuple(row))
+            if len(batch) == batch_size:
+                yield cls._fill_missing(batch)
+                batch = []
+
+        if batch:
+            yield cls._fill_missing(batch)
+
+    @classmethod
+    def by_username(cls, *criterion, batch_size=500):
+        '''
+        Return the policy of each user matching `criterion` by username, see `iter_users`
+        '''
+        return {username: policy for batch in cls.iter_users(*criterion, batch_size=batch_size) for username, digest, policy in batch}
+
+    @classmethod
+    def _fill_missing(cls, batch):
+        missing = [username for username, digest, policy in batch if policy is None]
+        if not missing:
+            return batch
+
+        merged = {user.username: user.merged_policy() for user in User.query_with_policies().filter(User.username.in_(missing))}
+
+        filled = []
+        for username, digest, policy in batch:
+            if policy is None:
+                policy = merged[username]
+                digest = hash_policy(policy)
+            filled.append((username, digest, policy))
+        return filled
+
+    @classmethod
+    def refresh_group(cls, group):
+        user_ids = db.session.query(group_users.c.user_id).filter(group_users.c.group_id == group.id)
+        cls.refresh(user_id for (user_id, ) in user_ids)
+
+    def __repr__(self):
+        return f'<EffectivePolicy {self.hash!r}>'
+
+
+class PolicyIndex(db.Model):
+
+    '''
+    The `Action` patterns of the `Allow` statements in each effective policy
+
+    Rows are rewritten along with the effective policy. Finding who could be
+    allowed an action then only needs the rows for its service, and just the
+    users they point at have their policy evaluated.
+    '''
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    # None if the pattern doesn't start with a literal `service:`. Policies
+    # aren't validated, so patterns can be of any length.
+    service = db.Column(db.Text, index=True)
+    action = db.Column(db.Text, nullable=False)
+
+    @classmethod
+    def for_policy(cls, policy):
+        actions = set()
+        for statement in policy.get('Statement', []):
+            if statement.get('Effect') != 'Deny':
+                # Anything that isn't a string can't match an action
+                actions.update(action for action in _get_list(statement, 'Action') if isinstance(action, str))
+        return [cls(service=_get_service(action), action=action) for action in sorted(actions)]
+
+    @classmethod
+    def candidates(cls, action):
+        '''
+        Return the ids of the users with an `Allow` statement that matches `action`
+        '''
+        rows = db.session.query(cls.user_id, cls.action).filter(
+            db.or_(cls.service == _get_service(action), cls.service.is_(None)),
+        )
+        return {user_id for user_id, pattern in rows if _compile_glob(pattern)(action)}
+
+    @classmethod
+    def who_can(cls, action, resource, batch_size=500):
+        '''
+        Return who can do `action` on `resource` as two sorted lists of usernames
+
+        The first is the users that are allowed it, and the second those that
+        are only allowed it under a `Condition`. See `tinyauth.policy.review`.
+        Users whose effective policy hasn't been materialized yet aren't in
+        the index, so they are always checked.
+        '''
+        user_ids = sorted(cls.candidates(action))
+
+        policies = {}
+        for i in range(0, len(user_ids), batch_size):
+            policies.update(EffectivePolicy.by_username(User.id.in_(user_ids[i:i + batch_size]), batch_size=batch_size))
+        policies.update(EffectivePolicy.by_username(EffectivePolicy.user_id.is_(None), batch_size=batch_size))
+
+        allowed = []
+        conditional = []
+        for username in sorted(policies):
+            decision = review(policies[username], action, resource)
+            if decision == 'Allow':
+                allowed.append(username)
+            elif decision == 'Conditional':
+                conditional.append(username)
+
+        return allowed, conditional
+
+    def __repr__(self):
+        return f'<PolicyIndex {self.action!r}>'
+
+
+class Change(db.Model):
+
+    '''
+    A log of identities whose keys or effective policy changed
+
+    Proxies poll this through `GET /api/v1/changes` so that they only have to
+    drop the cache entries that are actually out of date. A row without an
+    access key id is about the user's policies and signing tokens.
+    '''
+
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(128), nullable=False)
+    access_key_id = db.Column(db.String(128))
+    created = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False, index=True)
+
+    @classmethod
+    def record(cls, username, access_key_id=None):
+        db.session.add(cls(username=username, access_key_id=access_key_id))
+
+    @classmethod
+    def head(cls):
+        return db.session.query(db.func.max(cls.id)).scalar() or 0
+
+    def __repr__(self):
+        return f'<Change {self.id} {self.username!r}>'
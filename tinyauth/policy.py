@@ -1,5 +1,8 @@
-import fnmatch
+import bisect
+import collections
+import functools
 import ipaddress
+import re
 
 NOT_PRESENT = object()
 
@@ -35,24 +38,219 @@ def _get_list(dict, key):
     return [retval]
 
 
-def _match_action(statement, action):
-    for statement_action in _get_list(statement, 'Action'):
-        if fnmatch.fnmatch(action, statement_action):
-            return True
+def _is_glob(pattern):
+    return '*' in pattern or '?' in pattern or '[' in pattern
+
+
+_STAR = object()
+
+
+def _parse_bracket_ranges(pattern, i, j):
+    chunks = []
+    k = i + 2 if pattern[i] == '!' else i + 1
+    while True:
+        k = pattern.find('-', k, j)
+        if k < 0:
+            break
+        chunks.append(pattern[i:k])
+        i = k + 1
+        k = k + 3
+    chunk = pattern[i:j]
+    if chunk:
+        chunks.append(chunk)
+    else:
+        chunks[-1] += '-'
+    # Remove empty ranges -- invalid in RE.
+    for k in range(len(chunks) - 1, 0, -1):
+        if chunks[k - 1][-1] > chunks[k][0]:
+            chunks[k - 1] = chunks[k - 1][:-1] + chunks[k][1:]
+            del chunks[k]
+    # Escape backslashes and hyphens for set difference (--).
+    return '-'.join(s.replace('\\', r'\\').replace('-', r'\-') for s in chunks)
+
+
+def _parse_bracket(pattern, i):
+    '''
+    Parse a `[...]` expression starting just after the `[` at `i - 1`
+
+    This follows `fnmatch.translate` exactly. Returns the regex for the
+    character class and the index after the closing `]`, or None if the
+    bracket is never closed (and so is just a literal `[`).
+    '''
+    n = len(pattern)
+    j = i
+    if j < n and pattern[j] == '!':
+        j = j + 1
+    if j < n and pattern[j] == ']':
+        j = j + 1
+    while j < n and pattern[j] != ']':
+        j = j + 1
+    if j >= n:
+        return None
+
+    stuff = pattern[i:j]
+    if '-' not in stuff:
+        stuff = stuff.replace('\\', r'\\')
+    else:
+        stuff = _parse_bracket_ranges(pattern, i, j)
+
+    # Escape set operations (&&, ~~ and ||).
+    stuff = re.sub(r'([&~|])', r'\\\1', stuff)
+
+    if not stuff:
+        regex = '(?!)'
+    elif stuff == '!':
+        regex = '.'
+    elif stuff[0] == '!':
+        regex = '[^' + stuff[1:] + ']'
+    elif stuff[0] in ('^', '['):
+        regex = '[\\' + stuff + ']'
+    else:
+        regex = '[' + stuff + ']'
+
+    return regex, j + 1
+
+
+class _GlobChunk(object):
+
+    '''
+    A run of pattern characters between two `*`
+
+    Every token matches exactly one character, so matching at a position or
+    scanning for the chunk never backtracks.
+    '''
+
+    __slots__ = ('width', 'literal', 'regex')
+
+    def __init__(self, tokens):
+        self.width = len(tokens)
+        if all(literal is not None for literal, _ in tokens):
+            self.literal = ''.join(literal for literal, _ in tokens)
+            self.regex = None
+        else:
+            self.literal = None
+            self.regex = re.compile('(?s:' + ''.join(regex for _, regex in tokens) + ')')
+
+    def match_at(self, value, pos):
+        if self.regex is None:
+            return value.startswith(self.literal, pos)
+        return self.regex.match(value, pos) is not None
+
+    def find(self, value, start, end):
+        if self.regex is None:
+            return value.find(self.literal, start, end)
+        match = self.regex.search(value, start, end)
+        return match.start() if match else -1
+
+
+def _tokenize_glob(pattern):
+    '''
+    Split a glob into `_STAR` and `(literal, regex)` tokens for one character each
+
+    `literal` is None for `?` and `[...]`. Runs of `*` are collapsed.
+    '''
+    tokens = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        i = i + 1
+        if c == '*':
+            if not tokens or tokens[-1] is not _STAR:
+                tokens.append(_STAR)
+        elif c == '?':
+            tokens.append((None, '.'))
+        elif c == '[':
+            bracket = _parse_bracket(pattern, i)
+            if bracket is None:
+                tokens.append((c, re.escape(c)))
+            else:
+                regex, i = bracket
+                tokens.append((None, regex))
+        else:
+            tokens.append((c, re.escape(c)))
 
-    # FIXME: Implement NotAction
+    return tokens
 
-    return False
 
+def _parse_glob(pattern):
+    chunks = [[]]
+    for token in _tokenize_glob(pattern):
+        if token is _STAR:
+            chunks.append([])
+        else:
+            chunks[-1].append(token)
+
+    return [_GlobChunk(chunk) for chunk in chunks]
+
+
+@functools.lru_cache(maxsize=32768)
+def _compile_glob(pattern):
+    '''
+    Compile a glob pattern with the same semantics as `fnmatch.fnmatchcase`
+
+    `fnmatch` builds a backtracking regex, so user supplied patterns like
+    `*a*a*a*a*b` can take super-linear time against a long ARN. Here the
+    pattern is split on `*` into fixed width chunks. The first and last
+    chunk are anchored and every chunk in between is found at its leftmost
+    position, which is always safe for `*`. That is O(n * m) in the worst
+    case for a value of length n and a pattern of length m.
+    '''
+    chunks = _parse_glob(pattern)
+
+    if len(chunks) == 1:
+        chunk = chunks[0]
+
+        def match(value):
+            return len(value) == chunk.width and chunk.match_at(value, 0)
+
+        return match
+
+    head, middle, tail = chunks[0], chunks[1:-1], chunks[-1]
+    min_width = sum(chunk.width for chunk in chunks)
+
+    def match(value):
+        n = len(value)
+        if n < min_width:
+            return False
+
+        end = n - tail.width
+        if not head.match_at(value, 0) or not tail.match_at(value, end):
+            return False
+
+        pos = head.width
+        for chunk in middle:
+            pos = chunk.find(value, pos, end)
+            if pos < 0:
+                return False
+            pos += chunk.width
+
+        return True
+
+    return match
 
-def _match_resource(statement, resource):
-    for statement_resource in _get_list(statement, 'Resource'):
-        if fnmatch.fnmatch(resource, statement_resource):
-            return True
 
-    # FIXME: Implement NotResource
+def _compile_patterns(patterns):
+    '''
+    Turn a list of glob patterns into a single match function
 
-    return False
+    Literal patterns become a set lookup and everything else is translated to
+    a regex once, rather than on every call to `allow`.
+    '''
+    literals = frozenset(p for p in patterns if not _is_glob(p))
+    globs = tuple(_compile_glob(p) for p in patterns if _is_glob(p))
+
+    if not globs:
+        return literals.__contains__
+
+    def match(value):
+        if value in literals:
+            return True
+        for glob in globs:
+            if glob(value):
+                return True
+        return False
+
+    return match
 
 
 _condition_functions = {
@@ -63,48 +261,592 @@ _condition_functions = {
 }
 
 
-def _match_condition(statement, context):
-    # "Condition": {"IpAddress": {"aws:SourceIp": "203.0.113.0/24"}}
-    for condition_check, conditions in statement.get('Condition', {}).items():
-        fn = _condition_functions[condition_check]
-        for condition, value in conditions.items():
+def _get_condition_function(condition_check):
+    try:
+        return _condition_functions[condition_check]
+    except KeyError:
+        pass
+
+    # Unknown operators only fail if the statement is actually evaluated
+    def fn(left, right):
+        raise KeyError(condition_check)
+
+    return fn
+
+
+class CompiledStatement(object):
+
+    def __init__(self, index, statement):
+        self.index = index
+        self._effect = statement.get('Effect', NOT_PRESENT)
+        self.actions = _get_list(statement, 'Action')
+        self.resources = _get_list(statement, 'Resource')
+
+        # FIXME: Implement NotAction and NotResource
+        self.match_action = _compile_patterns(self.actions)
+
+        # "Condition": {"IpAddress": {"aws:SourceIp": "203.0.113.0/24"}}
+        self.conditions = []
+        for condition_check, conditions in statement.get('Condition', {}).items():
+            fn = _get_condition_function(condition_check)
+            for condition, value in conditions.items():
+                self.conditions.append((fn, condition, value))
+
+    @property
+    def effect(self):
+        # Like unknown operators, a missing Effect only fails if the statement is actually evaluated
+        if self._effect is NOT_PRESENT:
+            raise KeyError('Effect')
+        return self._effect
+
+    def match_condition(self, context):
+        for fn, condition, value in self.conditions:
             if not fn(context.get(condition, NOT_PRESENT), value):
                 return False
+        return True
+
+
+def _get_service(pattern):
+    '''
+    Return the literal `svc` part of a `svc:...` pattern, otherwise None
+    '''
+    if ':' not in pattern:
+        return None
+    service = pattern.split(':', 1)[0]
+    if _is_glob(service):
+        return None
+    return service
+
+
+def _append_once(bucket, statement):
+    # Statements are indexed one at a time so duplicates are always adjacent
+    if not bucket or bucket[-1] is not statement:
+        bucket.append(statement)
+
+
+class ActionIndex(object):
+
+    '''
+    Find the statements whose `Action` can match a given action
+
+    Literal actions (`tinyauth:GetUser`), whole service grants (`tinyauth:*`)
+    and `*` are looked up without any matching at all. Other patterns with a
+    literal service (`tinyauth:Get*`) are only tested for actions of that
+    service. Only what is left over is tested for every action.
+    '''
+
+    def __init__(self, statements):
+        self.literal = collections.defaultdict(list)
+        self.service = collections.defaultdict(list)
+        self.service_wildcard = collections.defaultdict(list)
+        self.any = []
+        self.wildcard = []
+
+        for statement in statements:
+            for pattern in statement.actions:
+                if not _is_glob(pattern):
+                    _append_once(self.literal[pattern], statement)
+                    continue
+
+                if pattern == '*':
+                    _append_once(self.any, statement)
+                    continue
+
+                service = _get_service(pattern)
+                if service is None:
+                    _append_once(self.wildcard, statement)
+                elif pattern == service + ':*':
+                    _append_once(self.service[service], statement)
+                else:
+                    _append_once(self.service_wildcard[service], statement)
+
+    def lookup(self, action):
+        '''
+        Return the statements matching `action`, in policy order
+        '''
+        buckets = []
+
+        if self.any:
+            buckets.append(self.any)
+
+        if action in self.literal:
+            buckets.append(self.literal[action])
+
+        if ':' in action:
+            service = action.split(':', 1)[0]
+            if service in self.service:
+                buckets.append(self.service[service])
+            if service in self.service_wildcard:
+                buckets.append([s for s in self.service_wildcard[service] if s.match_action(action)])
+
+        if self.wildcard:
+            buckets.append([s for s in self.wildcard if s.match_action(action)])
+
+        buckets = [bucket for bucket in buckets if bucket]
+
+        if not buckets:
+            return []
+
+        if len(buckets) == 1:
+            return buckets[0]
+
+        matched = {}
+        for bucket in buckets:
+            for statement in bucket:
+                matched[statement.index] = statement
+        return [matched[i] for i in sorted(matched)]
+
+
+_arn_segment = re.compile(r'[^:/]*[:/]|[^:/]+')
+
+
+def _split_arn(value):
+    '''
+    Split an ARN into segments, keeping each separator on its segment
+
+    `arn:tinyauth:tinyauth:::users/charles` becomes `arn:`, `tinyauth:`,
+    `tinyauth:`, `:`, `:`, `users/` and `charles`, so joining the segments
+    gives back the original string.
+    '''
+    return _arn_segment.findall(value)
+
+
+class _ResourceTrieNode(object):
+
+    __slots__ = ('children', 'exact', 'leaves')
+
+    def __init__(self):
+        self.children = {}
+        self.exact = []
+        self.leaves = []
+
+
+class ResourceTrie(object):
+
+    '''
+    Match a resource against many `Resource` patterns at once
+
+    Patterns are stored under their leading literal ARN segments (as produced
+    by `tinyauth.authorize.format_arn`). Only patterns stored on the path a
+    resource walks through have to be glob matched, so the cost is roughly the
+    length of the ARN rather than the number of patterns.
+    '''
+
+    def __init__(self):
+        self.root = _ResourceTrieNode()
+
+    def add(self, pattern, value):
+        node = self.root
+        for segment in _split_arn(pattern):
+            if _is_glob(segment):
+                node.leaves.append((_compile_glob(pattern), value))
+                return
+            node = node.children.setdefault(segment, _ResourceTrieNode())
+        node.exact.append(value)
+
+    def match(self, resource):
+        '''
+        Return the values of every pattern that matches `resource`
+        '''
+        matched = []
+        node = self.root
+
+        for segment in _split_arn(resource):
+            for glob, value in node.leaves:
+                if glob(resource):
+                    matched.append(value)
+
+            node = node.children.get(segment)
+            if node is None:
+                return matched
+
+        for glob, value in node.leaves:
+            if glob(resource):
+                matched.append(value)
+
+        matched.extend(node.exact)
+
+        return matched
+
+
+def _glob_prefix(pattern):
+    '''
+    Return the literal text before the first wildcard in `pattern`
+    '''
+    return re.match(r'[^*?[]*', pattern).group()
+
+
+def _prefix_end(prefix):
+    '''
+    Return the smallest string that sorts after every string starting with `prefix`
+
+    Returns None if there is no such string.
+    '''
+    prefix = prefix.rstrip('\U0010ffff')
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class PatternSet(object):
+
+    '''
+    Match many resources against many `Resource` patterns at once
+
+    `match` returns a bitmask per resource, with bit `i` set if pattern `i`
+    matches it. Rather than trying every pattern on every resource, literal
+    patterns are looked up in a dict and each glob is only tried on the
+    resources that start with its literal prefix, found by bisecting the
+    sorted resources. A glob that is just a prefix and a trailing `*` isn't
+    tried at all. Only globs that start with a wildcard see every resource.
+    '''
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.exact = {}
+        self.prefixed = []
+        self.residual = []
+
+        for i, pattern in enumerate(self.patterns):
+            bit = 1 << i
+
+            if not _is_glob(pattern):
+                self.exact[pattern] = self.exact.get(pattern, 0) | bit
+                continue
+
+            prefix = _glob_prefix(pattern)
+            glob = None if pattern == prefix + '*' else _compile_glob(pattern)
+
+            if prefix:
+                self.prefixed.append((prefix, _prefix_end(prefix), glob, bit))
+            else:
+                self.residual.append((glob, bit))
+
+    def match(self, resources):
+        '''
+        Return a bitmask of the patterns that match each of `resources`
+        '''
+        resources = list(resources)
+        exact = self.exact
+        masks = [exact.get(resource, 0) for resource in resources]
+
+        if self.prefixed:
+            order = sorted(range(len(resources)), key=resources.__getitem__)
+            ordered = [resources[i] for i in order]
+
+            for prefix, end, glob, bit in self.prefixed:
+                lo = bisect.bisect_left(ordered, prefix)
+                hi = len(ordered) if end is None else bisect.bisect_left(ordered, end, lo)
+                for i in range(lo, hi):
+                    if glob is None or glob(ordered[i]):
+                        masks[order[i]] |= bit
+
+        for glob, bit in self.residual:
+            for i, resource in enumerate(resources):
+                if glob is None or glob(resource):
+                    masks[i] |= bit
+
+        return masks
+
+
+class CompiledPolicy(object):
+
+    '''
+    A policy document that has been prepared for repeated evaluation
+
+    Build one of these once per policy and pass it to `allow` or
+    `get_allowed_resources` instead of the raw dictionary.
+    '''
+
+    def __init__(self, policy):
+        self.document = policy
+        self.statements = [CompiledStatement(i, s) for i, s in enumerate(_get_list(policy, 'Statement'))]
+        self.actions = ActionIndex(self.statements)
+
+        self.resources = ResourceTrie()
+        for statement in self.statements:
+            for pattern in statement.resources:
+                self.resources.add(pattern, statement.index)
+
+        self._batch = None
+
+    def batch(self):
+        '''
+        Return a `PatternSet` of every `Resource` pattern and each statement's bits in it
+
+        This is only needed by `allow_matrix`, so it is built on first use.
+        '''
+        if self._batch is None:
+            patterns = sorted({pattern for statement in self.statements for pattern in statement.resources})
+            bits = {pattern: 1 << i for i, pattern in enumerate(patterns)}
+
+            statement_bits = []
+            for statement in self.statements:
+                mask = 0
+                for pattern in statement.resources:
+                    mask |= bits[pattern]
+                statement_bits.append(mask)
+
+            self._batch = PatternSet(patterns), statement_bits
+
+        return self._batch
+
+
+def compile_policy(policy):
+    if isinstance(policy, CompiledPolicy):
+        return policy
+    return CompiledPolicy(policy)
+
+
+@functools.lru_cache(maxsize=32768)
+def _can_match_prefix(pattern, prefix):
+    '''
+    Could `pattern` match any string that starts with `prefix`?
+
+    This errs on the side of yes, as it is used to drop statements that can't
+    apply and dropping a `Deny` by mistake would grant access.
+    '''
+    tokens = _tokenize_glob(pattern)
+
+    for i, c in enumerate(prefix):
+        if i >= len(tokens):
+            return False
+
+        token = tokens[i]
+        if token is _STAR:
+            return True
+
+        literal, regex = token
+        if literal is not None:
+            if literal != c:
+                return False
+        elif not re.fullmatch('(?s:' + regex + ')', c):
+            return False
 
     return True
 
 
+def _can_match_region(pattern, region):
+    # arn:partition:service:region:account:resource - anything we can't
+    # pin down to a literal region field is kept
+    fields = pattern.split(':', 4)
+    if len(fields) < 5 or any(_is_glob(field) for field in fields[:4]):
+        return True
+    return fields[3] in ('', region)
+
+
+def _statement_applies(statement, prefix, region):
+    # NotAction isn't implemented, but statements using it are kept so that
+    # implementing it doesn't also need this to change
+    if 'Action' not in statement:
+        return True
+
+    if not any(_can_match_prefix(pattern, prefix) for pattern in _get_list(statement, 'Action')):
+        return False
+
+    # Only ever drop Allows by region. A Deny on another region's ARN can
+    # still match a cross-region request, and dropping it would grant access.
+    if region is not None and 'Resource' in statement and statement.get('Effect', 'Deny') != 'Deny':
+        return any(_can_match_region(pattern, region) for pattern in _get_list(statement, 'Resource'))
+
+    return True
+
+
+def filter_policy(policy, service, region=None):
+    '''
+    Return a copy of `policy` with only the statements that can apply to `service`
+
+    A statement is kept if any of its `Action` patterns could match a
+    `service:...` action. With `region`, an `Allow` must also have a `Resource`
+    pattern that could match an ARN in that region or with no region at all.
+    Without a service (for actions that have no `service:` prefix) nothing is
+    dropped.
+    '''
+    if not service:
+        return policy
+
+    statements = [s for s in _get_list(policy, 'Statement') if _statement_applies(s, service + ':', region)]
+    return dict(policy, Statement=statements)
+
+
 def get_allowed_resources(policy, action, context=None):
+    policy = compile_policy(policy)
+    context = context or {}
+
     allowed = []
     denied = []
 
-    for statement in _get_list(policy, 'Statement'):
-        if not _match_action(statement, action):
-            continue
-        if not _match_condition(statement, context or {}):
+    for statement in policy.actions.lookup(action):
+        if not statement.match_condition(context):
             continue
 
-        if statement['Effect'] == 'Deny':
-            denied.extend(_get_list(statement, 'Resource'))
+        if statement.effect == 'Deny':
+            denied.extend(statement.resources)
         else:
-            allowed.extend(_get_list(statement, 'Resource'))
+            allowed.extend(statement.resources)
 
     return allowed, denied
 
 
+def filter_resources(policy, action, resources, context=None):
+    '''
+    Return the resources that `allow` would allow `action` on, in order
+
+    The allowed and denied patterns for `action` are collected once and
+    matched against all the resources together with a `PatternSet`, rather
+    than walking the policy for each resource.
+    '''
+    allowed, denied = get_allowed_resources(policy, action, context)
+    if not allowed:
+        return []
+
+    # Allowed patterns get the low bits and denied patterns the rest
+    resources = list(resources)
+    masks = PatternSet(allowed + denied).match(resources)
+    allowed_bits = (1 << len(allowed)) - 1
+    return [r for r, mask in zip(resources, masks) if mask & allowed_bits and not mask >> len(allowed)]
+
+
+def review(policy, action, resource):
+    '''
+    Decide `action` on `resource` without a request context
+
+    This is for asking who could do something, rather than authorizing a
+    request. Conditions aren't evaluated: "Allow" and "Deny" only come from
+    statements without a `Condition`, and "Conditional" means there is an
+    `Allow` that only applies in some contexts.
+    '''
+    policy = compile_policy(policy)
+
+    matched = set(policy.resources.match(resource))
+    statements = [s for s in policy.actions.lookup(action) if s.index in matched]
+
+    if any(s.effect == 'Deny' and not s.conditions for s in statements):
+        return "Deny"
+
+    allowed = [s for s in statements if s.effect != 'Deny']
+    if any(not s.conditions for s in allowed):
+        return "Allow"
+    if allowed:
+        return "Conditional"
+
+    return "Default"
+
+
 def allow(policy, action, resource, context=None):
+    policy = compile_policy(policy)
+    context = context or {}
+
+    statements = policy.actions.lookup(action)
+    if not statements:
+        return "Default"
+
+    matched = set(policy.resources.match(resource))
+    statements = [s for s in statements if s.index in matched]
     retval = "Default"
 
-    for statement in _get_list(policy, 'Statement'):
-        if not _match_action(statement, action):
-            continue
-        if not _match_resource(statement, resource):
+    # Deny always wins, so check those statements first
+    for statement in statements:
+        if statement.effect != 'Deny':
             continue
-        if not _match_condition(statement, context or {}):
+        if not statement.match_condition(context):
             continue
-        if statement['Effect'] == 'Deny':
-            return "Deny"
+        return "Deny"
 
+    for statement in statements:
+        if statement.effect == 'Deny':
+            continue
+        if not statement.match_condition(context):
+            continue
         retval = "Allow"
+        break
 
     return retval
+
+
+def allow_matrix(policy, actions, resources, context=None):
+    '''
+    Return what `allow` would for every pair of `actions` and `resources`
+
+    The result has a row for each action with a decision for each resource.
+    Each resource is matched against the policy's patterns just once, giving
+    a bitmask of the patterns it matches, and each action then only costs a
+    couple of bitwise operations per resource.
+    '''
+    policy = compile_policy(policy)
+    context = context or {}
+
+    pattern_set, statement_bits = policy.batch()
+    masks = pattern_set.match(resources)
+
+    seen = 0
+    for mask in masks:
+        seen |= mask
+
+    rows = []
+    for action in actions:
+        allowed = denied = 0
+
+        for statement in policy.actions.lookup(action):
+            bits = statement_bits[statement.index]
+            # `allow` only checks conditions of statements that match a resource
+            if not bits & seen or not statement.match_condition(context):
+                continue
+            if statement.effect == 'Deny':
+                denied |= bits
+            else:
+                allowed |= bits
+
+        if not allowed and not denied:
+            rows.append(['Default'] * len(masks))
+            continue
+
+        rows.append([
+            'Deny' if mask & denied else 'Allow' if mask & allowed else 'Default'
+            for mask in masks
+        ])
+
+    return rows
+
+
+def review_matrix(policy, actions, resources):
+    '''
+    Return what `review` would for every pair of `actions` and `resources`
+
+    The result is laid out like that of `allow_matrix`.
+    '''
+    policy = compile_policy(policy)
+
+    pattern_set, statement_bits = policy.batch()
+    masks = pattern_set.match(resources)
+
+    seen = 0
+    for mask in masks:
+        seen |= mask
+
+    rows = []
+    for action in actions:
+        allowed = denied = conditional = 0
+
+        for statement in policy.actions.lookup(action):
+            bits = statement_bits[statement.index]
+            # `review` only looks at statements that match a resource
+            if not bits & seen:
+                continue
+            if statement.effect == 'Deny':
+                if not statement.conditions:
+                    denied |= bits
+            elif statement.conditions:
+                conditional |= bits
+            else:
+                allowed |= bits
+
+        rows.append([
+            'Deny' if mask & denied else
+            'Allow' if mask & allowed else
+            'Conditional' if mask & conditional else
+            'Default'
+            for mask in masks
+        ])
+
+    return rows
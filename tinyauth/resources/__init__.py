@@ -1,9 +1,12 @@
 from .access_key import access_key_blueprint
-from .user import user_blueprint
-from .user_policy import user_policy_blueprint
+from .change import change_blueprint
 from .group import group_blueprint
 from .group_policy import group_policy_blueprint
 from .service import service_blueprint
+from .snapshot import snapshot_blueprint
+from .user import user_blueprint
+from .user_policy import user_policy_blueprint
+from .who_can import who_can_blueprint
 
 __all__ = [
     'access_key_blueprint',
@@ -12,4 +15,7 @@ __all__ = [
     'group_blueprint',
     'group_policy_blueprint',
     'service_blueprint',
+    'change_blueprint',
+    'snapshot_blueprint',
+    'who_can_blueprint',
 ]
@@ -7,7 +7,7 @@ from flask_restful import Api, Resource, abort, fields, marshal
 from tinyauth.app import db
 from tinyauth.audit import audit_request_cbv
 from tinyauth.authorize import format_arn, internal_authorize
-from tinyauth.models import AccessKey, User
+from tinyauth.models import AccessKey, Change, User
 from tinyauth.simplerest import build_response_for_request
 
 ACCESS_KEY_ID_LETTERS = string.ascii_uppercase + string.digits
@@ -64,6 +64,7 @@ class AccessKeyResource(Resource):
         access_key = self._get_or_404(user, key_id)
         audit_ctx['request.username'] = access_key.user.username
         db.session.delete(access_key)
+        Change.record(access_key.user.username, access_key.access_key_id)
         db.session.commit()
 
         return make_response(jsonify({}), 201, [])
@@ -103,6 +104,7 @@ class AccessKeysResource(Resource):
         )
 
         db.session.add(access_key)
+        Change.record(user.username, access_key.access_key_id)
         db.session.commit()
 
         audit_ctx['response.access_key_id'] = access_key.access_key_id
@@ -0,0 +1,76 @@
+import datetime
+
+from flask import Blueprint, jsonify, make_response, request
+from flask_restful import abort
+
+from tinyauth.app import db
+from tinyauth.audit import audit_request
+from tinyauth.authorize import format_arn, internal_authorize
+from tinyauth.models import Change
+
+MAX_CHANGES = 1000
+
+# Ids are handed out when a change is inserted but become visible when its
+# transaction commits, so a missing id may still be on its way. The cursor
+# doesn't move past one until it is this old, after which it is assumed to
+# have been rolled back. Proxy cache TTLs bound how stale a change committed
+# later than this can leave a proxy, so keep them short.
+GAP_TIMEOUT = datetime.timedelta(seconds=60)
+
+change_blueprint = Blueprint('change', __name__)
+
+
+@change_blueprint.route('/api/v1/changes', methods=['GET'])
+@audit_request('ListChanges')
+def list_changes(audit_ctx):
+    '''
+    List the identities that changed after the `since` cursor
+
+    Without `since` only the current cursor is returned, which is where a
+    client with empty caches should start from. If changes after `since`
+    have already been pruned `reset` is set, and the client should drop
+    everything it has cached.
+
+    The cursor stops short of ids that may belong to changes that haven't been
+    committed yet, see `GAP_TIMEOUT`.
+    '''
+    internal_authorize('ListChanges', format_arn('changes'))
+
+    try:
+        since = request.args.get('since')
+        since = int(since) if since is not None else None
+        limit = max(1, min(int(request.args.get('limit', MAX_CHANGES)), MAX_CHANGES))
+    except ValueError:
+        abort(make_response(jsonify(message='since and limit must be integers'), 400))
+
+    audit_ctx['request.since'] = since
+
+    head = Change.head()
+
+    if since is None:
+        return jsonify({'cursor': head, 'changes': [], 'reset': False, 'more': False})
+
+    oldest = db.session.query(db.func.min(Change.id)).scalar()
+    if since > head or (oldest is not None and since < oldest - 1):
+        return jsonify({'cursor': head, 'changes': [], 'reset': True, 'more': False})
+
+    changes = Change.query.filter(Change.id > since).order_by(Change.id).limit(limit).all()
+
+    # Changes after a recent gap are returned again by the next poll, which is
+    # harmless as dropping a cache entry twice does no harm
+    cursor = since
+    settled = datetime.datetime.utcnow() - GAP_TIMEOUT
+    for change in changes:
+        if change.id != cursor + 1 and change.created > settled:
+            break
+        cursor = change.id
+
+    return jsonify({
+        'cursor': cursor,
+        'changes': [{
+            'user': change.username,
+            'access-key': change.access_key_id,
+        } for change in changes],
+        'reset': False,
+        'more': len(changes) == limit and cursor == changes[-1].id,
+    })
@@ -5,7 +5,7 @@ from tinyauth.api import Api
 from tinyauth.app import db
 from tinyauth.audit import audit_request, audit_request_cbv
 from tinyauth.authorize import format_arn, internal_authorize
-from tinyauth.models import Group, User
+from tinyauth.models import EffectivePolicy, Group, PolicyVersion, User
 from tinyauth.simplerest import build_response_for_request
 
 group_fields = {
@@ -45,9 +45,14 @@ class GroupResource(Resource):
 
         group = self._get_or_404(group_id)
         audit_ctx['request.group'] = group.name
+
+        if args['name'] != group.name and Group.query.filter(Group.name == args['name']).count():
+            abort(409, message=f'group {args["name"]} already exists')
+
         group.name = args['name']
         db.session.add(group)
 
+        PolicyVersion.bump()
         db.session.commit()
 
         return jsonify(marshal(group, group_fields))
@@ -78,11 +83,15 @@ class GroupsResource(Resource):
         audit_ctx['request.group'] = args['name']
         internal_authorize('CreateGroup', format_arn('groups', args['name']))
 
+        if Group.query.filter(Group.name == args['name']).count():
+            abort(409, message=f'group {args["name"]} already exists')
+
         group = Group(
             name=args['name'],
         )
 
         db.session.add(group)
+        PolicyVersion.bump()
         db.session.commit()
 
         return jsonify(marshal(group, group_fields))
@@ -115,6 +124,8 @@ def add_user_to_group(audit_ctx, group_id):
     group.users.append(user)
     db.session.add(group)
 
+    PolicyVersion.bump()
+    EffectivePolicy.refresh([user.id])
     db.session.commit()
 
     return jsonify({})
@@ -137,6 +148,8 @@ def remove_user_from_group(audit_ctx, group_id, username):
 
     group.users.remove(user)
     db.session.add(group)
+    PolicyVersion.bump()
+    EffectivePolicy.refresh([user.id])
     db.session.commit()
 
     return make_response(jsonify({}), 201, [])
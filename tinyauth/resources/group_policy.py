@@ -6,7 +6,7 @@ from flask_restful import Api, Resource, abort, fields, marshal, reqparse
 from tinyauth.app import db
 from tinyauth.audit import audit_request_cbv
 from tinyauth.authorize import format_arn, internal_authorize
-from tinyauth.models import Group, GroupPolicy
+from tinyauth.models import EffectivePolicy, Group, GroupPolicy, PolicyVersion
 from tinyauth.simplerest import build_response_for_request
 
 
@@ -65,10 +65,16 @@ class GroupPolicyResource(Resource):
         audit_ctx['request.policy-json'] = json.dumps(policy_json, indent=4, separators=(',', ': '))
 
         policy = self._get_or_404(group, policy_name)
+
+        if args['name'] != policy.name and GroupPolicy.query.filter(GroupPolicy.group == group, GroupPolicy.name == args['name']).count():
+            abort(409, message=f'Policy {args["name"]} for group {group} already exists')
+
         policy.name = args['name']
         policy.policy = policy_json
         db.session.add(policy)
 
+        PolicyVersion.bump()
+        EffectivePolicy.refresh_group(group)
         db.session.commit()
 
         return jsonify(marshal(policy, group_policy_fields))
@@ -85,6 +91,8 @@ class GroupPolicyResource(Resource):
 
         policy = self._get_or_404(group, policy_name)
         db.session.delete(policy)
+        PolicyVersion.bump()
+        EffectivePolicy.refresh_group(group)
         db.session.commit()
 
         return make_response(jsonify({}), 201, [])
@@ -123,6 +131,9 @@ class GroupPoliciesResource(Resource):
         if not group:
             abort(404, message=f'Group {group_id} does not exist')
 
+        if GroupPolicy.query.filter(GroupPolicy.group == group, GroupPolicy.name == args['name']).count():
+            abort(409, message=f'Policy {args["name"]} for group {group} already exists')
+
         policy = GroupPolicy(
             group=group,
             name=args['name'],
@@ -130,6 +141,8 @@ class GroupPoliciesResource(Resource):
         )
 
         db.session.add(policy)
+        PolicyVersion.bump()
+        EffectivePolicy.refresh_group(group)
         db.session.commit()
 
         return jsonify(marshal(policy, group_policy_fields))
@@ -1,26 +1,41 @@
 import base64
 import collections
 import datetime
+import hashlib
 import itertools
 import json
 import logging
 import uuid
 
 import jwt
-from flask import Blueprint, abort, current_app, jsonify, make_response
+from flask import (
+    Blueprint,
+    Response,
+    abort,
+    current_app,
+    jsonify,
+    make_response,
+    request,
+    stream_with_context,
+)
 from werkzeug.datastructures import Headers
 
 from .. import const
 from ..audit import audit_request, format_headers_for_audit_log
 from ..authorize import (
     external_authorize,
+    external_authorize_bulk,
     external_authorize_login,
+    external_authorize_many,
+    external_authorizer,
+    external_filter_resources,
     format_arn,
     get_arn_base,
     internal_authorize,
 )
 from ..exceptions import AuthenticationError, NoSuchKey
 from ..models import User
+from ..policy import filter_policy
 from ..reqparse import RequestParser
 
 service_blueprint = Blueprint('service', __name__)
@@ -38,7 +53,75 @@ batch_authorize_parser.add_argument('permit', type=dict, location='json', requir
 batch_authorize_parser.add_argument('headers', type=list, location='json', required=True)
 batch_authorize_parser.add_argument('context', type=dict, location='json', required=True)
 
+filter_resources_parser = RequestParser()
+filter_resources_parser.add_argument('region', type=str, location='json', required=False)
+filter_resources_parser.add_argument('action', type=str, location='json', required=True)
+filter_resources_parser.add_argument('resources', type=list, location='json', required=True)
+filter_resources_parser.add_argument('headers', type=list, location='json', required=True)
+filter_resources_parser.add_argument('context', type=dict, location='json', required=True)
+
+bulk_authorize_parser = RequestParser()
+bulk_authorize_parser.add_argument('region', type=str, location='json', required=False)
+bulk_authorize_parser.add_argument('requests', type=list, location='json', required=True)
+
+identity_bundles_parser = RequestParser()
+identity_bundles_parser.add_argument('protocol', type=str, location='json', required=True)
+identity_bundles_parser.add_argument('date', type=str, location='json', required=True)
+identity_bundles_parser.add_argument('access-keys', type=list, location='json', required=False, default=[])
+identity_bundles_parser.add_argument('users', type=list, location='json', required=False, default=[])
+
 logger = logging.getLogger("tinyauth.audit")
+error_logger = logging.getLogger("tinyauth.service")
+
+SIGNING_TOKEN_EXPIRY = 60 * 60 * 24 * 3
+USER_POLICIES_EXPIRY = 60
+
+MAX_IDENTITY_BUNDLES = 100
+MAX_BULK_AUTHORIZE = 500
+MAX_FILTER_RESOURCES = 50000
+
+
+def _conditional(response, expiry):
+    '''
+    Make a response cacheable for `expiry` seconds, and revalidatable by its ETag
+
+    A client that sends the ETag it already has in `If-None-Match` gets an
+    empty 304 with fresh expiry headers if nothing changed.
+    '''
+    expire_time = datetime.datetime.utcnow() + datetime.timedelta(seconds=expiry)
+    response.headers['Expires'] = expire_time.strftime("%a, %d %b %Y %H:%M:%S GMT")
+    response.headers['Cache-Control'] = f'max-age={expiry}'
+
+    response.set_etag(hashlib.sha256(response.get_data()).hexdigest())
+    return response.make_conditional(request)
+
+
+def _flatten_permit(permit):
+    return [(action, resource) for action, resources in permit.items() for resource in resources]
+
+
+def _permit_result(permits, step_results):
+    '''
+    Group the results for `(action, resource)` pairs the way `authorize-by-token` returns them
+    '''
+    result = {
+       'Permitted': collections.defaultdict(list),
+       'NotPermitted': collections.defaultdict(list),
+       'Authorized': False,
+    }
+
+    for (action, resource), step_result in zip(permits, step_results):
+        grant_set = result['Permitted' if step_result['Authorized'] else 'NotPermitted']
+        grant_set[action].append(resource)
+
+        if not step_result['Authorized']:
+            result['ErrorCode'] = step_result['ErrorCode']
+
+    if len(result['NotPermitted']) == 0 and len(result['Permitted']) > 0:
+        result['Authorized'] = True
+        result['Identity'] = step_result['Identity']
+
+    return result
 
 
 @service_blueprint.route('/api/v1/authorize-login', methods=['POST'])
@@ -103,6 +186,118 @@ def service_authorize(audit_ctx):
     return jsonify(result)
 
 
+def _is_header_list(headers):
+    return isinstance(headers, list) and all(
+        isinstance(header, list) and len(header) == 2 and all(isinstance(part, str) for part in header)
+        for header in headers
+    )
+
+
+def _parse_stream_line(line):
+    '''
+    Parse one line of an authorize stream, raising `ValueError` if it isn't valid
+    '''
+    args = json.loads(line)
+    if not isinstance(args, dict):
+        raise ValueError('Expected an object')
+
+    unexpected = set(args) - {'region', 'action', 'resource', 'headers', 'context'}
+    if unexpected:
+        raise ValueError(f'Unexpected {", ".join(sorted(unexpected))}')
+
+    if not isinstance(args.get('action'), str) or not isinstance(args.get('resource'), str):
+        raise ValueError('action and resource must be strings')
+
+    if not isinstance(args.get('region') or '', str):
+        raise ValueError('region must be a string')
+
+    if not _is_header_list(args.get('headers')):
+        raise ValueError('headers must be a list of [name, value] pairs')
+
+    if not isinstance(args.get('context', {}), dict):
+        raise ValueError('context must be an object')
+
+    return args
+
+
+def _authorize_stream(lines, audit_ctx):
+    authorize = external_authorizer()
+
+    for line in lines:
+        if not line.strip():
+            continue
+
+        audit_ctx['response.count'] += 1
+
+        try:
+            args = _parse_stream_line(line)
+        except ValueError as e:
+            audit_ctx['response.invalid-count'] += 1
+            yield {'Authorized': False, 'ErrorCode': 'InvalidRequest', 'Status': 400, 'Message': str(e)}
+            continue
+
+        # The response has already started, so one bad line mustn't end the stream
+        try:
+            result = authorize(
+                args.get('region') or const.REGION_GLOBAL,
+                args['action'].split(':', 1)[0] if ':' in args['action'] else '',
+                action=args['action'],
+                resource=args['resource'],
+                headers=Headers(args['headers']),
+                context=args.get('context', {}),
+            )
+        except Exception:
+            error_logger.exception('Unable to authorize stream line %d', audit_ctx['response.count'])
+            audit_ctx['response.error-count'] += 1
+            yield {'Authorized': False, 'ErrorCode': 'InternalError', 'Status': 500}
+            continue
+
+        if result['Authorized']:
+            audit_ctx['response.authorized-count'] += 1
+
+        yield result
+
+
+def _ndjson_stream(results, audit_ctx):
+    try:
+        for result in results:
+            yield json.dumps(result) + '\n'
+    finally:
+        # The request was audited when the stream started, so record how it ended
+        logger.info('AuthorizeStreamEnded', extra=audit_ctx)
+
+
+@service_blueprint.route('/api/v1/authorize-stream', methods=['POST'])
+@audit_request('AuthorizeStream')
+def service_authorize_stream(audit_ctx):
+    '''
+    Authorize newline delimited JSON requests, streaming back a result for each
+
+    Every line is a request like the body of `/api/v1/authorize`, and gets a
+    line with the same result back, in order. Lines that can't be parsed get
+    an `InvalidRequest` result, and lines that fail unexpectedly an
+    `InternalError` one. The body is processed a line at a time, and
+    identities and policies are reused between lines from the same caller.
+    '''
+    internal_authorize('Authorize', get_arn_base())
+
+    summary = {
+        'response.count': 0,
+        'response.authorized-count': 0,
+        'response.invalid-count': 0,
+        'response.error-count': 0,
+    }
+    if 'request-id' in audit_ctx:
+        summary['request-id'] = audit_ctx['request-id']
+
+    results = _authorize_stream(request.stream, summary)
+
+    return Response(
+        stream_with_context(_ndjson_stream(results, summary)),
+        mimetype='application/x-ndjson',
+    )
+
+
 @service_blueprint.route('/api/v1/services/<service>/get-token-for-login', methods=['POST'])
 @audit_request('GetTokenForLogin')
 def get_token_for_login(audit_ctx, service):
@@ -188,36 +383,147 @@ def batch_service_authorize(audit_ctx, service):
         'request.context': args['context'],
     })
 
-    result = {
-       'Permitted': collections.defaultdict(list),
-       'NotPermitted': collections.defaultdict(list),
-       'Authorized': False,
-    }
-
-    # FIXME: Refactor this to only need to verify identity once and reuse the extracted policies for multiple verifications
-    for action, resources in args['permit'].items():
-        for resource in resources:
-            step_result = external_authorize(
-                args['region'] or const.REGION_GLOBAL,
-                service,
-                action=':'.join((service, action)),
-                resource=resource,
-                headers=Headers(args['headers']),
-                context=args['context'],
-            )
+    permits = _flatten_permit(args['permit'])
 
-            grant_set = result['Permitted' if step_result['Authorized'] else 'NotPermitted']
-            grant_set[action].append(resource)
+    step_results = external_authorize_many(
+        args['region'] or const.REGION_GLOBAL,
+        service,
+        permits=[(':'.join((service, action)), resource) for action, resource in permits],
+        headers=Headers(args['headers']),
+        context=args['context'],
+    )
 
-            if not step_result['Authorized']:
-                result['ErrorCode'] = step_result['ErrorCode']
+    result = _permit_result(permits, step_results)
 
     audit_ctx['response.permitted'] = json.dumps(dict(result['Permitted']), indent=4, separators=(',', ': '))
     audit_ctx['response.not-permitted'] = json.dumps(dict(result['NotPermitted']), indent=4, separators=(',', ': '))
 
-    if len(result['NotPermitted']) == 0 and len(result['Permitted']) > 0:
-        audit_ctx['response.authorized'] = result['Authorized'] = True
-        audit_ctx['response.identity'] = result['Identity'] = step_result['Identity']
+    if result['Authorized']:
+        audit_ctx['response.authorized'] = True
+        audit_ctx['response.identity'] = result['Identity']
+
+    return jsonify(result)
+
+
+def _parse_bulk_request(i, entry, default_region):
+    def invalid(message):
+        abort(make_response(jsonify(message=f'requests[{i}]: {message}'), 400))
+
+    if not isinstance(entry, dict):
+        invalid('must be an object')
+
+    unexpected = set(entry) - {'region', 'permit', 'headers', 'context'}
+    if unexpected:
+        invalid(f'unexpected {", ".join(sorted(unexpected))}')
+
+    if not isinstance(entry.get('region') or '', str):
+        invalid('region must be a string')
+
+    permit = entry.get('permit')
+    if not isinstance(permit, dict) or not all(
+        isinstance(resources, list) and all(isinstance(resource, str) for resource in resources)
+        for resources in permit.values()
+    ):
+        invalid('permit must map actions to lists of resources')
+
+    if not _is_header_list(entry.get('headers')):
+        invalid('headers must be a list of [name, value] pairs')
+
+    if not isinstance(entry.get('context', {}), dict):
+        invalid('context must be an object')
+
+    return {
+        'region': entry.get('region') or default_region,
+        'permit': permit,
+        'headers': entry['headers'],
+        'context': entry.get('context', {}),
+    }
+
+
+@service_blueprint.route('/api/v1/services/<service>/bulk-authorize-by-token', methods=['POST'])
+@audit_request('BulkAuthorizeByToken')
+def bulk_service_authorize(audit_ctx, service):
+    '''
+    Authorize many independent requests for `service` in one round trip
+
+    Every entry of `requests` has its own `permit`, `headers` and `context`,
+    like a call to `authorize-by-token`, and can override the top level
+    `region`. Results come back in the same order and format. Callers that
+    appear more than once are only identified once.
+    '''
+    audit_ctx['request.service'] = service
+
+    internal_authorize('BatchAuthorizeByToken', format_arn('services', service))
+
+    args = bulk_authorize_parser.parse_args()
+
+    if len(args['requests']) > MAX_BULK_AUTHORIZE:
+        abort(make_response(jsonify(message=f'No more than {MAX_BULK_AUTHORIZE} requests per bulk request'), 400))
+
+    default_region = args['region'] or const.REGION_GLOBAL
+    requests = [_parse_bulk_request(i, r, default_region) for i, r in enumerate(args['requests'])]
+    permits = [_flatten_permit(r['permit']) for r in requests]
+
+    step_results = external_authorize_bulk(service, [{
+        'region': r['region'],
+        'permits': [(':'.join((service, action)), resource) for action, resource in p],
+        'headers': Headers(r['headers']),
+        'context': r['context'],
+    } for r, p in zip(requests, permits)])
+
+    results = [_permit_result(p, steps) for p, steps in zip(permits, step_results)]
+
+    audit_ctx.update({
+        'request.region': default_region,
+        'request.count': len(requests),
+        'response.authorized-count': sum(1 for result in results if result['Authorized']),
+        'response.identities': sorted({result['Identity'] for result in results if result['Authorized']}),
+    })
+
+    return jsonify({'Results': results})
+
+
+@service_blueprint.route('/api/v1/services/<service>/filter-resources-by-token', methods=['POST'])
+@audit_request('FilterResourcesByToken')
+def filter_resources_by_token(audit_ctx, service):
+    '''
+    Return the subset of `resources` that the caller may perform `action` on
+
+    For listing pages, where checking every item with `authorize-by-token`
+    would be too slow. The policy is only walked once per request.
+    '''
+    audit_ctx['request.service'] = service
+
+    internal_authorize('BatchAuthorizeByToken', format_arn('services', service))
+
+    args = filter_resources_parser.parse_args()
+
+    if len(args['resources']) > MAX_FILTER_RESOURCES:
+        abort(make_response(jsonify(message=f'No more than {MAX_FILTER_RESOURCES} resources per request'), 400))
+
+    if not all(isinstance(resource, str) for resource in args['resources']):
+        abort(make_response(jsonify(message='resources must be a list of strings'), 400))
+
+    audit_ctx.update({
+        'request.region': args['region'] or const.REGION_GLOBAL,
+        'request.actions': [':'.join((service, args['action']))],
+        'request.resource-count': len(args['resources']),
+        'request.headers': format_headers_for_audit_log(args['headers']),
+        'request.context': args['context'],
+    })
+
+    result = external_filter_resources(
+        args['region'] or const.REGION_GLOBAL,
+        service,
+        action=':'.join((service, args['action'])),
+        resources=args['resources'],
+        headers=Headers(args['headers']),
+        context=args['context'],
+    )
+
+    audit_ctx['response.allowed-count'] = len(result['Allowed'])
+    if 'Identity' in result:
+        audit_ctx['response.identity'] = result['Identity']
 
     return jsonify(result)
 
@@ -249,12 +555,7 @@ def get_service_user_signing_token(audit_ctx, region, service, user, protocol, d
         'identity': secret['identity'],
     })
 
-    expiry = 60 * 60 * 24 * 3
-    expire_time = datetime.datetime.utcnow() + datetime.timedelta(seconds=expiry)
-    response.headers['Expires'] = expire_time.strftime("%a, %d %b %Y %H:%M:%S GMT")
-    response.headers['Cache-Control'] = f'max-age={expiry}'
-
-    return response
+    return _conditional(response, SIGNING_TOKEN_EXPIRY)
 
 
 @service_blueprint.route('/api/v1/regions/<region>/services/<service>/access-key-signing-tokens/<access_key>/<protocol>/<date>', methods=['GET'])
@@ -284,12 +585,7 @@ def get_service_accessKey_signing_token(audit_ctx, region, service, access_key,
         'identity': secret['identity'],
     })
 
-    expiry = 60 * 60 * 24 * 3
-    expire_time = datetime.datetime.utcnow() + datetime.timedelta(seconds=expiry)
-    response.headers['Expires'] = expire_time.strftime("%a, %d %b %Y %H:%M:%S GMT")
-    response.headers['Cache-Control'] = f'max-age={expiry}'
-
-    return response
+    return _conditional(response, SIGNING_TOKEN_EXPIRY)
 
 
 @service_blueprint.route('/api/v1/regions/<region>/services/<service>/user-policies/<user>', methods=['GET'])
@@ -301,15 +597,110 @@ def get_service_user_policies(audit_ctx, region, service, user):
 
     internal_authorize('GetServiceUserPolicies', format_arn('services', service))
 
-    # FIXME: Return a filtered subset of the policies
+    # Only Allows on ARNs for this region (or no region) are kept if the caller asks
+    region_scoped = request.args.get('region-scoped', 'false').lower() in ('true', 'yes')
+    if region_scoped:
+        audit_ctx['request.region-scoped'] = True
+
     try:
         policies = current_app.auth_backend.get_policies(region, service, user)
     except NoSuchKey:
         abort(make_response(jsonify(message='No such key'), 404))
 
-    response = jsonify(policies)
+    policies = filter_policy(policies, service, region if region_scoped else None)
+
+    return _conditional(jsonify(policies), USER_POLICIES_EXPIRY)
+
+
+def _identity_bundle(region, service, get_key):
+    try:
+        secret = get_key()
+        policy = current_app.auth_backend.get_policies(region, service, secret['identity'])
+    except NoSuchKey:
+        return None
+
+    return {
+        'key': base64.b64encode(secret['key']).decode('utf-8'),
+        'identity': secret['identity'],
+        'policy': filter_policy(policy, service),
+    }
+
+
+def _check_identities(args):
+    for kind in ('access-keys', 'users'):
+        for i, identity in enumerate(args[kind]):
+            if not isinstance(identity, str):
+                abort(make_response(jsonify(message=f'{kind}[{i}]: must be a string'), 400))
+
+
+@service_blueprint.route('/api/v1/regions/<region>/services/<service>/identity-bundles', methods=['POST'])
+@audit_request('GetServiceIdentityBundles')
+def get_service_identity_bundles(audit_ctx, region, service):
+    '''
+    Return the signing key, identity and policies for many identities at once
+
+    This lets a proxy fill all of its caches in a single round trip. Identities
+    that don't exist are returned as `null`.
+    '''
+    audit_ctx['request.region'] = region
+    audit_ctx['request.service'] = service
+
+    args = identity_bundles_parser.parse_args()
+
+    audit_ctx['request.protocol'] = args['protocol']
+    audit_ctx['request.date'] = args['date']
+    audit_ctx['request.access-keys'] = args['access-keys']
+    audit_ctx['request.users'] = args['users']
+
+    # Only grant what the individual endpoints would have
+    if args['access-keys']:
+        internal_authorize('GetServiceAccessKeySigningToken', format_arn('services', service))
+    if args['users']:
+        internal_authorize('GetServiceUserSigningToken', format_arn('services', service))
+    internal_authorize('GetServiceUserPolicies', format_arn('services', service))
+
+    if len(args['access-keys']) + len(args['users']) > MAX_IDENTITY_BUNDLES:
+        abort(make_response(jsonify(message=f'No more than {MAX_IDENTITY_BUNDLES} identities per request'), 400))
+
+    _check_identities(args)
+
+    if args['protocol'] not in ('basic-auth', 'jwt'):
+        abort(make_response(jsonify(message=f'Unknown protocol {args["protocol"]}'), 400))
+
+    if args['users'] and args['protocol'] != 'jwt':
+        abort(make_response(jsonify(message='User signing tokens are only available for jwt'), 400))
+
+    try:
+        date = datetime.datetime.strptime(args['date'], '%Y%m%d').date()
+    except ValueError:
+        abort(make_response(jsonify(message=f'Invalid date {args["date"]}'), 400))
+
+    backend = current_app.auth_backend
+
+    access_keys = {}
+    for access_key in args['access-keys']:
+        access_keys[access_key] = _identity_bundle(
+            region,
+            service,
+            lambda: backend.get_access_key(args['protocol'], region, service, date, access_key),
+        )
+
+    users = {}
+    for user in args['users']:
+        users[user] = _identity_bundle(
+            region,
+            service,
+            lambda: backend.get_user_key(args['protocol'], region, service, date, user),
+        )
+
+    response = jsonify({
+        'access-keys': access_keys,
+        'users': users,
+        'key-max-age': SIGNING_TOKEN_EXPIRY,
+        'policy-max-age': USER_POLICIES_EXPIRY,
+    })
 
-    expiry = 60
+    expiry = USER_POLICIES_EXPIRY
     expire_time = datetime.datetime.utcnow() + datetime.timedelta(seconds=expiry)
     response.headers['Expires'] = expire_time.strftime("%a, %d %b %Y %H:%M:%S GMT")
     response.headers['Cache-Control'] = f'max-age={expiry}'
@@ -0,0 +1,42 @@
+from flask import Blueprint, current_app, jsonify, make_response, request
+from flask_restful import abort
+
+from tinyauth import snapshot
+from tinyauth.audit import audit_request
+from tinyauth.authorize import format_arn, internal_authorize
+
+snapshot_blueprint = Blueprint('snapshot', __name__)
+
+
+@snapshot_blueprint.route('/api/v1/regions/<region>/services/<service>/snapshot', methods=['GET'])
+@audit_request('GetServiceSnapshot')
+def get_service_snapshot(audit_ctx, region, service):
+    '''
+    Export everything an offline proxy needs for `service` in `region`
+
+    The `start` and `end` dates (`YYYYMMDD`, both included) pick which days of
+    signing keys are exported.
+    '''
+    audit_ctx['request.region'] = region
+    audit_ctx['request.service'] = service
+
+    # Only grant what the individual endpoints would have
+    internal_authorize('GetServiceAccessKeySigningToken', format_arn('services', service))
+    internal_authorize('GetServiceUserSigningToken', format_arn('services', service))
+    internal_authorize('GetServiceUserPolicies', format_arn('services', service))
+
+    try:
+        dates = snapshot.date_range(request.args.get('start'), request.args.get('end'))
+    except ValueError as e:
+        abort(make_response(jsonify(message=str(e)), 400))
+
+    audit_ctx['request.start'] = dates[0].strftime('%Y%m%d')
+    audit_ctx['request.end'] = dates[-1].strftime('%Y%m%d')
+
+    body = snapshot.build(region, service, dates, current_app.config['SECRET_SIGNING_KEY'])
+
+    response = make_response(snapshot.dumps(body))
+    response.headers['Content-Type'] = 'application/octet-stream'
+    response.headers['Cache-Control'] = 'no-store'
+
+    return response
@@ -5,7 +5,7 @@ from tinyauth.api import Api
 from tinyauth.app import db
 from tinyauth.audit import audit_request_cbv
 from tinyauth.authorize import format_arn, internal_authorize
-from tinyauth.models import User
+from tinyauth.models import Change, PolicyVersion, User
 from tinyauth.simplerest import build_response_for_request
 
 user_fields = {
@@ -54,12 +54,24 @@ class UserResource(Resource):
 
         user = self._get_or_404(username)
 
+        if args['username'] != user.username and User.query.filter(User.username == args['username']).count():
+            abort(409, message=f'user {args["username"]} already exists')
+
+        if args['username'] != user.username:
+            # Anything cached under either name is now wrong, including which
+            # user the access keys belong to
+            Change.record(user.username)
+            Change.record(args['username'])
+            for access_key in user.access_keys:
+                Change.record(args['username'], access_key.access_key_id)
+
         if 'username' in args:
             user.username = args['username']
         if 'password' in args:
             user.set_password(args['password'])
         db.session.add(user)
 
+        PolicyVersion.bump()
         db.session.commit()
 
         return jsonify(marshal(user, user_fields))
@@ -91,6 +103,9 @@ class UsersResource(Resource):
 
         internal_authorize('CreateUser', format_arn('users', args['username']))
 
+        if User.query.filter(User.username == args['username']).count():
+            abort(409, message=f'user {args["username"]} already exists')
+
         user = User(
             username=args['username'],
         )
@@ -99,6 +114,8 @@ class UsersResource(Resource):
             audit_ctx['request.password'] = '********'
 
         db.session.add(user)
+        Change.record(user.username)
+        PolicyVersion.bump()
         db.session.commit()
 
         return jsonify(marshal(user, user_fields))
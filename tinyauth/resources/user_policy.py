@@ -6,7 +6,7 @@ from flask_restful import Api, Resource, abort, fields, marshal, reqparse
 from tinyauth.app import db
 from tinyauth.audit import audit_request_cbv
 from tinyauth.authorize import format_arn, internal_authorize
-from tinyauth.models import User, UserPolicy
+from tinyauth.models import EffectivePolicy, PolicyVersion, User, UserPolicy
 from tinyauth.simplerest import build_response_for_request
 
 
@@ -66,10 +66,16 @@ class UserPolicyResource(Resource):
         audit_ctx['request.policy-json'] = json.dumps(policy_json, indent=4, separators=(',', ': '))
 
         policy = self._get_or_404(user, policy_name)
+
+        if args['name'] != policy.name and UserPolicy.query.filter(UserPolicy.user == user, UserPolicy.name == args['name']).count():
+            abort(409, message=f'Policy {args["name"]} for user {user} already exists')
+
         policy.name = args['name']
         policy.policy = policy_json
         db.session.add(policy)
 
+        PolicyVersion.bump()
+        EffectivePolicy.refresh([user.id])
         db.session.commit()
 
         return jsonify(marshal(policy, user_policy_fields))
@@ -86,6 +92,8 @@ class UserPolicyResource(Resource):
 
         policy = self._get_or_404(user, policy_name)
         db.session.delete(policy)
+        PolicyVersion.bump()
+        EffectivePolicy.refresh([user.id])
         db.session.commit()
 
         return make_response(jsonify({}), 201, [])
@@ -123,6 +131,9 @@ class UserPoliciesResource(Resource):
         if not user:
             abort(404, message=f'User doesn\'t exist')
 
+        if UserPolicy.query.filter(UserPolicy.user == user, UserPolicy.name == args['name']).count():
+            abort(409, message=f'Policy {args["name"]} for user {user} already exists')
+
         policy = UserPolicy(
             user=user,
             name=args['name'],
@@ -130,6 +141,8 @@ class UserPoliciesResource(Resource):
         )
 
         db.session.add(policy)
+        PolicyVersion.bump()
+        EffectivePolicy.refresh([user.id])
         db.session.commit()
 
         return jsonify(marshal(policy, user_policy_fields))
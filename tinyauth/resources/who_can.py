@@ -0,0 +1,38 @@
+from flask import Blueprint, jsonify, make_response, request
+from flask_restful import abort
+
+from tinyauth.audit import audit_request
+from tinyauth.authorize import format_arn, internal_authorize
+from tinyauth.models import PolicyIndex
+
+who_can_blueprint = Blueprint('who_can', __name__)
+
+
+@who_can_blueprint.route('/api/v1/who-can', methods=['GET'])
+@audit_request('ListUsersForAction')
+def list_users_for_action(audit_ctx):
+    '''
+    List the users that can do `action` on `resource`
+
+    Users that are only allowed it under a `Condition` are listed
+    separately, as whether they are allowed depends on the request.
+    '''
+    internal_authorize('ListUsersForAction', format_arn('users'))
+
+    action = request.args.get('action')
+    resource = request.args.get('resource')
+    if not action or not resource:
+        abort(make_response(jsonify(message='action and resource are required'), 400))
+
+    audit_ctx['request.action'] = action
+    audit_ctx['request.resource'] = resource
+
+    allowed, conditional = PolicyIndex.who_can(action, resource)
+
+    audit_ctx['response.count'] = len(allowed)
+    audit_ctx['response.conditional-count'] = len(conditional)
+
+    return jsonify({
+        'Users': allowed,
+        'ConditionalUsers': conditional,
+    })
@@ -0,0 +1,112 @@
+import base64
+import datetime
+import gzip
+import hashlib
+import json
+
+from .models import AccessKey, EffectivePolicy, User, db
+from .subkey import make_basic_auth_key, make_jwt_key
+
+MAGIC = b'TINYAUTH-SNAPSHOT 1\n'
+
+# A snapshot holds every key for every day it covers, so keep ranges short
+MAX_SNAPSHOT_DAYS = 31
+DEFAULT_SNAPSHOT_DAYS = 7
+
+
+class InvalidSnapshot(Exception):
+    pass
+
+
+def date_range(start=None, end=None):
+    '''
+    Parse a `YYYYMMDD` range into a list of dates, both ends included
+
+    `start` defaults to today, and `end` to `DEFAULT_SNAPSHOT_DAYS` later.
+    Raises `ValueError` for dates that don't parse and ranges that are empty or
+    longer than `MAX_SNAPSHOT_DAYS`.
+    '''
+    if start:
+        start = datetime.datetime.strptime(start, '%Y%m%d').date()
+    else:
+        start = datetime.datetime.utcnow().date()
+
+    if end:
+        end = datetime.datetime.strptime(end, '%Y%m%d').date()
+    else:
+        end = start + datetime.timedelta(days=DEFAULT_SNAPSHOT_DAYS - 1)
+
+    days = (end - start).days + 1
+    if days < 1 or days > MAX_SNAPSHOT_DAYS:
+        raise ValueError(f'A snapshot must cover between 1 and {MAX_SNAPSHOT_DAYS} days')
+
+    return [start + datetime.timedelta(days=i) for i in range(days)]
+
+
+def _key(make_key, region, service, date, identity, secret):
+    return base64.b64encode(make_key(region, service, date, identity, secret)).decode('utf-8')
+
+
+def build(region, service, dates, signing_key):
+    '''
+    Collect everything a proxy needs to answer for `region` and `service` on `dates`
+
+    That is every user's effective policy, and the day-scoped signing keys of
+    every user and access key.
+    '''
+    days = [date.strftime('%Y%m%d') for date in dates]
+    policies = EffectivePolicy.by_username()
+
+    users = {}
+    for username in policies:
+        users[username] = {
+            'jwt': {day: _key(make_jwt_key, region, service, date, username, signing_key) for day, date in zip(days, dates)},
+        }
+
+    access_keys = {}
+    rows = db.session.query(AccessKey.access_key_id, AccessKey.secret_access_key, User.username).join(User)
+    for access_key_id, secret_access_key, username in rows:
+        access_keys[access_key_id] = {
+            'identity': username,
+            'basic-auth': {
+                day: _key(make_basic_auth_key, region, service, date, access_key_id, secret_access_key) for day, date in zip(days, dates)
+            },
+            'jwt': {
+                day: _key(make_jwt_key, region, service, date, access_key_id, secret_access_key) for day, date in zip(days, dates)
+            },
+        }
+
+    return {
+        'region': region,
+        'service': service,
+        'dates': days,
+        'created': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'policies': policies,
+        'users': users,
+        'access-keys': access_keys,
+    }
+
+
+def dumps(snapshot):
+    '''
+    Serialize a snapshot as a header, the SHA-256 of the payload and the gzipped payload
+
+    The SHA-256 only detects a corrupt or truncated file. It is not a signature,
+    so snapshots must be kept where only tinyauth can write or read them.
+    '''
+    payload = gzip.compress(json.dumps(snapshot, separators=(',', ':'), sort_keys=True).encode('utf-8'))
+    return MAGIC + hashlib.sha256(payload).hexdigest().encode('ascii') + b'\n' + payload
+
+
+def loads(data):
+    if not data.startswith(MAGIC):
+        raise InvalidSnapshot('Not a tinyauth snapshot')
+
+    digest, _, payload = data[len(MAGIC):].partition(b'\n')
+    if hashlib.sha256(payload).hexdigest().encode('ascii') != digest:
+        raise InvalidSnapshot('Snapshot is corrupt, its checksum does not match')
+
+    try:
+        return json.loads(gzip.decompress(payload).decode('utf-8'))
+    except (OSError, EOFError, ValueError) as e:
+        raise InvalidSnapshot(f'Unable to decode snapshot: {e}')
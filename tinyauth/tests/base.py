@@ -169,4 +169,25 @@ class TestProxyMixin(object):
                 response.json.return_value = json.loads(r.get_data(as_text=True))
                 return response
 
+        def session_post(url, headers, auth, verify, **kwargs):
+            with self.backend.app_context():
+                with self.backend.test_client() as client:
+                    r = client.post(
+                        url,
+                        headers={
+                            'Authorization': 'Basic {}'.format(
+                                base64.b64encode(b'AKIDEXAMPLE:password').decode('utf-8')
+                            )
+                        },
+                        content_type='application/json',
+                        data=json.dumps(kwargs['json']),
+                    )
+
+                response = mock.Mock()
+                response.headers = dict(r.headers)
+                response.status_code = r.status_code
+                response.json.return_value = json.loads(r.get_data(as_text=True))
+                return response
+
         self.session.get.side_effect = session_get
+        self.session.post.side_effect = session_post
@@ -0,0 +1,100 @@
+import io
+import json
+
+from tinyauth import access_review
+from tinyauth.app import db
+from tinyauth.models import (
+    EffectivePolicy,
+    Group,
+    GroupPolicy,
+    User,
+    hash_policy,
+)
+
+from . import base
+
+
+class TestCase(base.TestCase):
+
+    actions = ['tinyauth:DeleteUser', 'myservice:LaunchRocket']
+    resources = ['arn:tinyauth:tinyauth:::users/*', 'arn:tinyauth:myservice:::rockets/thrift']
+
+    def setUp(self):
+        super().setUp()
+
+        group = Group(name='launchers', users=[self.user2])
+        db.session.add(group)
+        db.session.add(GroupPolicy(name='launch', group=group, policy={
+            'Statement': [{
+                'Action': 'myservice:Launch*',
+                'Resource': 'arn:tinyauth:myservice:::rockets/*',
+                'Effect': 'Allow',
+                'Condition': {'IpAddress': {'SourceIp': '10.0.0.0/8'}},
+            }],
+        }))
+        db.session.add(User(username='nobody'))
+        db.session.flush()
+
+        # Charles and nobody are left to be merged on the fly
+        EffectivePolicy.refresh([self.user2.id])
+        db.session.commit()
+
+    def test_iter_policies(self):
+        batches = list(access_review.iter_policies(batch_size=2))
+        assert [[username for username, digest, policy in batch] for batch in batches] == [['charles', 'freddy'], ['nobody']]
+        assert batches[0][0][2]['Statement'][0]['Action'] == 'tinyauth:*'
+        assert batches[1][0][1:] == (hash_policy({'Statement': []}), {'Statement': []})
+
+    def test_ndjson(self):
+        output = io.StringIO()
+        assert access_review.run(output, self.actions, self.resources, processes=1) == (3, 3)
+
+        assert [json.loads(line) for line in output.getvalue().splitlines()] == [{
+            'user': 'charles',
+            'action': 'tinyauth:DeleteUser',
+            'resource': 'arn:tinyauth:tinyauth:::users/*',
+            'decision': 'Allow',
+        }, {
+            'user': 'charles',
+            'action': 'tinyauth:DeleteUser',
+            'resource': 'arn:tinyauth:myservice:::rockets/thrift',
+            'decision': 'Allow',
+        }, {
+            'user': 'freddy',
+            'action': 'myservice:LaunchRocket',
+            'resource': 'arn:tinyauth:myservice:::rockets/thrift',
+            'decision': 'Conditional',
+        }]
+
+    def test_csv(self):
+        output = io.StringIO()
+        access_review.run(output, self.actions, self.resources, output_format='csv', processes=1)
+
+        assert output.getvalue() == (
+            'user,action,resource,decision\n'
+            'charles,tinyauth:DeleteUser,arn:tinyauth:tinyauth:::users/*,Allow\n'
+            'charles,tinyauth:DeleteUser,arn:tinyauth:myservice:::rockets/thrift,Allow\n'
+            'freddy,myservice:LaunchRocket,arn:tinyauth:myservice:::rockets/thrift,Conditional\n'
+        )
+
+    def test_same_policy_reviewed_once(self):
+        db.session.add(User(username='gina'))
+        db.session.flush()
+        EffectivePolicy.refresh([user.id for user in User.query])
+        db.session.commit()
+
+        review_matrix = self.patch_object(access_review, 'review_matrix', wraps=access_review.review_matrix)
+
+        output = io.StringIO()
+        assert access_review.run(output, self.actions, self.resources, processes=1, batch_size=1) == (4, 3)
+
+        # gina and nobody have the same empty policy, in different batches
+        assert review_matrix.call_count == 3
+
+    def test_pool(self):
+        expected = io.StringIO()
+        access_review.run(expected, self.actions, self.resources, processes=1)
+
+        output = io.StringIO()
+        assert access_review.run(output, self.actions, self.resources, processes=2, batch_size=1) == (3, 3)
+        assert output.getvalue() == expected.getvalue()
@@ -1,9 +1,22 @@
+import datetime
 import os
+import tempfile
 from unittest import mock
 
-from tinyauth.app import createdevuser
+from tinyauth import snapshot
+from tinyauth.app import (
+    access_review,
+    createdevuser,
+    db,
+    export_snapshot,
+    prune_changes,
+    rebuild_effective_policies,
+    who_can,
+)
 from tinyauth.backends.proxy import Backend
-from tinyauth.models import AccessKey, User
+from tinyauth.backends.snapshot import Backend as SnapshotBackend
+from tinyauth.models import AccessKey, Change, EffectivePolicy, User
+from tinyauth.utils.store import SqliteStore
 
 from .base import BaseTestCase, TestCase
 
@@ -22,6 +35,43 @@ class TestApp(TestCase):
         assert User.query.filter(User.username == 'root').count() == 1
         assert AccessKey.query.filter(AccessKey.access_key_id == 'gatekeeper').count() == 1
 
+    def test_rebuild_effective_policies(self):
+        os.environ['FLASK_APP'] = os.path.join(os.path.dirname(__file__), '..', 'wsgi.py')
+        try:
+            rebuild_effective_policies([])
+        except SystemExit as e:
+            assert e.code == 0
+        else:
+            raise RuntimeError('Did not raise SystemExit')
+
+        charles = User.query.filter(User.username == 'charles').one()
+        assert charles.effective_policy.policy == {
+            'Statement': [{
+                'Action': 'tinyauth:*',
+                'Resource': 'arn:tinyauth:*',
+                'Effect': 'Allow',
+            }]
+        }
+
+        freddy = User.query.filter(User.username == 'freddy').one()
+        assert freddy.effective_policy.policy == {'Statement': []}
+
+        assert EffectivePolicy.query.count() == 2
+        assert [row.action for row in charles.policy_index] == ['tinyauth:*']
+
+    def test_who_can(self):
+        echo = self.patch('click.echo')
+
+        os.environ['FLASK_APP'] = os.path.join(os.path.dirname(__file__), '..', 'wsgi.py')
+        try:
+            who_can(['tinyauth:DeleteUser', 'arn:tinyauth:tinyauth:::users/freddy'])
+        except SystemExit as e:
+            assert e.code == 0
+        else:
+            raise RuntimeError('Did not raise SystemExit')
+
+        echo.assert_called_once_with('charles')
+
 
 class TestProxyMode(BaseTestCase):
 
@@ -37,3 +87,138 @@ class TestProxyMode(BaseTestCase):
 
     def test_configure_worked(self):
         assert isinstance(self.app.auth_backend, Backend)
+        assert self.app.auth_backend.store is None
+
+        # Expired entries are swept rather than kept until they are evicted
+        assert Backend.get_policies.cache.max_stale == self.app.config['TINYAUTH_CACHE_MAX_STALE'] == 60 * 60
+
+
+class TestProxyModeWithStore(BaseTestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+
+        environ = {
+            'TINYAUTH_AUTH_MODE': 'proxy',
+            'TINYAUTH_ENDPOINT': 'http://localhost',
+            'TINYAUTH_ACCESS_KEY_ID': 'access-key',
+            'TINYAUTH_SECRET_ACCESS_KEY': 'secret-key',
+            'TINYAUTH_CACHE_PATH': os.path.join(tmp.name, 'cache.db'),
+        }
+        with mock.patch.dict(os.environ, environ):
+            super().setUp()
+
+    def test_configure_worked(self):
+        assert isinstance(self.app.auth_backend.store, SqliteStore)
+        assert self.app.auth_backend.store.path == self.app.config['TINYAUTH_CACHE_PATH']
+
+
+class TestProxyModeUnusableCache(BaseTestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+
+        environ = {
+            'TINYAUTH_AUTH_MODE': 'proxy',
+            'TINYAUTH_ENDPOINT': 'http://localhost',
+            'TINYAUTH_ACCESS_KEY_ID': 'access-key',
+            'TINYAUTH_SECRET_ACCESS_KEY': 'secret-key',
+            'TINYAUTH_CACHE_PATH': os.path.join(tmp.name, 'missing', 'cache.db'),
+        }
+        with mock.patch.dict(os.environ, environ):
+            super().setUp()
+
+    def test_runs_without_store(self):
+        assert self.app.auth_backend.store is None
+
+
+class TestSnapshotMode(BaseTestCase):
+
+    def setUp(self):
+        environ = {
+            'TINYAUTH_AUTH_MODE': 'snapshot',
+            'TINYAUTH_SNAPSHOT_PATH': os.pathsep.join(('/srv/a.snapshot', '/srv/b.snapshot')),
+        }
+        with mock.patch.dict(os.environ, environ):
+            super().setUp()
+
+    def test_configure_worked(self):
+        assert isinstance(self.app.auth_backend, SnapshotBackend)
+        assert [f.path for f in self.app.auth_backend.files] == ['/srv/a.snapshot', '/srv/b.snapshot']
+
+
+class TestAccessReview(TestCase):
+
+    def test_access_review(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'review.csv')
+
+        os.environ['FLASK_APP'] = os.path.join(os.path.dirname(__file__), '..', 'wsgi.py')
+        try:
+            access_review([
+                '--action', 'tinyauth:DeleteUser',
+                '--action', 'tinyauth:CreateUser',
+                '--resource', 'arn:tinyauth:tinyauth:::users/*',
+                '--format', 'csv',
+                '--processes', '1',
+                path,
+            ])
+        except SystemExit as e:
+            assert e.code == 0
+        else:
+            raise RuntimeError('Did not raise SystemExit')
+
+        with open(path) as fp:
+            assert fp.read() == (
+                'user,action,resource,decision\n'
+                'charles,tinyauth:DeleteUser,arn:tinyauth:tinyauth:::users/*,Allow\n'
+                'charles,tinyauth:CreateUser,arn:tinyauth:tinyauth:::users/*,Allow\n'
+            )
+
+
+class TestPruneChanges(TestCase):
+
+    def test_prune_changes(self):
+        for i in range(3):
+            Change.record(f'user{i}')
+        db.session.commit()
+
+        Change.query.update({'created': datetime.datetime.utcnow() - datetime.timedelta(days=30)})
+        db.session.commit()
+
+        os.environ['FLASK_APP'] = os.path.join(os.path.dirname(__file__), '..', 'wsgi.py')
+        try:
+            prune_changes(['--days', '7'])
+        except SystemExit as e:
+            assert e.code == 0
+        else:
+            raise RuntimeError('Did not raise SystemExit')
+
+        # The newest change is kept even though it is old, so the cursor survives
+        assert [change.id for change in Change.query.all()] == [3]
+
+
+class TestExportSnapshot(TestCase):
+
+    def test_export_snapshot(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'snapshot')
+
+        os.environ['FLASK_APP'] = os.path.join(os.path.dirname(__file__), '..', 'wsgi.py')
+        try:
+            export_snapshot(['--region', 'europe', '--service', 'myservice', '--start', '20170101', '--end', '20170102', path])
+        except SystemExit as e:
+            assert e.code == 0
+        else:
+            raise RuntimeError('Did not raise SystemExit')
+
+        with open(path, 'rb') as fp:
+            body = snapshot.loads(fp.read())
+
+        assert body['dates'] == ['20170101', '20170102']
+        assert sorted(body['access-keys']) == ['AKIDEXAMPLE', 'AKIDEXAMPLE2']
+        assert os.stat(path).st_mode & 0o077 == 0
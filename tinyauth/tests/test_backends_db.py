@@ -0,0 +1,174 @@
+import datetime
+
+from flask import g
+from sqlalchemy import event
+
+from tinyauth.app import db
+from tinyauth.backends.db import Backend
+from tinyauth.models import (
+    EffectivePolicy,
+    Group,
+    GroupPolicy,
+    PolicyVersion,
+    UserPolicy,
+)
+
+from . import base
+
+
+class TestBackendDb(base.TestCase):
+
+    def add_groups(self, start, count):
+        for i in range(start, start + count):
+            group = Group(name=f'group-{i}')
+            group.users.append(self.user)
+            db.session.add(group)
+
+            db.session.add(GroupPolicy(name=f'policy-{i}', group=group, policy={
+                'Version': '2012-10-17',
+                'Statement': [{
+                    'Action': f'service{i}:*',
+                    'Resource': '*',
+                    'Effect': 'Allow',
+                }]
+            }))
+
+        db.session.commit()
+
+    def count_queries(self, fn, *args):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        engine = db.get_engine(self.app)
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            result = fn(*args)
+        finally:
+            event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+        return len(statements), result
+
+    def test_get_policies(self):
+        self.add_groups(0, 2)
+        db.session.add(UserPolicy(name='extra', user=self.user, policy={
+            'Statement': [{'Action': 'extra:*', 'Resource': '*', 'Effect': 'Deny'}],
+        }))
+        db.session.commit()
+        db.session.expire_all()
+
+        policy = Backend().get_policies('europe', 'myservice', 'charles')
+
+        actions = sorted(statement['Action'] for statement in policy['Statement'])
+        assert actions == ['extra:*', 'service0:*', 'service1:*', 'tinyauth:*']
+
+    def test_get_policies_query_count_is_constant(self):
+        backend = Backend()
+
+        self.add_groups(0, 1)
+        db.session.expire_all()
+        one_group, policy = self.count_queries(backend._load_policies, 'charles')
+        assert len(policy['Statement']) == 2
+
+        self.add_groups(1, 20)
+        db.session.expire_all()
+        many_groups, policy = self.count_queries(backend._load_policies, 'charles')
+        assert len(policy['Statement']) == 22
+
+        assert many_groups == one_group
+        assert one_group <= 4
+
+    def test_get_policies_materialized(self):
+        self.add_groups(0, 5)
+        EffectivePolicy.refresh([self.user.id])
+        db.session.commit()
+        db.session.expire_all()
+
+        queries, policy = self.count_queries(Backend()._load_policies, 'charles')
+        assert queries == 1
+        assert len(policy['Statement']) == 6
+
+
+class TestBackendDbPolicyCache(base.TestCase):
+
+    def add_policy(self, action):
+        db.session.add(UserPolicy(name=action, user=self.user, policy={
+            'Statement': [{'Action': action, 'Resource': '*', 'Effect': 'Allow'}],
+        }))
+        db.session.commit()
+
+    def new_request(self):
+        g.pop('tinyauth_policy_version', None)
+
+    def test_cached(self):
+        backend = Backend()
+        policy = backend.get_compiled_policies('europe', 'myservice', 'charles')
+
+        self.add_policy('myservice:*')
+        self.new_request()
+
+        assert backend.get_compiled_policies('europe', 'myservice', 'charles') is policy
+        assert backend.get_policies('europe', 'myservice', 'charles') is policy.document
+
+    def test_invalidated_by_version(self):
+        backend = Backend()
+        policy = backend.get_compiled_policies('europe', 'myservice', 'charles')
+
+        self.add_policy('myservice:*')
+        PolicyVersion.bump()
+        db.session.commit()
+        self.new_request()
+
+        new_policy = backend.get_compiled_policies('europe', 'myservice', 'charles')
+        assert new_policy is not policy
+        assert len(new_policy.statements) == 2
+
+    def test_version_checked_once_per_request(self):
+        backend = Backend()
+        policy = backend.get_compiled_policies('europe', 'myservice', 'charles')
+
+        PolicyVersion.bump()
+        db.session.commit()
+
+        assert backend.get_compiled_policies('europe', 'myservice', 'charles') is policy
+
+    def test_version_check_interval(self):
+        backend = Backend(cache_check_interval=60)
+        policy = backend.get_compiled_policies('europe', 'myservice', 'charles')
+
+        PolicyVersion.bump()
+        db.session.commit()
+        self.new_request()
+
+        assert backend.get_compiled_policies('europe', 'myservice', 'charles') is policy
+
+        backend.policy_version_checked -= 60
+        self.new_request()
+
+        assert backend.get_compiled_policies('europe', 'myservice', 'charles') is not policy
+
+    def test_entry_from_older_version_is_ignored(self):
+        backend = Backend()
+        policy = backend.get_compiled_policies('europe', 'myservice', 'charles')
+
+        PolicyVersion.bump()
+        db.session.commit()
+        self.new_request()
+        backend._check_policy_version()
+
+        # Simulate a slow request storing what it loaded before the bump
+        backend.policies.set('charles', (0, policy), datetime.datetime.max)
+
+        assert backend.get_compiled_policies('europe', 'myservice', 'charles') is not policy
+
+    def test_policy_api_bumps_version(self):
+        version = PolicyVersion.current()
+
+        response = self.req('post', '/api/v1/users/charles/policies', body={
+            'name': 'myservice',
+            'policy': '{"Statement": []}',
+        })
+        assert response.status_code == 200
+
+        assert PolicyVersion.current() == version + 1
@@ -1,8 +1,14 @@
 import base64
 import datetime
+import os
+import tempfile
+import time
 from unittest import mock
 
+from tinyauth import exceptions
+from tinyauth.backends import proxy
 from tinyauth.backends.proxy import Backend
+from tinyauth.utils.store import SqliteStore
 
 from . import base
 
@@ -36,12 +42,40 @@ class TestBackendProxy(base.TestCase):
             verify=True,
         )
 
+    @mock.patch('tinyauth.backends.proxy.requests')
+    def test_get_compiled_policies(self, requests):
+        self.app.config['TINYAUTH_ENDPOINT'] = 'http://localhost'
+        self.app.config['TINYAUTH_ACCESS_KEY_ID'] = 'access-key'
+        self.app.config['TINYAUTH_SECRET_ACCESS_KEY'] = 'secret-key'
+
+        expires = datetime.datetime.utcnow() + datetime.timedelta(minutes=5)
+        requests.Session.return_value.get.return_value.headers = {
+            'Expires': expires.strftime('%a, %d %b %Y %H:%M:%S GMT'),
+        }
+        requests.Session.return_value.get.return_value.json.side_effect = lambda: {'Statement': []}
+
+        compile_policy = self.patch('tinyauth.backends.proxy.compile_policy', wraps=proxy.compile_policy)
+
+        backend = Backend()
+        compiled = backend.get_compiled_policies('region', 'service', 'username')
+        assert compiled.document == {'Statement': []}
+        assert backend.get_compiled_policies('region', 'service', 'username') is compiled
+        assert compile_policy.call_count == 1
+
+        # A new document is compiled again
+        backend.invalidate(users=['username'])
+        assert backend.get_compiled_policies('region', 'service', 'username') is not compiled
+        assert compile_policy.call_count == 2
+
     @mock.patch('tinyauth.backends.proxy.requests')
     def test_get_user_key(self, requests):
         self.app.config['TINYAUTH_ENDPOINT'] = 'http://localhost'
         self.app.config['TINYAUTH_ACCESS_KEY_ID'] = 'access-key'
         self.app.config['TINYAUTH_SECRET_ACCESS_KEY'] = 'secret-key'
 
+        # An upstream without the identity bundles endpoint
+        requests.Session.return_value.post.return_value.status_code = 404
+
         requests.Session.return_value.get.return_value.headers = {
             'Expires': 'Wed, 21 Oct 2015 07:28:00 GMT',
             'Cache-Control': 'max-age=60',
@@ -73,6 +107,9 @@ class TestBackendProxy(base.TestCase):
         self.app.config['TINYAUTH_ACCESS_KEY_ID'] = 'access-key'
         self.app.config['TINYAUTH_SECRET_ACCESS_KEY'] = 'secret-key'
 
+        # An upstream without the identity bundles endpoint
+        requests.Session.return_value.post.return_value.status_code = 404
+
         requests.Session.return_value.get.return_value.headers = {
             'Expires': 'Wed, 21 Oct 2015 07:28:00 GMT',
             'Cache-Control': 'max-age=60',
@@ -97,3 +134,365 @@ class TestBackendProxy(base.TestCase):
             headers={'Accept': 'application/json'},
             verify=True,
         )
+
+        # The missing endpoint isn't asked for again
+        backend.get_access_key('basic-auth', 'region', 'service', date, 'AKIDEXAMPLE2')
+        assert requests.Session.return_value.post.call_count == 1
+        assert requests.Session.return_value.get.call_count == 2
+
+    @mock.patch('tinyauth.backends.proxy.requests')
+    def test_get_access_key_bundles_error(self, requests):
+        self.app.config['TINYAUTH_ENDPOINT'] = 'http://localhost'
+        self.app.config['TINYAUTH_ACCESS_KEY_ID'] = 'access-key'
+        self.app.config['TINYAUTH_SECRET_ACCESS_KEY'] = 'secret-key'
+
+        requests.Session.return_value.post.return_value.status_code = 503
+
+        requests.Session.return_value.get.return_value.headers = {
+            'Expires': 'Wed, 21 Oct 2015 07:28:00 GMT',
+        }
+        requests.Session.return_value.get.return_value.json.return_value = {
+            'key': base64.b64encode(b'hello').decode('utf-8'),
+            'identity': 'username',
+        }
+
+        date = datetime.datetime(2016, 8, 4)
+
+        backend = Backend()
+        secret = backend.get_access_key('basic-auth', 'region', 'service', date, 'AKIDEXAMPLE')
+        assert secret == {'key': b'hello', 'identity': 'username'}
+        assert requests.Session.return_value.get.call_count == 1
+
+        # A failure isn't a missing endpoint, so bundles are tried again
+        backend.get_access_key('basic-auth', 'region', 'service', date, 'AKIDEXAMPLE2')
+        assert requests.Session.return_value.post.call_count == 2
+
+    @mock.patch('tinyauth.backends.proxy.requests')
+    def test_get_policies_refreshed_ahead_of_expiry(self, requests):
+        self.app.config['TINYAUTH_ENDPOINT'] = 'http://localhost'
+        self.app.config['TINYAUTH_ACCESS_KEY_ID'] = 'access-key'
+        self.app.config['TINYAUTH_SECRET_ACCESS_KEY'] = 'secret-key'
+
+        expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=5)
+        requests.Session.return_value.get.return_value.headers = {
+            'Expires': expires.strftime('%a, %d %b %Y %H:%M:%S GMT'),
+            'Cache-Control': 'max-age=5',
+        }
+        requests.Session.return_value.get.return_value.json.return_value = {
+            'Statement': [],
+        }
+
+        backend = Backend()
+        backend.get_policies('region', 'service', 'username')
+        backend.get_policies('region', 'service', 'username')
+
+        refresher = Backend.get_policies.refresher
+        for i in range(100):
+            if not refresher.pending:
+                break
+            time.sleep(0.01)
+
+        assert requests.Session.return_value.get.call_count == 2
+
+    @mock.patch('tinyauth.backends.proxy.requests')
+    def test_get_access_key_unknown_is_cached(self, requests):
+        self.app.config['TINYAUTH_ENDPOINT'] = 'http://localhost'
+        self.app.config['TINYAUTH_ACCESS_KEY_ID'] = 'access-key'
+        self.app.config['TINYAUTH_SECRET_ACCESS_KEY'] = 'secret-key'
+
+        # An upstream without the identity bundles endpoint
+        requests.Session.return_value.post.return_value.status_code = 404
+
+        requests.Session.return_value.get.return_value.status_code = 404
+
+        date = datetime.datetime(2016, 8, 4)
+
+        backend = Backend()
+        for i in range(3):
+            with self.assertRaises(exceptions.NoSuchKey) as cm:
+                backend.get_access_key('basic-auth', 'region', 'service', date, 'AKIDBOGUS')
+            assert cm.exception.identity == 'AKIDBOGUS'
+
+        assert requests.Session.return_value.get.call_count == 1
+        assert Backend.get_access_key.negative_cache.stats()['hits'] >= 2
+
+    @mock.patch('tinyauth.backends.proxy.requests')
+    def test_get_policies_from_store(self, requests):
+        self.app.config['TINYAUTH_ENDPOINT'] = 'http://localhost'
+        self.app.config['TINYAUTH_ACCESS_KEY_ID'] = 'access-key'
+        self.app.config['TINYAUTH_SECRET_ACCESS_KEY'] = 'secret-key'
+
+        expires = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        requests.Session.return_value.get.return_value.headers = {
+            'Expires': expires.strftime('%a, %d %b %Y %H:%M:%S GMT'),
+            'Cache-Control': 'max-age=3600',
+        }
+        requests.Session.return_value.get.return_value.json.return_value = {
+            'Statement': [],
+        }
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'cache.db')
+
+        backend = Backend(store=SqliteStore(path))
+        assert backend.get_policies('region', 'service', 'username') == {'Statement': []}
+        assert requests.Session.return_value.get.call_count == 1
+
+        # A restarted worker starts with an empty memory cache
+        backend = Backend(store=SqliteStore(path))
+        assert backend.get_policies('region', 'service', 'username') == {'Statement': []}
+        assert requests.Session.return_value.get.call_count == 1
+
+    @mock.patch('tinyauth.backends.proxy.requests')
+    def test_get_user_key_from_store(self, requests):
+        self.app.config['TINYAUTH_ENDPOINT'] = 'http://localhost'
+        self.app.config['TINYAUTH_ACCESS_KEY_ID'] = 'access-key'
+        self.app.config['TINYAUTH_SECRET_ACCESS_KEY'] = 'secret-key'
+
+        # An upstream without the identity bundles endpoint
+        requests.Session.return_value.post.return_value.status_code = 404
+
+        expires = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        requests.Session.return_value.get.return_value.headers = {
+            'Expires': expires.strftime('%a, %d %b %Y %H:%M:%S GMT'),
+            'Cache-Control': 'max-age=3600',
+        }
+        requests.Session.return_value.get.return_value.json.return_value = {
+            'key': base64.b64encode(b'hello').decode('utf-8'),
+            'identity': 'username',
+        }
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'cache.db')
+
+        date = datetime.datetime(2016, 8, 4)
+
+        Backend(store=SqliteStore(path)).get_user_key('basic-auth', 'region', 'service', date, 'username')
+
+        secret = Backend(store=SqliteStore(path)).get_user_key('basic-auth', 'region', 'service', date, 'username')
+        assert secret == {
+            'key': b'hello',
+            'identity': 'username',
+        }
+        assert requests.Session.return_value.get.call_count == 1
+
+    def bundles_response(self, requests, access_keys=None, users=None):
+        response = requests.Session.return_value.post.return_value
+        response.status_code = 200
+        response.json.return_value = {
+            'access-keys': access_keys or {},
+            'users': users or {},
+            'key-max-age': 60 * 60 * 24 * 3,
+            'policy-max-age': 60,
+        }
+
+    @mock.patch('tinyauth.backends.proxy.requests')
+    def test_get_access_key_fills_policies(self, requests):
+        self.app.config['TINYAUTH_ENDPOINT'] = 'http://localhost'
+        self.app.config['TINYAUTH_ACCESS_KEY_ID'] = 'access-key'
+        self.app.config['TINYAUTH_SECRET_ACCESS_KEY'] = 'secret-key'
+
+        self.bundles_response(requests, access_keys={
+            'AKIDEXAMPLE': {
+                'key': base64.b64encode(b'hello').decode('utf-8'),
+                'identity': 'username',
+                'policy': {'Statement': []},
+            },
+        })
+
+        date = datetime.date(2016, 8, 4)
+
+        backend = Backend()
+        secret = backend.get_access_key('basic-auth', 'region', 'service', date, 'AKIDEXAMPLE')
+        assert secret == {
+            'key': b'hello',
+            'identity': 'username',
+        }
+
+        requests.Session.return_value.post.assert_called_with(
+            'http://localhost/api/v1/regions/region/services/service/identity-bundles',
+            auth=('access-key', 'secret-key'),
+            headers={'Accept': 'application/json'},
+            verify=True,
+            json={
+                'protocol': 'basic-auth',
+                'date': '20160804',
+                'access-keys': ['AKIDEXAMPLE'],
+                'users': [],
+            },
+        )
+
+        # The policies came back in the same response
+        assert backend.get_policies('region', 'service', 'username') == {'Statement': []}
+        assert requests.Session.return_value.get.call_count == 0
+
+    @mock.patch('tinyauth.backends.proxy.requests')
+    def test_get_user_key_unknown(self, requests):
+        self.app.config['TINYAUTH_ENDPOINT'] = 'http://localhost'
+        self.app.config['TINYAUTH_ACCESS_KEY_ID'] = 'access-key'
+        self.app.config['TINYAUTH_SECRET_ACCESS_KEY'] = 'secret-key'
+
+        self.bundles_response(requests, users={'username': None})
+
+        date = datetime.date(2016, 8, 4)
+
+        backend = Backend()
+        with self.assertRaises(exceptions.NoSuchKey):
+            backend.get_user_key('jwt', 'region', 'service', date, 'username')
+
+    @mock.patch('tinyauth.backends.proxy.requests')
+    def test_prefetch(self, requests):
+        self.app.config['TINYAUTH_ENDPOINT'] = 'http://localhost'
+        self.app.config['TINYAUTH_ACCESS_KEY_ID'] = 'access-key'
+        self.app.config['TINYAUTH_SECRET_ACCESS_KEY'] = 'secret-key'
+
+        access_keys = [f'AKID{i}' for i in range(150)]
+
+        self.bundles_response(requests, access_keys={
+            access_key: {
+                'key': base64.b64encode(b'hello').decode('utf-8'),
+                'identity': f'user-{access_key}',
+                'policy': {'Statement': []},
+            } for access_key in access_keys
+        })
+
+        date = datetime.date(2016, 8, 4)
+
+        backend = Backend()
+        backend.prefetch('basic-auth', 'region', 'service', date, access_keys=access_keys, users=['freddy'])
+
+        calls = requests.Session.return_value.post.call_args_list
+        assert len(calls) == 2
+        assert len(calls[0][1]['json']['access-keys']) == 100
+        assert calls[1][1]['json']['access-keys'] == access_keys[100:]
+        assert calls[1][1]['json']['users'] == ['freddy']
+
+        backend.get_access_key('basic-auth', 'region', 'service', date, 'AKID42')
+        backend.get_policies('region', 'service', 'user-AKID42')
+        assert len(requests.Session.return_value.post.call_args_list) == 2
+        assert requests.Session.return_value.get.call_count == 0
+
+    def _changes(self, requests, *bodies):
+        responses = []
+        for body in bodies:
+            response = mock.Mock()
+            response.json.return_value = body
+            responses.append(response)
+        requests.Session.return_value.get.side_effect = responses
+
+    def _cached(self, backend, method):
+        # The caches are shared by every backend instance
+        return [key[1:] for key in method.cache.cache if key[0] is backend]
+
+    @mock.patch('tinyauth.backends.proxy.requests')
+    def test_poll_changes_invalidates(self, requests):
+        self.app.config['TINYAUTH_ENDPOINT'] = 'http://localhost'
+        self.app.config['TINYAUTH_ACCESS_KEY_ID'] = 'access-key'
+        self.app.config['TINYAUTH_SECRET_ACCESS_KEY'] = 'secret-key'
+
+        backend = Backend()
+        expires = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        backend.get_policies.prime(expires, {'Statement': []}, backend, 'region', 'service', 'charles')
+        backend.get_policies.prime(expires, {'Statement': []}, backend, 'region', 'service', 'freddy')
+        backend.get_access_key.prime(expires, {'key': b'x'}, backend, 'hmac', 'region', 'service', 'date', 'AKIDEXAMPLE')
+
+        self._changes(
+            requests,
+            {'cursor': 3, 'changes': [], 'reset': False, 'more': False},
+            {
+                'cursor': 5,
+                'changes': [{'user': 'charles', 'access-key': None}, {'user': 'freddy', 'access-key': 'AKIDEXAMPLE'}],
+                'reset': False,
+                'more': False,
+            },
+        )
+
+        backend.poll_changes()
+        assert backend.change_cursor == 3
+        assert len(self._cached(backend, backend.get_policies)) == 2
+
+        backend.poll_changes()
+        assert backend.change_cursor == 5
+        assert requests.Session.return_value.get.call_args[0][0] == 'http://localhost/api/v1/changes?since=3'
+
+        assert self._cached(backend, backend.get_policies) == [('region', 'service', 'freddy')]
+        assert self._cached(backend, backend.get_access_key) == []
+
+    @mock.patch('tinyauth.backends.proxy.requests')
+    def test_poll_changes_reset(self, requests):
+        self.app.config['TINYAUTH_ENDPOINT'] = 'http://localhost'
+        self.app.config['TINYAUTH_ACCESS_KEY_ID'] = 'access-key'
+        self.app.config['TINYAUTH_SECRET_ACCESS_KEY'] = 'secret-key'
+
+        backend = Backend()
+        backend.change_cursor = 10
+        expires = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        backend.get_policies.prime(expires, {'Statement': []}, backend, 'region', 'service', 'charles')
+
+        self._changes(requests, {'cursor': 2, 'changes': [], 'reset': True, 'more': False})
+        backend.poll_changes()
+
+        assert backend.change_cursor == 2
+        assert self._cached(backend, backend.get_policies) == []
+
+    @mock.patch('tinyauth.backends.proxy.requests')
+    def test_poll_changes_cursor_in_store(self, requests):
+        self.app.config['TINYAUTH_ENDPOINT'] = 'http://localhost'
+        self.app.config['TINYAUTH_ACCESS_KEY_ID'] = 'access-key'
+        self.app.config['TINYAUTH_SECRET_ACCESS_KEY'] = 'secret-key'
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'cache.db')
+
+        self._changes(
+            requests,
+            {'cursor': 7, 'changes': [], 'reset': False, 'more': True},
+            {'cursor': 9, 'changes': [], 'reset': False, 'more': False},
+        )
+        Backend(store=SqliteStore(path)).poll_changes()
+
+        self._changes(requests, {'cursor': 9, 'changes': [], 'reset': False, 'more': False})
+        Backend(store=SqliteStore(path)).poll_changes()
+
+        assert requests.Session.return_value.get.call_args[0][0] == 'http://localhost/api/v1/changes?since=9'
+
+    @mock.patch('tinyauth.backends.proxy.requests')
+    def test_get_policies_revalidated(self, requests):
+        self.app.config['TINYAUTH_ENDPOINT'] = 'http://localhost'
+        self.app.config['TINYAUTH_ACCESS_KEY_ID'] = 'access-key'
+        self.app.config['TINYAUTH_SECRET_ACCESS_KEY'] = 'secret-key'
+
+        expired = mock.Mock(status_code=200, headers={
+            'Expires': 'Wed, 21 Oct 2015 07:28:00 GMT',
+            'ETag': '"abc"',
+        })
+        expired.json.return_value = {'Statement': []}
+
+        expires = datetime.datetime.utcnow().replace(microsecond=0) + datetime.timedelta(minutes=1)
+        not_modified = mock.Mock(status_code=304, headers={
+            'Expires': expires.strftime('%a, %d %b %Y %H:%M:%S GMT'),
+            'ETag': '"abc"',
+        })
+
+        requests.Session.return_value.get.side_effect = [expired, not_modified]
+
+        backend = Backend()
+        assert backend.get_policies('region', 'service', 'username') == {'Statement': []}
+        assert backend.get_policies('region', 'service', 'username') == {'Statement': []}
+
+        requests.Session.return_value.get.assert_called_with(
+            'http://localhost/api/v1/regions/region/services/service/user-policies/username',
+            auth=('access-key', 'secret-key'),
+            headers={'Accept': 'application/json', 'If-None-Match': '"abc"'},
+            verify=True,
+        )
+        not_modified.json.assert_not_called()
+
+        # The 304 pushed the expiry forward, so this is a hit
+        hits = backend.get_policies.cache.stats()['hits']
+        assert backend.get_policies('region', 'service', 'username') == {'Statement': []}
+        assert backend.get_policies.cache.stats()['hits'] == hits + 1
+        assert requests.Session.return_value.get.call_count == 2
@@ -0,0 +1,107 @@
+import datetime
+import os
+import tempfile
+
+import pytest
+
+from tinyauth import exceptions, snapshot
+from tinyauth.app import db
+from tinyauth.backends.db import Backend as DbBackend
+from tinyauth.backends.snapshot import Backend
+from tinyauth.models import User
+
+from . import base
+
+DATE = datetime.date(2017, 1, 1)
+
+
+class TestBackendSnapshot(base.TestCase):
+
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+
+    def export(self, name, region='europe', service='myservice'):
+        path = os.path.join(self.dir, name)
+        body = snapshot.build(region, service, [DATE], self.app.config['SECRET_SIGNING_KEY'])
+        with open(f'{path}.tmp', 'wb') as fp:
+            fp.write(snapshot.dumps(body))
+        os.replace(f'{path}.tmp', path)
+        return path
+
+    def test_matches_db(self):
+        backend = Backend([self.export('snapshot')])
+        db_backend = DbBackend()
+
+        for protocol in ('basic-auth', 'jwt'):
+            assert backend.get_access_key(protocol, 'europe', 'myservice', DATE, 'AKIDEXAMPLE') == \
+                db_backend.get_access_key(protocol, 'europe', 'myservice', DATE, 'AKIDEXAMPLE')
+
+        assert backend.get_user_key('jwt', 'europe', 'myservice', DATE, 'charles') == \
+            db_backend.get_user_key('jwt', 'europe', 'myservice', DATE, 'charles')
+
+        assert backend.get_policies('europe', 'myservice', 'charles') == db_backend.get_policies('europe', 'myservice', 'charles')
+
+        compiled = backend.get_compiled_policies('europe', 'myservice', 'charles')
+        assert backend.get_compiled_policies('europe', 'myservice', 'charles') is compiled
+
+    def test_datetime(self):
+        backend = Backend([self.export('snapshot')])
+
+        # The access key signing token endpoint passes a datetime
+        secret = backend.get_access_key('jwt', 'europe', 'myservice', datetime.datetime(2017, 1, 1), 'AKIDEXAMPLE')
+        assert secret['identity'] == 'charles'
+
+    def test_no_such_key(self):
+        backend = Backend([self.export('snapshot')])
+
+        lookups = [
+            lambda: backend.get_access_key('jwt', 'europe', 'myservice', DATE, 'AKIDUNKNOWN'),
+            lambda: backend.get_access_key('jwt', 'europe', 'myservice', DATE + datetime.timedelta(days=1), 'AKIDEXAMPLE'),
+            lambda: backend.get_access_key('jwt', 'europe', 'otherservice', DATE, 'AKIDEXAMPLE'),
+            lambda: backend.get_user_key('basic-auth', 'europe', 'myservice', DATE, 'charles'),
+            lambda: backend.get_policies('europe', 'myservice', 'nobody'),
+        ]
+
+        for lookup in lookups:
+            with pytest.raises(exceptions.NoSuchKey):
+                lookup()
+
+    def test_several_files(self):
+        backend = Backend([self.export('a'), self.export('b', region='global', service='tinyauth')])
+
+        assert backend.get_access_key('jwt', 'europe', 'myservice', DATE, 'AKIDEXAMPLE')['identity'] == 'charles'
+        assert backend.get_access_key('jwt', 'global', 'tinyauth', DATE, 'AKIDEXAMPLE')['identity'] == 'charles'
+        assert backend.get_policies('elsewhere', 'otherservice', 'charles')
+
+    def test_reload(self):
+        path = self.export('snapshot')
+        backend = Backend([path], check_interval=0)
+
+        with pytest.raises(exceptions.NoSuchKey):
+            backend.get_policies('europe', 'myservice', 'mike')
+
+        db.session.add(User(username='mike'))
+        db.session.commit()
+        self.export('snapshot')
+
+        assert backend.get_policies('europe', 'myservice', 'mike') == {'Statement': []}
+
+    def test_bad_file_keeps_last_snapshot(self):
+        path = self.export('snapshot')
+        backend = Backend([path], check_interval=0)
+        assert backend.get_policies('europe', 'myservice', 'charles')
+
+        with open(f'{path}.tmp', 'wb') as fp:
+            fp.write(b'garbage')
+        os.replace(f'{path}.tmp', path)
+
+        assert backend.get_policies('europe', 'myservice', 'charles')
+
+    def test_missing_file(self):
+        backend = Backend([os.path.join(self.dir, 'missing')])
+
+        with pytest.raises(exceptions.NoSuchKey):
+            backend.get_policies('europe', 'myservice', 'charles')
@@ -1,6 +1,17 @@
 import unittest
 
-from tinyauth.models import AccessKey, Group, GroupPolicy, User, UserPolicy
+from tinyauth.models import (
+    AccessKey,
+    Change,
+    EffectivePolicy,
+    Group,
+    GroupPolicy,
+    PolicyIndex,
+    PolicyVersion,
+    User,
+    UserPolicy,
+    hash_policy,
+)
 
 
 class TestAccessKey(unittest.TestCase):
@@ -24,6 +35,13 @@ class TestGroup(unittest.TestCase):
         assert str(group) == '<Group \'my-user\'>'
 
 
+class TestPolicyVersion(unittest.TestCase):
+
+    def test_repr(self):
+        policy_version = PolicyVersion(version=5)
+        assert str(policy_version) == '<PolicyVersion 5>'
+
+
 class TestUserPolicy(unittest.TestCase):
 
     def test_repr(self):
@@ -36,3 +54,46 @@ class TestUser(unittest.TestCase):
     def test_repr(self):
         user = User(username='my-user')
         assert str(user) == '<User \'my-user\'>'
+
+
+class TestEffectivePolicy(unittest.TestCase):
+
+    def test_repr(self):
+        effective_policy = EffectivePolicy(hash='abcdef')
+        assert str(effective_policy) == '<EffectivePolicy \'abcdef\'>'
+
+    def test_hash_is_order_independent(self):
+        assert hash_policy({'Statement': [], 'Version': '1'}) == hash_policy({'Version': '1', 'Statement': []})
+        assert hash_policy({'Statement': []}) != hash_policy({'Statement': [{}]})
+
+
+class TestPolicyIndex(unittest.TestCase):
+
+    def test_repr(self):
+        policy_index = PolicyIndex(action='tinyauth:*')
+        assert str(policy_index) == '<PolicyIndex \'tinyauth:*\'>'
+
+    def test_for_policy(self):
+        rows = PolicyIndex.for_policy({
+            'Statement': [
+                {'Action': ['tinyauth:Get*', '*'], 'Resource': '*', 'Effect': 'Allow'},
+                {'Action': 'my*:Launch', 'Resource': '*', 'Effect': 'Allow'},
+                {'Action': 'tinyauth:Get*', 'Resource': '*', 'Effect': 'Allow'},
+                {'Action': 'tinyauth:DeleteUser', 'Resource': '*', 'Effect': 'Deny'},
+                {'Action': [5, {'tinyauth': 'GetUser'}], 'Resource': '*', 'Effect': 'Allow'},
+                {'Action': 'x' * 1000, 'Resource': '*', 'Effect': 'Allow'},
+            ],
+        })
+        assert [(row.service, row.action) for row in rows] == [
+            (None, '*'),
+            (None, 'my*:Launch'),
+            ('tinyauth', 'tinyauth:Get*'),
+            (None, 'x' * 1000),
+        ]
+
+
+class TestChange(unittest.TestCase):
+
+    def test_repr(self):
+        change = Change(id=5, username='my-user')
+        assert str(change) == '<Change 5 \'my-user\'>'
@@ -1,6 +1,23 @@
+import fnmatch
+import random
 import unittest
 
-from tinyauth.policy import allow, get_allowed_resources
+from tinyauth.policy import (
+    ActionIndex,
+    CompiledPolicy,
+    PatternSet,
+    ResourceTrie,
+    _can_match_prefix,
+    _compile_glob,
+    allow,
+    allow_matrix,
+    compile_policy,
+    filter_policy,
+    filter_resources,
+    get_allowed_resources,
+    review,
+    review_matrix,
+)
 
 
 class TestSimplePolicy(unittest.TestCase):
@@ -304,3 +321,430 @@ class TestAllowedPolicies(unittest.TestCase):
         allow, deny = get_allowed_resources(policy, 'myservice:ListInstances', context)
         assert allow == ['arn::myservice:::instances/foo_*']
         assert deny == []
+
+
+class TestCompiledPolicy(unittest.TestCase):
+
+    policy = {
+        'Version': '2012-10-17',
+        'Statement': [{
+            'Action': ['myservice:ListInstances', 'myservice:Get*'],
+            'Resource': ['arn::myservice:::instances/foo_*', 'arn::myservice:::volumes/vol-1'],
+            'Effect': 'Allow',
+        }, {
+            'Action': 'myservice:ListInstances',
+            'Resource': 'arn::myservice:::instances/foo_bar_*',
+            'Effect': 'Deny',
+        }, {
+            'Action': 'myservice:GetInstance',
+            'Resource': 'arn::myservice:::instances/foo_?',
+            'Condition': {
+                'IpAddress': {'SourceIp': '10.0.0.0/8'},
+            },
+            'Effect': 'Deny',
+        }]
+    }
+
+    def test_compile_policy_is_idempotent(self):
+        compiled = compile_policy(self.policy)
+        assert isinstance(compiled, CompiledPolicy)
+        assert compile_policy(compiled) is compiled
+
+    def test_same_decisions_as_raw_policy(self):
+        compiled = compile_policy(self.policy)
+
+        actions = ['myservice:ListInstances', 'myservice:GetInstance', 'myservice:DeleteInstance']
+        resources = [
+            'arn::myservice:::instances/foo_1',
+            'arn::myservice:::instances/foo_bar_1',
+            'arn::myservice:::volumes/vol-1',
+            'arn::myservice:::volumes/vol-2',
+        ]
+        contexts = [{}, {'SourceIp': '10.1.2.3'}, {'SourceIp': '192.168.0.1'}]
+
+        for action in actions:
+            for resource in resources:
+                for context in contexts:
+                    assert allow(compiled, action, resource, context) == allow(self.policy, action, resource, context)
+
+    def test_deny_wins_regardless_of_order(self):
+        compiled = compile_policy(self.policy)
+        assert allow(compiled, 'myservice:ListInstances', 'arn::myservice:::instances/foo_bar_1') == 'Deny'
+        assert allow(compiled, 'myservice:GetInstance', 'arn::myservice:::instances/foo_1', {'SourceIp': '10.0.0.1'}) == 'Deny'
+        assert allow(compiled, 'myservice:GetInstance', 'arn::myservice:::instances/foo_1', {'SourceIp': '11.0.0.1'}) == 'Allow'
+
+    def test_literal_pattern_is_not_a_prefix_match(self):
+        compiled = compile_policy(self.policy)
+        assert allow(compiled, 'myservice:GetVolume', 'arn::myservice:::volumes/vol-1') == 'Allow'
+        assert allow(compiled, 'myservice:GetVolume', 'arn::myservice:::volumes/vol-10') == 'Default'
+
+    def test_get_allowed_resources(self):
+        compiled = compile_policy(self.policy)
+        allowed, denied = get_allowed_resources(compiled, 'myservice:ListInstances')
+        assert allowed == ['arn::myservice:::instances/foo_*', 'arn::myservice:::volumes/vol-1']
+        assert denied == ['arn::myservice:::instances/foo_bar_*']
+        assert (allowed, denied) == get_allowed_resources(self.policy, 'myservice:ListInstances')
+
+    def test_unknown_condition_fails_when_evaluated(self):
+        compiled = compile_policy({
+            'Statement': [{
+                'Action': 'myservice:GetInstance',
+                'Resource': '*',
+                'Condition': {'NumericEquals': {'Count': '1'}},
+                'Effect': 'Allow',
+            }]
+        })
+        assert allow(compiled, 'myservice:ListInstances', 'arn::myservice:::instances/foo_1') == 'Default'
+        self.assertRaises(KeyError, allow, compiled, 'myservice:GetInstance', 'arn::myservice:::instances/foo_1')
+
+    def test_missing_effect_fails_when_evaluated(self):
+        compiled = compile_policy({
+            'Statement': [{
+                'Action': 'myservice:GetInstance',
+                'Resource': '*',
+            }, {
+                'Action': 'myservice:ListInstances',
+                'Resource': '*',
+                'Effect': 'Allow',
+            }]
+        })
+        assert allow(compiled, 'myservice:ListInstances', 'arn::myservice:::instances/foo_1') == 'Allow'
+        self.assertRaises(KeyError, allow, compiled, 'myservice:GetInstance', 'arn::myservice:::instances/foo_1')
+
+
+class TestActionIndex(unittest.TestCase):
+
+    policy = {
+        'Statement': [
+            {'Action': 'tinyauth:GetUser', 'Resource': '*', 'Effect': 'Allow'},
+            {'Action': 'tinyauth:*', 'Resource': '*', 'Effect': 'Allow'},
+            {'Action': ['tinyauth:List*', 'tinyauth:ListUsers'], 'Resource': '*', 'Effect': 'Allow'},
+            {'Action': 'myservice:*', 'Resource': '*', 'Effect': 'Allow'},
+            {'Action': '*:GetUser', 'Resource': '*', 'Effect': 'Deny'},
+            {'Action': '*', 'Resource': '*', 'Effect': 'Allow'},
+            {'Action': 'tinyauth', 'Resource': '*', 'Effect': 'Allow'},
+        ]
+    }
+
+    def lookup(self, action):
+        index = ActionIndex(compile_policy(self.policy).statements)
+        return [statement.index for statement in index.lookup(action)]
+
+    def test_literal(self):
+        assert self.lookup('tinyauth:GetUser') == [0, 1, 4, 5]
+
+    def test_service_wildcard(self):
+        assert self.lookup('tinyauth:ListUsers') == [1, 2, 5]
+        assert self.lookup('tinyauth:ListGroups') == [1, 2, 5]
+
+    def test_other_service(self):
+        assert self.lookup('myservice:GetUser') == [3, 4, 5]
+
+    def test_no_service(self):
+        assert self.lookup('tinyauth') == [5, 6]
+        assert self.lookup('GetUser') == [5]
+
+    def test_matches_fnmatch(self):
+        actions = [
+            'tinyauth:GetUser',
+            'tinyauth:ListUsers',
+            'tinyauth:',
+            'myservice:GetUser',
+            'myservice:Get:User',
+            'other:Thing',
+            'tinyauth',
+            '',
+        ]
+        statements = compile_policy(self.policy).statements
+        index = ActionIndex(statements)
+        for action in actions:
+            expected = [s.index for s in statements if any(fnmatch.fnmatch(action, a) for a in s.actions)]
+            assert [s.index for s in index.lookup(action)] == expected, action
+
+
+class TestResourceTrie(unittest.TestCase):
+
+    patterns = [
+        '*',
+        'arn:tinyauth:*',
+        'arn:tinyauth:tinyauth:::users/*',
+        'arn:tinyauth:tinyauth:::users/charles',
+        'arn:tinyauth:tinyauth:::users/char*',
+        'arn:tinyauth:tinyauth:::users/',
+        'arn:tinyauth:tinyauth:::groups/?dmins',
+        'arn:tinyauth:tinyauth:::groups/[ab]*',
+        'arn:tinyauth:myservice:*:*:rockets/*',
+        'arn:tinyauth:tinyauth:::',
+        'arn:tinyauth:tinyauth',
+        'users/*',
+    ]
+
+    resources = [
+        'arn:tinyauth:tinyauth:::users/charles',
+        'arn:tinyauth:tinyauth:::users/charlotte',
+        'arn:tinyauth:tinyauth:::users/',
+        'arn:tinyauth:tinyauth:::users',
+        'arn:tinyauth:tinyauth:::groups/admins',
+        'arn:tinyauth:tinyauth:::groups/bots',
+        'arn:tinyauth:tinyauth:::groups/users',
+        'arn:tinyauth:myservice:europe::rockets/thrift',
+        'arn:tinyauth:tinyauth:::',
+        'arn:tinyauth:tinyauth',
+        'arn:other:tinyauth:::users/charles',
+        'users/charles',
+        '',
+    ]
+
+    def test_matches_fnmatch(self):
+        trie = ResourceTrie()
+        for i, pattern in enumerate(self.patterns):
+            trie.add(pattern, i)
+
+        for resource in self.resources:
+            expected = [i for i, pattern in enumerate(self.patterns) if fnmatch.fnmatch(resource, pattern)]
+            assert sorted(trie.match(resource)) == expected, resource
+
+    def test_same_pattern_twice(self):
+        trie = ResourceTrie()
+        trie.add('arn:tinyauth:tinyauth:::users/*', 'first')
+        trie.add('arn:tinyauth:tinyauth:::users/*', 'second')
+        assert trie.match('arn:tinyauth:tinyauth:::users/charles') == ['first', 'second']
+
+    def test_no_match(self):
+        trie = ResourceTrie()
+        trie.add('arn:tinyauth:tinyauth:::users/*', 'users')
+        assert trie.match('arn:tinyauth:tinyauth:::groups/admins') == []
+
+
+class TestPatternSet(unittest.TestCase):
+
+    def test_matches_fnmatch(self):
+        patterns = TestResourceTrie.patterns + ['*charles', '?rn:*', 'arn:tinyauth:tinyauth:::users/charles']
+        resources = TestResourceTrie.resources
+
+        masks = PatternSet(patterns).match(resources)
+        for resource, mask in zip(resources, masks):
+            expected = sum(1 << i for i, pattern in enumerate(patterns) if fnmatch.fnmatchcase(resource, pattern))
+            assert mask == expected, resource
+
+    def test_random(self):
+        rnd = random.Random(0)
+        pattern_alphabet = 'ab:/*?[]!-'
+        value_alphabet = 'ab:/-[]!'
+
+        for i in range(200):
+            patterns = [''.join(rnd.choice(pattern_alphabet) for _ in range(rnd.randint(0, 6))) for _ in range(10)]
+            resources = [''.join(rnd.choice(value_alphabet) for _ in range(rnd.randint(0, 6))) for _ in range(30)]
+
+            masks = PatternSet(patterns).match(resources)
+            for resource, mask in zip(resources, masks):
+                expected = sum(1 << i for i, pattern in enumerate(patterns) if fnmatch.fnmatchcase(resource, pattern))
+                assert mask == expected, (patterns, resource)
+
+    def test_empty(self):
+        assert PatternSet([]).match(['arn:tinyauth:tinyauth:::users/charles']) == [0]
+        assert PatternSet(['*']).match([]) == []
+
+
+class TestGlob(unittest.TestCase):
+
+    def test_matches_fnmatch(self):
+        rnd = random.Random(0)
+        pattern_alphabet = 'ab:/*?[]!-^'
+        value_alphabet = 'ab:/-[]!^\n'
+
+        for i in range(20000):
+            pattern = ''.join(rnd.choice(pattern_alphabet) for _ in range(rnd.randint(0, 7)))
+            value = ''.join(rnd.choice(value_alphabet) for _ in range(rnd.randint(0, 8)))
+            assert _compile_glob(pattern)(value) == fnmatch.fnmatchcase(value, pattern), (pattern, value)
+
+    def test_arns(self):
+        match = _compile_glob('arn:tinyauth:tinyauth:::users/*')
+        assert match('arn:tinyauth:tinyauth:::users/charles')
+        assert match('arn:tinyauth:tinyauth:::users/')
+        assert not match('arn:tinyauth:tinyauth:::groups/admins')
+
+        match = _compile_glob('arn:*:myservice:?:*:rockets/*/fuel')
+        assert match('arn:tinyauth:myservice:e::rockets/thrift/fuel')
+        assert not match('arn:tinyauth:myservice:eu::rockets/thrift/fuel')
+        assert not match('arn:tinyauth:myservice:e::rockets/thrift/fuel/tank')
+
+    def test_pathological_pattern(self):
+        # A backtracking regex takes seconds for this at just a few hundred characters
+        match = _compile_glob('*a*a*a*a*a*a*b')
+        assert not match('a' * 100000)
+        assert match('a' * 100000 + 'b')
+
+
+class TestFilterPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = {
+            'Version': '2012-10-17',
+            'Statement': [
+                {'Action': 'myservice:GetRocket', 'Resource': '*', 'Effect': 'Allow'},
+                {'Action': ['otherservice:*', 'myservice:Launch*'], 'Resource': '*', 'Effect': 'Allow'},
+                {'Action': 'otherservice:*', 'Resource': '*', 'Effect': 'Deny'},
+                {'Action': 'my*', 'Resource': '*', 'Effect': 'Deny'},
+                {'Action': '?yservice:Get*', 'Resource': '*', 'Effect': 'Allow'},
+                {'Action': '*', 'Resource': 'arn:tinyauth:myservice:eu-west::rockets/*', 'Effect': 'Allow'},
+                {'Action': '*', 'Resource': 'arn:tinyauth:myservice:::rockets/*', 'Effect': 'Allow'},
+                {'Action': '*', 'Resource': 'arn:tinyauth:myservice:us-east::rockets/*', 'Effect': 'Allow'},
+                {'NotAction': 'myservice:GetRocket', 'Resource': '*', 'Effect': 'Deny'},
+                {'Action': '*', 'Resource': 'arn:tinyauth:myservice:us-east::rockets/*', 'Effect': 'Deny'},
+            ],
+        }
+
+    def test_service(self):
+        filtered = filter_policy(self.policy, 'myservice')
+        assert filtered['Version'] == '2012-10-17'
+        assert filtered['Statement'] == [s for i, s in enumerate(self.policy['Statement']) if i != 2]
+
+    def test_region(self):
+        filtered = filter_policy(self.policy, 'myservice', 'eu-west')
+        assert filtered['Statement'] == [s for i, s in enumerate(self.policy['Statement']) if i not in (2, 7)]
+
+    def test_region_keeps_deny(self):
+        filtered = filter_policy(self.policy, 'myservice', 'eu-west')
+        resource = 'arn:tinyauth:myservice:us-east::rockets/thrift'
+        assert allow(filtered, 'myservice:LaunchRocket', resource) == allow(self.policy, 'myservice:LaunchRocket', resource) == 'Deny'
+
+    def test_no_service(self):
+        assert filter_policy(self.policy, '') is self.policy
+
+    def test_same_decisions(self):
+        filtered = filter_policy(self.policy, 'myservice')
+        for action in ('myservice:GetRocket', 'myservice:LaunchRocket', 'myservice:Fuel'):
+            resource = 'arn:tinyauth:myservice:eu-west::rockets/thrift'
+            assert allow(filtered, action, resource) == allow(self.policy, action, resource)
+
+    def test_never_drops_a_match(self):
+        rnd = random.Random(0)
+        pattern_alphabet = 'ab:*?[]!-'
+        value_alphabet = 'ab:-'
+
+        for i in range(20000):
+            pattern = ''.join(rnd.choice(pattern_alphabet) for _ in range(rnd.randint(0, 7)))
+            value = 'ab:' + ''.join(rnd.choice(value_alphabet) for _ in range(rnd.randint(0, 4)))
+            if fnmatch.fnmatchcase(value, pattern):
+                assert _can_match_prefix(pattern, 'ab:'), (pattern, value)
+
+
+class TestFilterResources(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = compile_policy({
+            'Statement': [{
+                'Action': 'myservice:Get*',
+                'Resource': 'arn:tinyauth:myservice:::projects/*',
+                'Effect': 'Allow',
+            }, {
+                'Action': 'myservice:GetProject',
+                'Resource': ['arn:tinyauth:myservice:::projects/secret-*', 'arn:tinyauth:myservice:::projects/hidden'],
+                'Effect': 'Deny',
+            }, {
+                'Action': 'myservice:*',
+                'Resource': 'arn:tinyauth:myservice:::projects/vpn-*',
+                'Effect': 'Allow',
+                'Condition': {'IpAddress': {'SourceIp': '10.0.0.0/8'}},
+            }, {
+                'Action': 'myservice:*',
+                'Resource': 'arn:tinyauth:myservice:::shared',
+                'Effect': 'Allow',
+            }],
+        })
+
+        self.resources = [
+            'arn:tinyauth:myservice:::projects/a',
+            'arn:tinyauth:myservice:::projects/secret-b',
+            'arn:tinyauth:myservice:::projects/hidden',
+            'arn:tinyauth:myservice:::projects/vpn-c',
+            'arn:tinyauth:myservice:::shared',
+            'arn:tinyauth:myservice:::other/d',
+        ]
+
+    def test_filter(self):
+        assert filter_resources(self.policy, 'myservice:GetProject', self.resources) == [
+            'arn:tinyauth:myservice:::projects/a',
+            'arn:tinyauth:myservice:::projects/vpn-c',
+            'arn:tinyauth:myservice:::shared',
+        ]
+
+    def test_nothing_allowed(self):
+        assert filter_resources(self.policy, 'otherservice:GetProject', self.resources) == []
+
+    def test_same_decisions_as_allow(self):
+        for action in ('myservice:GetProject', 'myservice:GetThing', 'myservice:DeleteProject'):
+            for context in ({}, {'SourceIp': '10.1.2.3'}, {'SourceIp': '192.168.0.1'}):
+                expected = [r for r in self.resources if allow(self.policy, action, r, context) == 'Allow']
+                assert filter_resources(self.policy, action, self.resources, context) == expected, (action, context)
+
+
+class TestAllowMatrix(unittest.TestCase):
+
+    setUp = TestFilterResources.setUp
+
+    def test_same_decisions_as_allow(self):
+        actions = ['myservice:GetProject', 'myservice:GetThing', 'myservice:DeleteProject', 'otherservice:GetProject']
+
+        for context in ({}, {'SourceIp': '10.1.2.3'}, {'SourceIp': '192.168.0.1'}):
+            expected = [[allow(self.policy, action, r, context) for r in self.resources] for action in actions]
+            assert allow_matrix(self.policy, actions, self.resources, context) == expected, context
+
+    def test_raw_policy(self):
+        matrix = allow_matrix(self.policy.document, ['myservice:GetProject'], self.resources)
+        assert matrix == [['Allow', 'Deny', 'Deny', 'Allow', 'Allow', 'Default']]
+
+    def test_empty(self):
+        assert allow_matrix(self.policy, [], self.resources) == []
+        assert allow_matrix(self.policy, ['myservice:GetProject'], []) == [[]]
+
+
+class TestReview(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = compile_policy({
+            'Statement': [{
+                'Action': 'myservice:*',
+                'Resource': 'arn:tinyauth:myservice:::rockets/*',
+                'Effect': 'Allow',
+            }, {
+                'Action': 'myservice:LaunchRocket',
+                'Resource': 'arn:tinyauth:myservice:::rockets/saturn-v',
+                'Effect': 'Deny',
+            }, {
+                'Action': 'myservice:LaunchRocket',
+                'Resource': 'arn:tinyauth:myservice:::rockets/thrift',
+                'Effect': 'Deny',
+                'Condition': {'IpAddress': {'SourceIp': '10.0.0.0/8'}},
+            }, {
+                'Action': 'myservice:FuelRocket',
+                'Resource': 'arn:tinyauth:myservice:::tankers/*',
+                'Effect': 'Allow',
+                'Condition': {'NumericEquals': {'Count': '1'}},
+            }],
+        })
+
+    def test_allow(self):
+        assert review(self.policy, 'myservice:LaunchRocket', 'arn:tinyauth:myservice:::rockets/thrift') == 'Allow'
+
+    def test_deny(self):
+        assert review(self.policy, 'myservice:LaunchRocket', 'arn:tinyauth:myservice:::rockets/saturn-v') == 'Deny'
+
+    def test_conditional(self):
+        # Conditions aren't evaluated, so unknown operators don't fail
+        assert review(self.policy, 'myservice:FuelRocket', 'arn:tinyauth:myservice:::tankers/one') == 'Conditional'
+
+    def test_default(self):
+        assert review(self.policy, 'otherservice:LaunchRocket', 'arn:tinyauth:myservice:::rockets/thrift') == 'Default'
+
+    def test_matrix(self):
+        actions = ['myservice:LaunchRocket', 'myservice:FuelRocket', 'otherservice:LaunchRocket']
+        resources = [
+            'arn:tinyauth:myservice:::rockets/thrift',
+            'arn:tinyauth:myservice:::rockets/saturn-v',
+            'arn:tinyauth:myservice:::tankers/one',
+        ]
+
+        expected = [[review(self.policy, action, r) for r in resources] for action in actions]
+        assert review_matrix(self.policy, actions, resources) == expected
@@ -0,0 +1,133 @@
+import datetime
+import json
+
+from tinyauth.app import db
+from tinyauth.models import Change
+
+from . import base
+
+
+class TestCase(base.TestCase):
+
+    def get_changes(self, query=''):
+        response = self.req('get', f'/api/v1/changes{query}')
+        assert response.status_code == 200
+        return json.loads(response.get_data(as_text=True))
+
+    def test_head(self):
+        Change.record('charles')
+        db.session.commit()
+
+        assert self.get_changes() == {'cursor': 1, 'changes': [], 'reset': False, 'more': False}
+
+    def test_policy_change(self):
+        cursor = self.get_changes()['cursor']
+
+        response = self.req('post', '/api/v1/users/freddy/policies', body={
+            'name': 'example1',
+            'policy': json.dumps({'Statement': [{'Action': '*', 'Resource': '*', 'Effect': 'Allow'}]}),
+        })
+        assert response.status_code == 200
+
+        changes = self.get_changes(f'?since={cursor}')
+        assert changes['changes'] == [{'user': 'freddy', 'access-key': None}]
+        assert changes['cursor'] > cursor
+
+        # Nothing new since then
+        assert self.get_changes(f'?since={changes["cursor"]}') == {
+            'cursor': changes['cursor'],
+            'changes': [],
+            'reset': False,
+            'more': False,
+        }
+
+    def test_access_key_change(self):
+        response = self.req('post', '/api/v1/users/freddy/keys')
+        assert response.status_code == 200
+        access_key_id = json.loads(response.get_data(as_text=True))['access_key_id']
+
+        response = self.req('delete', f'/api/v1/users/freddy/keys/{access_key_id}')
+        assert response.status_code == 201
+
+        assert self.get_changes('?since=0')['changes'] == [
+            {'user': 'freddy', 'access-key': access_key_id},
+            {'user': 'freddy', 'access-key': access_key_id},
+        ]
+
+    def test_rename_user(self):
+        response = self.req('put', '/api/v1/users/freddy', body={'username': 'frederick', 'password': 'password'})
+        assert response.status_code == 200
+
+        assert self.get_changes('?since=0')['changes'] == [
+            {'user': 'freddy', 'access-key': None},
+            {'user': 'frederick', 'access-key': None},
+            {'user': 'frederick', 'access-key': 'AKIDEXAMPLE2'},
+        ]
+
+    def test_limit(self):
+        for i in range(3):
+            Change.record(f'user{i}')
+        db.session.commit()
+
+        changes = self.get_changes('?since=0&limit=2')
+        assert changes['cursor'] == 2
+        assert changes['more'] is True
+        assert [change['user'] for change in changes['changes']] == ['user0', 'user1']
+
+        changes = self.get_changes('?since=2&limit=2')
+        assert changes['cursor'] == 3
+        assert changes['more'] is False
+
+    def test_cursor_waits_for_gap(self):
+        for i in range(3):
+            Change.record(f'user{i}')
+        db.session.commit()
+
+        # As if the transaction that inserted change 2 hadn't committed yet
+        Change.query.filter(Change.id == 2).delete()
+        db.session.commit()
+
+        changes = self.get_changes('?since=0')
+        assert changes['cursor'] == 1
+        assert changes['more'] is False
+        assert [change['user'] for change in changes['changes']] == ['user0', 'user2']
+
+    def test_cursor_skips_old_gap(self):
+        for i in range(3):
+            Change.record(f'user{i}')
+        db.session.commit()
+
+        Change.query.filter(Change.id == 2).delete()
+        Change.query.filter(Change.id == 3).update({'created': datetime.datetime.utcnow() - datetime.timedelta(hours=1)})
+        db.session.commit()
+
+        assert self.get_changes('?since=0')['cursor'] == 3
+
+    def test_reset_after_prune(self):
+        for i in range(3):
+            Change.record(f'user{i}')
+        db.session.commit()
+
+        Change.query.filter(Change.id < 3).delete()
+        db.session.commit()
+
+        assert self.get_changes('?since=0') == {'cursor': 3, 'changes': [], 'reset': True, 'more': False}
+        assert self.get_changes('?since=2')['reset'] is False
+
+    def test_reset_ahead_of_head(self):
+        assert self.get_changes('?since=10')['reset'] is True
+
+    def test_invalid_since(self):
+        response = self.req('get', '/api/v1/changes?since=yesterday')
+        assert response.status_code == 400
+
+    def test_no_auth(self):
+        response = self.client.get('/api/v1/changes')
+        assert response.status_code == 401
+
+    def test_created(self):
+        Change.record('charles')
+        db.session.commit()
+
+        change = Change.query.one()
+        assert change.created <= datetime.datetime.utcnow()
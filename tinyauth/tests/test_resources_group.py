@@ -2,7 +2,7 @@ import base64
 import json
 
 from tinyauth.app import db
-from tinyauth.models import Group
+from tinyauth.models import EffectivePolicy, Group, GroupPolicy
 
 from .base import TestCase
 
@@ -313,3 +313,29 @@ class TestGroupMembership(TestCase):
             'request.group': 'test-group',
             'request.username': 'charles',
         }
+
+    def test_membership_updates_effective_policy(self):
+        statement = {'Action': 'myservice:*', 'Resource': '*', 'Effect': 'Allow'}
+
+        group = Group.query.filter(Group.name == 'test-group').one()
+        db.session.add(GroupPolicy(name='myservice', group=group, policy={'Statement': [statement]}))
+        db.session.commit()
+
+        response = self.req('post', '/api/v1/groups/test-group/add-user', body={'user': 'charles'})
+        assert response.status_code == 200
+
+        effective = EffectivePolicy.query.filter(EffectivePolicy.user == self.user).one()
+        assert effective.policy['Statement'][0] == statement
+
+        response = self.req('delete', '/api/v1/groups/test-group/users/charles')
+        assert response.status_code == 201
+
+        effective = EffectivePolicy.query.filter(EffectivePolicy.user == self.user).one()
+        assert statement not in effective.policy['Statement']
+
+    def test_create_duplicate_group(self):
+        db.session.add(Group(name='devs'))
+        db.session.commit()
+
+        response = self.req('post', '/api/v1/groups', body={'name': 'devs'})
+        assert response.status_code == 409
@@ -1,6 +1,6 @@
 import json
 
-from tinyauth.models import Group, GroupPolicy, db
+from tinyauth.models import EffectivePolicy, Group, GroupPolicy, db
 
 from . import base
 
@@ -108,3 +108,22 @@ class TestCase(base.TestCase):
             'request.group': 'test-group',
             'request.policy': 'example1',
         }
+
+    def test_create_group_policy_updates_effective_policy(self):
+        group = Group.query.filter(Group.name == 'test-group').one()
+        group.users.append(self.user2)
+        db.session.commit()
+
+        statement = {'Action': 'myservice:*', 'Resource': '*', 'Effect': 'Allow'}
+
+        response = self.req('post', '/api/v1/groups/test-group/policies', body={
+            'name': 'example1',
+            'policy': json.dumps({'Statement': [statement]}),
+        })
+        assert response.status_code == 200
+
+        effective = EffectivePolicy.query.filter(EffectivePolicy.user == self.user2).one()
+        assert effective.policy == {'Statement': [statement]}
+
+        # Charles isn't in the group so shouldn't have been touched
+        assert EffectivePolicy.query.filter(EffectivePolicy.user == self.user).count() == 0
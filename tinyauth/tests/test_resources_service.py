@@ -1,8 +1,11 @@
 import base64
+import datetime
 import json
+from unittest import mock
 
 import jwt
 
+from tinyauth import authorize
 from tinyauth.app import db
 from tinyauth.audit import format_json
 from tinyauth.models import Group, GroupPolicy, UserPolicy
@@ -332,6 +335,158 @@ class TestCaseTokenProxied(base.TestProxyMixin, TestCaseToken):
     pass
 
 
+class TestCaseAuthorizeStream(base.TestCase):
+
+    def stream(self, lines, credentials=b'AKIDEXAMPLE:password'):
+        return self.client.post(
+            '/api/v1/authorize-stream',
+            data=b''.join(line + b'\n' for line in lines),
+            headers={'Authorization': 'Basic {}'.format(base64.b64encode(credentials).decode('utf-8'))},
+            content_type='application/x-ndjson',
+        )
+
+    def line(self, action, resource, credentials=b'AKIDEXAMPLE:password', **kwargs):
+        return json.dumps(dict({
+            'action': action,
+            'resource': resource,
+            'headers': [('Authorization', 'Basic {}'.format(base64.b64encode(credentials).decode('utf-8')))],
+        }, **kwargs)).encode('utf-8')
+
+    def test_authorize_stream(self):
+        identify = self.patch('tinyauth.authorize.identify', wraps=authorize.identify)
+
+        response = self.stream([
+            self.line('tinyauth:ListUsers', 'arn:tinyauth:tinyauth:::users/', region='europe', context={}),
+            b'',
+            b'not json',
+            self.line('myservice:LaunchRocket', 'arn:myservice:rockets/thrift', region='europe'),
+            self.line('tinyauth:ListUsers', 'arn:tinyauth:tinyauth:::users/', credentials=b'AKIDEXAMPLE:wrong'),
+            json.dumps({'action': 'tinyauth:ListUsers'}).encode('utf-8'),
+            self.line('tinyauth:ListGroups', 'arn:tinyauth:tinyauth:::groups/', region='europe'),
+        ])
+        assert response.status_code == 200
+        assert response.headers['Content-Type'] == 'application/x-ndjson'
+
+        results = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        assert [r['Authorized'] for r in results] == [True, False, False, False, False, True]
+        assert results[0]['Identity'] == 'charles'
+        assert results[1]['ErrorCode'] == 'InvalidRequest'
+        assert results[2]['ErrorCode'] == 'NotPermitted'
+        assert results[3]['ErrorCode'] == 'InvalidSignature'
+        assert results[4]['ErrorCode'] == 'InvalidRequest'
+
+        # The caller, charles for each service he used in europe and the
+        # wrong password. The last line reuses the identity from the first.
+        assert identify.call_count == 4
+
+        assert [args[0] for args, kwargs in self.audit_log.call_args_list] == ['AuthorizeStream', 'AuthorizeStreamEnded']
+        args, kwargs = self.audit_log.call_args_list[-1]
+        assert kwargs['extra'] == {
+            'request-id': 'a823a206-95a0-4666-b464-93b9f0606d7b',
+            'response.count': 6,
+            'response.authorized-count': 2,
+            'response.invalid-count': 2,
+            'response.error-count': 0,
+        }
+
+    def test_invalid_fields(self):
+        response = self.stream([
+            self.line('tinyauth:ListUsers', 'arn:tinyauth:tinyauth:::users/', headers=[[1]]),
+            self.line('tinyauth:ListUsers', 'arn:tinyauth:tinyauth:::users/', headers=[['Authorization']]),
+            self.line('tinyauth:ListUsers', 'arn:tinyauth:tinyauth:::users/', region=5),
+            self.line('tinyauth:ListUsers', 'arn:tinyauth:tinyauth:::users/'),
+        ])
+        assert response.status_code == 200
+
+        results = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        assert [r.get('ErrorCode') for r in results] == ['InvalidRequest', 'InvalidRequest', 'InvalidRequest', None]
+
+    def test_error_does_not_end_stream(self):
+        authorize = mock.Mock(side_effect=[RuntimeError('boom'), {'Authorized': True, 'Identity': 'charles'}])
+        self.patch('tinyauth.resources.service.external_authorizer', return_value=authorize)
+        self.patch('tinyauth.resources.service.error_logger')
+
+        response = self.stream([
+            self.line('tinyauth:ListUsers', 'arn:tinyauth:tinyauth:::users/', region='europe'),
+            self.line('tinyauth:ListUsers', 'arn:tinyauth:tinyauth:::users/', region='asia'),
+        ])
+        assert response.status_code == 200
+
+        results = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        assert results == [
+            {'Authorized': False, 'ErrorCode': 'InternalError', 'Status': 500},
+            {'Authorized': True, 'Identity': 'charles'},
+        ]
+
+        args, kwargs = self.audit_log.call_args_list[-1]
+        assert kwargs['extra']['response.error-count'] == 1
+
+    def test_unauthenticated(self):
+        response = self.stream([self.line('tinyauth:ListUsers', 'arn:tinyauth:tinyauth:::users/')], credentials=b'AKIDEXAMPLE:wrong')
+        assert response.status_code == 401
+
+
+class TestCaseFilterResources(base.TestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        db.session.add(UserPolicy(name='myserver', user=self.user, policy={
+            'Version': '2012-10-17',
+            'Statement': [{
+                'Action': 'myservice:ListProjects',
+                'Resource': 'arn:myservice:projects/*',
+                'Effect': 'Allow',
+            }, {
+                'Action': 'myservice:ListProjects',
+                'Resource': 'arn:myservice:projects/secret',
+                'Effect': 'Deny',
+            }]
+        }))
+        db.session.commit()
+
+    def filter(self, resources, credentials=b'AKIDEXAMPLE:password'):
+        return self.req('post', '/api/v1/services/myservice/filter-resources-by-token', body={
+            'region': 'europe',
+            'action': 'ListProjects',
+            'resources': resources,
+            'headers': [('Authorization', 'Basic {}'.format(base64.b64encode(credentials).decode('utf-8')))],
+            'context': {},
+        })
+
+    def test_filter_resources(self):
+        response = self.filter([f'arn:myservice:projects/{i}' for i in range(5)] + ['arn:myservice:projects/secret', 'arn:myservice:other'])
+        assert response.status_code == 200
+        assert json.loads(response.get_data(as_text=True)) == {
+            'Identity': 'charles',
+            'Allowed': [f'arn:myservice:projects/{i}' for i in range(5)],
+        }
+
+        args, kwargs = self.audit_log.call_args_list[-1]
+        assert args[0] == 'FilterResourcesByToken'
+        assert kwargs['extra']['request.resource-count'] == 7
+        assert kwargs['extra']['response.allowed-count'] == 5
+        assert kwargs['extra']['response.identity'] == 'charles'
+
+    def test_invalid_signature(self):
+        response = self.filter(['arn:myservice:projects/1'], credentials=b'AKIDEXAMPLE:wrong')
+        assert response.status_code == 200
+        assert json.loads(response.get_data(as_text=True)) == {
+            'Authorized': False,
+            'ErrorCode': 'InvalidSignature',
+            'Status': 401,
+            'Allowed': [],
+        }
+
+    def test_too_many_resources(self):
+        response = self.filter(['arn:myservice:projects/1'] * 50001)
+        assert response.status_code == 400
+
+    def test_resources_must_be_strings(self):
+        response = self.filter([{'arn': 'arn:myservice:projects/1'}])
+        assert response.status_code == 400
+
+
 class TestCaseBatchToken(base.TestCase):
 
     def test_invalid_outer_auth(self):
@@ -754,8 +909,11 @@ class TestCaseBatchTokenProxied(base.TestProxyMixin, TestCaseBatchToken):
             }
 
             # This asserts that the first call to authorize hits the upstream tinyauth
-            # It also asserts that the next 4 do not, thus proving caching works
-            assert len(self.app.auth_backend.session.get.call_args_list) == 4
+            # It also asserts that the next 4 do not, thus proving caching works.
+            # The outer and inner identities each cost one identity bundle
+            # request, which fills both the key and policy caches.
+            assert len(self.app.auth_backend.session.post.call_args_list) == 2
+            assert len(self.app.auth_backend.session.get.call_args_list) == 0
 
         args, kwargs = self.audit_log.call_args_list[-1]
         assert args[0] == 'AuthorizeByToken'
@@ -778,6 +936,182 @@ class TestCaseBatchTokenProxied(base.TestProxyMixin, TestCaseBatchToken):
         }
 
 
+class TestCaseBatchTokenIdentifiesOnce(base.TestCase):
+
+    def test_authorize_service_identifies_once(self):
+        with self.backend.app_context():
+            policy = UserPolicy(name='myserver', user=self.user, policy={
+                'Version': '2012-10-17',
+                'Statement': [{
+                    'Action': 'myservice:LaunchRocket',
+                    'Resource': '*',
+                    'Effect': 'Allow',
+                }]
+            })
+            db.session.add(policy)
+
+            db.session.commit()
+
+        identify = self.patch('tinyauth.authorize.identify', wraps=authorize.identify)
+        get_compiled_policies = self.patch_object(
+            self.app.auth_backend,
+            'get_compiled_policies',
+            wraps=self.app.auth_backend.get_compiled_policies,
+        )
+
+        response = self.client.post(
+            '/api/v1/services/myservice/authorize-by-token',
+            data=json.dumps({
+                'region': 'europe',
+                'permit': {
+                    'LaunchRocket': ['arn:myservice:rockets/thrift', 'arn:myservice:rockets/falcon'],
+                    'LandRocket': ['arn:myservice:rockets/thrift'],
+                },
+                'headers': [
+                    ('Authorization', 'Basic {}'.format(
+                        base64.b64encode(b'AKIDEXAMPLE:password').decode('utf-8')))
+                ],
+                'context': {},
+            }),
+            headers={
+                'Authorization': 'Basic {}'.format(
+                    base64.b64encode(b'AKIDEXAMPLE:password').decode('utf-8')
+                )
+            },
+            content_type='application/json',
+        )
+        assert response.status_code == 200
+        assert json.loads(response.get_data(as_text=True)) == {
+            'Authorized': False,
+            'ErrorCode': 'NotPermitted',
+            'Permitted': {'LaunchRocket': ['arn:myservice:rockets/thrift', 'arn:myservice:rockets/falcon']},
+            'NotPermitted': {'LandRocket': ['arn:myservice:rockets/thrift']},
+        }
+
+        # Once for the caller and once for the request being authorized
+        assert identify.call_count == 2
+        assert get_compiled_policies.call_count == 2
+
+
+class TestCaseBulkToken(base.TestCase):
+
+    def basic_auth(self, credentials):
+        return [('Authorization', 'Basic {}'.format(base64.b64encode(credentials).decode('utf-8')))]
+
+    def test_bulk_authorize(self):
+        db.session.add(UserPolicy(name='myserver', user=self.user, policy={
+            'Version': '2012-10-17',
+            'Statement': [{
+                'Action': 'myservice:LaunchRocket',
+                'Resource': '*',
+                'Effect': 'Allow',
+            }]
+        }))
+        db.session.commit()
+
+        identify = self.patch('tinyauth.authorize.identify', wraps=authorize.identify)
+        get_compiled_policies = self.patch_object(
+            self.app.auth_backend,
+            'get_compiled_policies',
+            wraps=self.app.auth_backend.get_compiled_policies,
+        )
+
+        charles = self.basic_auth(b'AKIDEXAMPLE:password')
+        response = self.req('post', '/api/v1/services/myservice/bulk-authorize-by-token', body={
+            'region': 'europe',
+            'requests': [{
+                'permit': {'LaunchRocket': ['arn:myservice:rockets/thrift']},
+                'headers': charles,
+                'context': {},
+            }, {
+                'permit': {'LaunchRocket': ['arn:myservice:rockets/thrift']},
+                'headers': self.basic_auth(b'AKIDEXAMPLE2:password'),
+            }, {
+                'permit': {'LaunchRocket': ['arn:myservice:rockets/thrift']},
+                'headers': self.basic_auth(b'AKIDEXAMPLE:wrong'),
+            }, {
+                'region': 'asia',
+                'permit': {'LaunchRocket': ['arn:myservice:rockets/falcon'], 'LandRocket': ['arn:myservice:rockets/falcon']},
+                'headers': charles,
+            }, {
+                'permit': {'LaunchRocket': ['arn:myservice:rockets/heavy']},
+                'headers': charles,
+            }],
+        })
+        assert response.status_code == 200
+        assert json.loads(response.get_data(as_text=True)) == {'Results': [{
+            'Authorized': True,
+            'Identity': 'charles',
+            'Permitted': {'LaunchRocket': ['arn:myservice:rockets/thrift']},
+            'NotPermitted': {},
+        }, {
+            'Authorized': False,
+            'ErrorCode': 'NotPermitted',
+            'Permitted': {},
+            'NotPermitted': {'LaunchRocket': ['arn:myservice:rockets/thrift']},
+        }, {
+            'Authorized': False,
+            'ErrorCode': 'InvalidSignature',
+            'Permitted': {},
+            'NotPermitted': {'LaunchRocket': ['arn:myservice:rockets/thrift']},
+        }, {
+            'Authorized': False,
+            'ErrorCode': 'NotPermitted',
+            'Permitted': {'LaunchRocket': ['arn:myservice:rockets/falcon']},
+            'NotPermitted': {'LandRocket': ['arn:myservice:rockets/falcon']},
+        }, {
+            'Authorized': True,
+            'Identity': 'charles',
+            'Permitted': {'LaunchRocket': ['arn:myservice:rockets/heavy']},
+            'NotPermitted': {},
+        }]}
+
+        # The caller, then each distinct region and set of headers once
+        assert identify.call_count == 5
+        # The caller, then charles in europe and asia and freddy
+        assert get_compiled_policies.call_count == 4
+
+        args, kwargs = self.audit_log.call_args_list[-1]
+        assert args[0] == 'BulkAuthorizeByToken'
+        assert kwargs['extra'] == {
+            'request-id': 'a823a206-95a0-4666-b464-93b9f0606d7b',
+            'http.status': 200,
+            'request.service': 'myservice',
+            'request.region': 'europe',
+            'request.count': 5,
+            'response.authorized-count': 2,
+            'response.identities': ['charles'],
+        }
+
+    def test_invalid_request(self):
+        response = self.req('post', '/api/v1/services/myservice/bulk-authorize-by-token', body={
+            'requests': [{
+                'permit': {'LaunchRocket': 'arn:myservice:rockets/thrift'},
+                'headers': [],
+            }],
+        })
+        assert response.status_code == 400
+
+    def test_invalid_fields(self):
+        for entry in (
+            {'permit': {'LaunchRocket': [1]}, 'headers': []},
+            {'permit': {'LaunchRocket': ['arn:myservice:rockets/thrift']}, 'headers': [[1]]},
+            {'permit': {'LaunchRocket': ['arn:myservice:rockets/thrift']}, 'headers': [['Authorization']]},
+            {'permit': {'LaunchRocket': ['arn:myservice:rockets/thrift']}, 'headers': [], 'region': 5},
+        ):
+            response = self.req('post', '/api/v1/services/myservice/bulk-authorize-by-token', body={
+                'requests': [{'permit': {}, 'headers': []}, entry],
+            })
+            assert response.status_code == 400, entry
+            assert 'requests[1]: ' in response.get_data(as_text=True), entry
+
+    def test_too_many_requests(self):
+        response = self.req('post', '/api/v1/services/myservice/bulk-authorize-by-token', body={
+            'requests': [{'permit': {}, 'headers': []}] * 501,
+        })
+        assert response.status_code == 400
+
+
 class TestCaseLogin(base.TestCase):
 
     def test_authorize_service(self):
@@ -1010,6 +1344,22 @@ class TestGetServiceUserSigningToken(base.TestCase):
             'request.protocol': 'jwt',
         }
 
+    def test_not_modified(self):
+        uri = '/api/v1/regions/europe/services/myservice/user-signing-tokens/charles/jwt/20170316'
+
+        response = self.req('get', uri)
+        assert response.status_code == 200
+        etag = response.headers['ETag']
+
+        response = self.req('get', uri, headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.get_data() == b''
+        assert 'Expires' in response.headers
+        assert response.headers['ETag'] == etag
+
+        response = self.req('get', uri, headers={'If-None-Match': '"stale"'})
+        assert response.status_code == 200
+
 
 class TestGetServiceAccessKeySigningToken(base.TestCase):
 
@@ -1045,6 +1395,22 @@ class TestGetServiceAccessKeySigningToken(base.TestCase):
             'request.protocol': 'basic-auth',
         }
 
+    def test_not_modified(self):
+        uri = '/api/v1/regions/europe/services/myservice/access-key-signing-tokens/AKIDEXAMPLE/basic-auth/20170316'
+
+        response = self.req('get', uri)
+        assert response.status_code == 200
+        etag = response.headers['ETag']
+
+        response = self.req('get', uri, headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.get_data() == b''
+        assert 'Expires' in response.headers
+        assert response.headers['ETag'] == etag
+
+        response = self.req('get', uri, headers={'If-None-Match': '"stale"'})
+        assert response.status_code == 200
+
 
 class TestGetServiceUserPolicies(base.TestCase):
 
@@ -1076,3 +1442,170 @@ class TestGetServiceUserPolicies(base.TestCase):
             'request.service': 'myservice',
             'request.user': 'charles',
         }
+
+    def test_not_modified(self):
+        uri = '/api/v1/regions/europe/services/myservice/user-policies/charles'
+
+        response = self.req('get', uri)
+        assert response.status_code == 200
+        etag = response.headers['ETag']
+
+        response = self.req('get', uri, headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.get_data() == b''
+        assert 'Expires' in response.headers
+        assert response.headers['ETag'] == etag
+
+        response = self.req('get', uri, headers={'If-None-Match': '"stale"'})
+        assert response.status_code == 200
+
+
+class TestGetServiceUserPoliciesFiltered(base.TestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        db.session.add(UserPolicy(name='myservice', user=self.user, policy={
+            'Statement': [{
+                'Action': 'myservice:*',
+                'Resource': 'arn:tinyauth:myservice:europe::rockets/*',
+                'Effect': 'Allow',
+            }, {
+                'Action': 'myservice:*',
+                'Resource': 'arn:tinyauth:myservice:asia::rockets/*',
+                'Effect': 'Allow',
+            }, {
+                'Action': 'myservice:*',
+                'Resource': 'arn:tinyauth:myservice:asia::rockets/saturn-v',
+                'Effect': 'Deny',
+            }],
+        }))
+        db.session.commit()
+
+    def get_policies(self, query=''):
+        response = self.req('get', f'/api/v1/regions/europe/services/myservice/user-policies/charles{query}')
+        assert response.status_code == 200
+        return json.loads(response.get_data(as_text=True))
+
+    def test_filtered_by_service(self):
+        statements = self.get_policies()['Statement']
+        assert [s['Resource'] for s in statements] == [
+            'arn:tinyauth:myservice:europe::rockets/*',
+            'arn:tinyauth:myservice:asia::rockets/*',
+            'arn:tinyauth:myservice:asia::rockets/saturn-v',
+        ]
+
+    def test_filtered_by_region(self):
+        statements = self.get_policies('?region-scoped=true')['Statement']
+        assert [s['Resource'] for s in statements] == [
+            'arn:tinyauth:myservice:europe::rockets/*',
+            'arn:tinyauth:myservice:asia::rockets/saturn-v',
+        ]
+
+        args, kwargs = self.audit_log.call_args_list[-1]
+        assert kwargs['extra']['request.region-scoped'] is True
+
+
+class TestGetServiceIdentityBundles(base.TestCase):
+
+    def test_get_identity_bundles(self):
+        response = self.req('post', '/api/v1/regions/europe/services/myservice/identity-bundles', body={
+            'protocol': 'jwt',
+            'date': '20170316',
+            'access-keys': ['AKIDEXAMPLE', 'AKIDUNKNOWN'],
+            'users': ['freddy'],
+        })
+        assert response.status_code == 200
+        assert response.headers['Cache-Control'] == 'max-age=60'
+
+        payload = json.loads(response.get_data(as_text=True))
+        assert payload['key-max-age'] == 60 * 60 * 24 * 3
+        assert payload['policy-max-age'] == 60
+
+        date = datetime.date(2017, 3, 16)
+        access_key = self.app.auth_backend.get_access_key('jwt', 'europe', 'myservice', date, 'AKIDEXAMPLE')
+        user_key = self.app.auth_backend.get_user_key('jwt', 'europe', 'myservice', date, 'freddy')
+
+        assert payload['access-keys'] == {
+            'AKIDEXAMPLE': {
+                'key': base64.b64encode(access_key['key']).decode('utf-8'),
+                'identity': 'charles',
+                # Only statements for myservice, and charles only has tinyauth ones
+                'policy': {'Statement': []},
+            },
+            'AKIDUNKNOWN': None,
+        }
+        assert payload['users'] == {
+            'freddy': {
+                'key': base64.b64encode(user_key['key']).decode('utf-8'),
+                'identity': 'freddy',
+                'policy': {'Statement': []},
+            },
+        }
+
+        args, kwargs = self.audit_log.call_args_list[0]
+        assert args[0] == 'GetServiceIdentityBundles'
+        assert kwargs['extra'] == {
+            'request-id': 'a823a206-95a0-4666-b464-93b9f0606d7b',
+            'http.status': 200,
+            'request.region': 'europe',
+            'request.service': 'myservice',
+            'request.protocol': 'jwt',
+            'request.date': '20170316',
+            'request.access-keys': ['AKIDEXAMPLE', 'AKIDUNKNOWN'],
+            'request.users': ['freddy'],
+        }
+
+    def test_too_many_identities(self):
+        response = self.req('post', '/api/v1/regions/europe/services/myservice/identity-bundles', body={
+            'protocol': 'basic-auth',
+            'date': '20170316',
+            'access-keys': [f'AKID{i}' for i in range(101)],
+        })
+        assert response.status_code == 400
+
+    def test_invalid_identities(self):
+        for body in ({'access-keys': ['AKIDEXAMPLE', {'id': 'AKIDEXAMPLE'}]}, {'users': [['freddy']]}):
+            response = self.req('post', '/api/v1/regions/europe/services/myservice/identity-bundles', body=dict({
+                'protocol': 'jwt',
+                'date': '20170316',
+            }, **body))
+            assert response.status_code == 400
+
+        assert json.loads(response.get_data(as_text=True)) == {'message': 'users[0]: must be a string'}
+
+    def test_unknown_protocol(self):
+        response = self.req('post', '/api/v1/regions/europe/services/myservice/identity-bundles', body={
+            'protocol': 'carrier-pigeon',
+            'date': '20170316',
+            'users': ['freddy'],
+        })
+        assert response.status_code == 400
+
+    def test_user_keys_need_jwt(self):
+        response = self.req('post', '/api/v1/regions/europe/services/myservice/identity-bundles', body={
+            'protocol': 'basic-auth',
+            'date': '20170316',
+            'users': ['freddy'],
+        })
+        assert response.status_code == 400
+
+    def test_invalid_date(self):
+        response = self.req('post', '/api/v1/regions/europe/services/myservice/identity-bundles', body={
+            'protocol': 'jwt',
+            'date': 'tuesday',
+            'users': ['freddy'],
+        })
+        assert response.status_code == 400
+
+    def test_no_auth(self):
+        response = self.client.post(
+            '/api/v1/regions/europe/services/myservice/identity-bundles',
+            data=json.dumps({
+                'protocol': 'jwt',
+                'date': '20170316',
+                'users': ['freddy'],
+            }),
+            content_type='application/json',
+        )
+        assert response.status_code == 401
@@ -0,0 +1,42 @@
+import base64
+
+from tinyauth import snapshot
+
+from . import base
+
+
+class TestGetServiceSnapshot(base.TestCase):
+
+    def test_export(self):
+        response = self.req('get', '/api/v1/regions/europe/services/myservice/snapshot?start=20170101&end=20170102')
+        assert response.status_code == 200
+        assert response.headers['Content-Type'] == 'application/octet-stream'
+
+        body = snapshot.loads(response.get_data())
+        assert body['region'] == 'europe'
+        assert body['service'] == 'myservice'
+        assert body['dates'] == ['20170101', '20170102']
+        assert sorted(body['access-keys']) == ['AKIDEXAMPLE', 'AKIDEXAMPLE2']
+
+        self.audit_log.assert_called_once()
+        args, kwargs = self.audit_log.call_args
+        assert kwargs['extra']['request.start'] == '20170101'
+        assert kwargs['extra']['request.end'] == '20170102'
+
+    def test_invalid_range(self):
+        response = self.req('get', '/api/v1/regions/europe/services/myservice/snapshot?start=20170102&end=20170101')
+        assert response.status_code == 400
+
+    def test_unauthenticated(self):
+        response = self.client.get(
+            '/api/v1/regions/europe/services/myservice/snapshot',
+            headers={'Authorization': 'Basic {}'.format(base64.b64encode(b'AKIDEXAMPLE:wrong').decode('utf-8'))},
+        )
+        assert response.status_code == 401
+
+    def test_not_permitted(self):
+        response = self.client.get(
+            '/api/v1/regions/europe/services/myservice/snapshot',
+            headers={'Authorization': 'Basic {}'.format(base64.b64encode(b'AKIDEXAMPLE2:password').decode('utf-8'))},
+        )
+        assert response.status_code == 403
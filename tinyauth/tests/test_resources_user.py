@@ -1,9 +1,6 @@
 import base64
 import json
 
-from tinyauth.app import db
-from tinyauth.models import User
-
 from .base import TestCase
 
 
@@ -114,11 +111,6 @@ class TestCase(TestCase):
         }
 
     def test_delete_user_with_auth(self):
-        user = User(username='freddy')
-        db.session.add(user)
-
-        db.session.commit()
-
         response = self.client.delete(
             '/api/v1/users/freddy',
             headers={
@@ -172,11 +164,6 @@ class TestCase(TestCase):
         }
 
     def test_put_user_with_auth(self):
-        user = User(username='freddy')
-        db.session.add(user)
-
-        db.session.commit()
-
         response = self.client.put(
             '/api/v1/users/freddy',
             data=json.dumps({
@@ -234,11 +221,6 @@ class TestCase(TestCase):
         }
 
     def test_get_user_with_auth(self):
-        user = User(username='freddy')
-        db.session.add(user)
-
-        db.session.commit()
-
         response = self.client.get(
             '/api/v1/users/freddy',
             headers={
@@ -308,3 +290,11 @@ class TestCase(TestCase):
             'http.status': 404,
             'request.username': 'james',
         }
+
+    def test_create_duplicate_user(self):
+        response = self.req('post', '/api/v1/users', body={'username': 'freddy'})
+        assert response.status_code == 409
+
+    def test_rename_user_to_existing_name(self):
+        response = self.req('put', '/api/v1/users/freddy', body={'username': 'charles'})
+        assert response.status_code == 409
@@ -1,5 +1,7 @@
 import json
 
+from tinyauth.models import EffectivePolicy, PolicyVersion, hash_policy
+
 from . import base
 
 
@@ -109,3 +111,56 @@ class TestCase(base.TestCase):
             'request.username': 'charles',
             'request.policy': 'example1',
         }
+
+    def test_create_user_policy_with_invalid_action(self):
+        response = self.req('post', '/api/v1/users/freddy/policies', body={
+            'name': 'example1',
+            'policy': json.dumps({'Statement': [{'Action': 5, 'Resource': '*', 'Effect': 'Allow'}]}),
+        })
+        assert response.status_code == 200
+
+        response = self.req('post', '/api/v1/users/freddy/policies', body={
+            'name': 'example2',
+            'policy': json.dumps({'Statement': [{'Action': 'myservice:*', 'Resource': '*', 'Effect': 'Allow'}]}),
+        })
+        assert response.status_code == 200
+
+    def test_create_user_policy_updates_effective_policy(self):
+        statement = {'Action': 'myservice:*', 'Resource': '*', 'Effect': 'Allow'}
+
+        response = self.req('post', '/api/v1/users/charles/policies', body={
+            'name': 'example1',
+            'policy': json.dumps({'Statement': [statement]}),
+        })
+        assert response.status_code == 200
+
+        effective = EffectivePolicy.query.filter(EffectivePolicy.user == self.user).one()
+        assert effective.policy['Statement'][-1] == statement
+        assert effective.hash == hash_policy(effective.policy)
+
+        response = self.req('delete', '/api/v1/users/charles/policies/example1')
+        assert response.status_code == 201
+
+        effective = EffectivePolicy.query.filter(EffectivePolicy.user == self.user).one()
+        assert statement not in effective.policy['Statement']
+
+    def test_policy_version_locked_before_refresh(self):
+        calls = []
+        self.patch_object(PolicyVersion, 'bump', side_effect=lambda: calls.append('bump'))
+        self.patch_object(EffectivePolicy, 'refresh', side_effect=lambda user_ids: calls.append('refresh'))
+
+        response = self.req('post', '/api/v1/users/charles/policies', body={
+            'name': 'example1',
+            'policy': json.dumps({'Statement': []}),
+        })
+        assert response.status_code == 200
+
+        # The bump's row lock is what serializes concurrent merges
+        assert calls == ['bump', 'refresh']
+
+    def test_create_duplicate_user_policy(self):
+        response = self.req('post', '/api/v1/users/charles/policies', body={
+            'name': 'tinyauth',
+            'policy': json.dumps({'Statement': []}),
+        })
+        assert response.status_code == 409
@@ -0,0 +1,126 @@
+import base64
+import json
+
+from tinyauth.app import db
+from tinyauth.models import (
+    EffectivePolicy,
+    Group,
+    GroupPolicy,
+    PolicyIndex,
+    UserPolicy,
+)
+
+from . import base
+
+
+class TestCase(base.TestCase):
+
+    def setUp(self):
+        super().setUp()
+
+        group = Group(name='launchers')
+        db.session.add(group)
+
+        db.session.add(GroupPolicy(name='launch', group=group, policy={
+            'Statement': [{
+                'Action': 'myservice:Launch*',
+                'Resource': 'arn:tinyauth:myservice:::rockets/*',
+                'Effect': 'Allow',
+            }, {
+                'Action': 'myservice:LaunchRocket',
+                'Resource': 'arn:tinyauth:myservice:::rockets/saturn-v',
+                'Effect': 'Deny',
+            }],
+        }))
+
+        db.session.commit()
+
+    def who_can(self, action, resource):
+        response = self.req('get', f'/api/v1/who-can?action={action}&resource={resource}')
+        assert response.status_code == 200
+        return json.loads(response.get_data(as_text=True))
+
+    def test_who_can(self):
+        # Charles has no effective policy yet, so isn't in the index
+        assert self.who_can('tinyauth:DeleteUser', 'arn:tinyauth:tinyauth:::users/freddy') == {
+            'Users': ['charles'],
+            'ConditionalUsers': [],
+        }
+
+        args = self.audit_log.call_args[1]['extra']
+        assert args['request.action'] == 'tinyauth:DeleteUser'
+        assert args['response.count'] == 1
+
+    def test_group_membership(self):
+        response = self.req('post', '/api/v1/groups/launchers/add-user', body={'user': 'freddy'})
+        assert response.status_code == 200
+
+        assert self.who_can('myservice:LaunchRocket', 'arn:tinyauth:myservice:::rockets/thrift')['Users'] == ['freddy']
+        assert self.who_can('myservice:LaunchRocket', 'arn:tinyauth:myservice:::rockets/saturn-v')['Users'] == []
+
+        response = self.req('delete', '/api/v1/groups/launchers/users/freddy')
+        assert response.status_code == 201
+
+        assert self.who_can('myservice:LaunchRocket', 'arn:tinyauth:myservice:::rockets/thrift')['Users'] == []
+
+    def test_group_policy_change(self):
+        response = self.req('post', '/api/v1/groups/launchers/add-user', body={'user': 'freddy'})
+        assert response.status_code == 200
+
+        response = self.req('put', '/api/v1/groups/launchers/policies/launch', body={
+            'name': 'launch',
+            'policy': json.dumps({
+                'Statement': [{
+                    'Action': 'myservice:Fuel*',
+                    'Resource': 'arn:tinyauth:myservice:::rockets/*',
+                    'Effect': 'Allow',
+                }],
+            }),
+        })
+        assert response.status_code == 200
+
+        assert self.who_can('myservice:LaunchRocket', 'arn:tinyauth:myservice:::rockets/thrift')['Users'] == []
+        assert self.who_can('myservice:FuelRocket', 'arn:tinyauth:myservice:::rockets/thrift')['Users'] == ['freddy']
+
+    def test_conditional(self):
+        response = self.req('post', '/api/v1/users/freddy/policies', body={
+            'name': 'office',
+            'policy': json.dumps({
+                'Statement': [{
+                    'Action': 'tinyauth:DeleteUser',
+                    'Resource': 'arn:tinyauth:tinyauth:::users/*',
+                    'Effect': 'Allow',
+                    'Condition': {'IpAddress': {'SourceIp': '10.0.0.0/8'}},
+                }],
+            }),
+        })
+        assert response.status_code == 200
+
+        assert self.who_can('tinyauth:DeleteUser', 'arn:tinyauth:tinyauth:::users/charles') == {
+            'Users': ['charles'],
+            'ConditionalUsers': ['freddy'],
+        }
+
+    def test_only_candidates_are_loaded(self):
+        db.session.add(UserPolicy(name='other', user=self.user2, policy={
+            'Statement': [{'Action': 'otherservice:*', 'Resource': '*', 'Effect': 'Allow'}],
+        }))
+        EffectivePolicy.refresh([self.user.id, self.user2.id])
+        db.session.commit()
+
+        assert PolicyIndex.candidates('tinyauth:DeleteUser') == {self.user.id}
+        assert PolicyIndex.candidates('otherservice:DeleteUser') == {self.user2.id}
+        assert PolicyIndex.candidates('myservice:LaunchRocket') == set()
+
+        assert PolicyIndex.who_can('otherservice:DeleteUser', 'arn:tinyauth:otherservice:::users/charles') == (['freddy'], [])
+
+    def test_missing_arguments(self):
+        response = self.req('get', '/api/v1/who-can?action=tinyauth:DeleteUser')
+        assert response.status_code == 400
+
+    def test_not_permitted(self):
+        response = self.client.get(
+            '/api/v1/who-can?action=tinyauth:DeleteUser&resource=arn:tinyauth:tinyauth:::users/charles',
+            headers={'Authorization': 'Basic {}'.format(base64.b64encode(b'AKIDEXAMPLE2:password').decode('utf-8'))},
+        )
+        assert response.status_code == 403
@@ -0,0 +1,66 @@
+import base64
+import datetime
+
+import pytest
+
+from tinyauth import snapshot
+from tinyauth.subkey import make_basic_auth_key, make_jwt_key
+
+from . import base
+
+
+class TestSnapshot(base.TestCase):
+
+    def test_date_range(self):
+        assert snapshot.date_range('20170101', '20170103') == [
+            datetime.date(2017, 1, 1),
+            datetime.date(2017, 1, 2),
+            datetime.date(2017, 1, 3),
+        ]
+
+    def test_date_range_default(self):
+        dates = snapshot.date_range()
+        assert dates[0] == datetime.datetime.utcnow().date()
+        assert len(dates) == snapshot.DEFAULT_SNAPSHOT_DAYS
+
+    def test_date_range_invalid(self):
+        with pytest.raises(ValueError):
+            snapshot.date_range('20170103', '20170101')
+        with pytest.raises(ValueError):
+            snapshot.date_range('20170101', '20170301')
+        with pytest.raises(ValueError):
+            snapshot.date_range('2017-01-01')
+
+    def test_build(self):
+        date = datetime.date(2017, 1, 1)
+        body = snapshot.build('europe', 'myservice', [date], 'signing-key')
+
+        assert body['dates'] == ['20170101']
+        assert sorted(body['policies']) == ['charles', 'freddy']
+        assert body['policies']['charles']['Statement'][0]['Action'] == 'tinyauth:*'
+        assert body['policies']['freddy'] == {'Statement': []}
+
+        assert base64.b64decode(body['users']['charles']['jwt']['20170101']) == make_jwt_key(
+            'europe', 'myservice', date, 'charles', 'signing-key',
+        )
+
+        access_key = body['access-keys']['AKIDEXAMPLE']
+        assert access_key['identity'] == 'charles'
+        assert base64.b64decode(access_key['basic-auth']['20170101']) == make_basic_auth_key(
+            'europe', 'myservice', date, 'AKIDEXAMPLE', 'password',
+        )
+
+    def test_roundtrip(self):
+        body = snapshot.build('europe', 'myservice', [datetime.date(2017, 1, 1)], 'signing-key')
+        assert snapshot.loads(snapshot.dumps(body)) == body
+
+    def test_corrupt(self):
+        data = bytearray(snapshot.dumps(snapshot.build('europe', 'myservice', [datetime.date(2017, 1, 1)], 'signing-key')))
+        data[-10] ^= 1
+
+        with pytest.raises(snapshot.InvalidSnapshot):
+            snapshot.loads(bytes(data))
+
+    def test_not_a_snapshot(self):
+        with pytest.raises(snapshot.InvalidSnapshot):
+            snapshot.loads(b'{}')
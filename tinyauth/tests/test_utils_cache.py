@@ -1,9 +1,12 @@
+import contextlib
 import datetime
+import threading
+import time
 import unittest
 import uuid
 from unittest import mock
 
-from tinyauth.utils.cache import cache
+from tinyauth.utils.cache import Cache, Refresher, cache
 
 
 class TestCacheDecorator(unittest.TestCase):
@@ -96,3 +99,341 @@ class TestCacheDecorator(unittest.TestCase):
         assert result3 != result5
 
         assert len(callable.call_args_list) == 3
+
+    def test_hit_refreshes_lru_position(self):
+        expires = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+        callable = mock.Mock()
+        callable.side_effect = lambda *args: (expires, uuid.uuid4())
+
+        fn = cache(max_size=2)(callable)
+        result1 = fn('key1')
+        fn('key2')
+        assert fn('key1') == result1
+
+        # key2 is the least recently used entry, so it is the one evicted
+        fn('key3')
+        assert fn('key1') == result1
+        assert len(callable.call_args_list) == 3
+
+        fn('key2')
+        assert len(callable.call_args_list) == 4
+
+    def test_stats(self):
+        callable = mock.Mock()
+        fn = cache(max_size=1)(callable)
+
+        callable.side_effect = lambda *args: (datetime.datetime.utcnow() + datetime.timedelta(hours=1), uuid.uuid4())
+        fn('key1')
+        fn('key1')
+        fn('key2')
+
+        callable.side_effect = lambda *args: (datetime.datetime.utcnow() - datetime.timedelta(hours=1), uuid.uuid4())
+        fn('key3')
+
+        callable.side_effect = RuntimeError('Temporary error')
+        fn('key3')
+
+        assert fn.cache.stats() == {
+            'size': 1,
+            'hits': 1,
+            'misses': 4,
+            'evictions': 2,
+            'expirations': 0,
+            'stale': 1,
+            'coalesced': 0,
+            'refreshes': 0,
+        }
+
+
+class TestCache(unittest.TestCase):
+
+    def test_get_missing(self):
+        c = Cache()
+        self.assertRaises(KeyError, c.get, 'key')
+
+    def test_no_expiry(self):
+        c = Cache()
+        c.set('key', 'value', None)
+        assert c.get('key') == (False, 'value')
+
+    def test_expired_kept_for_stale_reads(self):
+        c = Cache()
+        c.set('key', 'value', datetime.datetime.utcnow() - datetime.timedelta(hours=1))
+        assert c.get('key') == (True, 'value')
+
+    def test_lazy_expiry(self):
+        c = Cache(max_stale=60)
+        c.set('key', 'value', datetime.datetime.utcnow() - datetime.timedelta(hours=1))
+        self.assertRaises(KeyError, c.get, 'key')
+        assert c.stats()['expirations'] == 1
+
+    def test_sweep(self):
+        c = Cache(max_stale=60, sweep_interval=0)
+        c.set('key1', 'value', datetime.datetime.utcnow() - datetime.timedelta(hours=1))
+        c.set('key2', 'value', datetime.datetime.utcnow() + datetime.timedelta(hours=1))
+
+        assert list(c.cache.keys()) == ['key2']
+        assert c.stats()['expirations'] == 1
+
+    def test_threaded(self):
+        c = Cache(max_size=50)
+        expires = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+        def worker(n):
+            for i in range(2000):
+                key = (n * i) % 100
+                try:
+                    c.get(key)
+                except KeyError:
+                    c.set(key, key, expires)
+
+        threads = [threading.Thread(target=worker, args=(n, )) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stats = c.stats()
+        assert stats['size'] == len(c.cache) <= 50
+        assert stats['hits'] + stats['misses'] == 8 * 2000
+
+
+class TestCacheSingleFlight(unittest.TestCase):
+
+    def run_threads(self, fn, count=20):
+        barrier = threading.Barrier(count)
+        results = []
+
+        def worker():
+            barrier.wait()
+            results.append(fn('key'))
+
+        threads = [threading.Thread(target=worker) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return results
+
+    def slow_callable(self, expires):
+        callable = mock.Mock()
+
+        def load(*args):
+            time.sleep(0.2)
+            return expires, uuid.uuid4()
+
+        callable.side_effect = load
+        return callable
+
+    def test_cold_key_loaded_once(self):
+        callable = self.slow_callable(datetime.datetime.utcnow() + datetime.timedelta(hours=1))
+        fn = cache()(callable)
+
+        results = self.run_threads(fn)
+
+        assert len(callable.call_args_list) == 1
+        assert len(results) == 20
+        assert len(set(results)) == 1
+        assert fn.cache.stats()['coalesced'] == 19
+
+    def test_expired_key_loaded_once(self):
+        callable = self.slow_callable(datetime.datetime.utcnow() - datetime.timedelta(hours=1))
+        fn = cache()(callable)
+        stale = fn('key')
+
+        callable.reset_mock()
+        results = self.run_threads(fn)
+
+        # Everybody but the caller doing the refresh is given the stale value
+        assert len(callable.call_args_list) == 1
+        assert results.count(stale) == 19
+        assert fn.cache.stats()['stale'] == 19
+
+    def test_waiters_see_error(self):
+        callable = mock.Mock()
+
+        def load(*args):
+            time.sleep(0.2)
+            raise RuntimeError('Temporary error')
+
+        callable.side_effect = load
+        fn = cache()(callable)
+
+        errors = []
+
+        def call(key):
+            try:
+                return fn(key)
+            except RuntimeError as e:
+                errors.append(e)
+
+        self.run_threads(call)
+
+        assert len(callable.call_args_list) == 1
+        assert len(errors) == 20
+
+    def test_disabled(self):
+        callable = self.slow_callable(datetime.datetime.utcnow() + datetime.timedelta(hours=1))
+        fn = cache(single_flight=False)(callable)
+
+        self.run_threads(fn, count=5)
+
+        assert len(callable.call_args_list) == 5
+
+
+class TestCacheRefreshAhead(unittest.TestCase):
+
+    def wait_for_refresh(self, fn):
+        for i in range(100):
+            if not fn.refresher.pending:
+                return
+            time.sleep(0.01)
+        raise AssertionError('Refresh did not finish')
+
+    def test_refreshed_in_background(self):
+        callable = mock.Mock()
+        callable.side_effect = lambda *args: (datetime.datetime.utcnow() + datetime.timedelta(seconds=5), uuid.uuid4())
+
+        fn = cache(refresh_ahead=10)(callable)
+        result1 = fn('key')
+
+        # The caller still gets the current value while the refresh runs
+        assert fn('key') == result1
+        self.wait_for_refresh(fn)
+
+        assert len(callable.call_args_list) == 2
+        assert fn('key') != result1
+        assert fn.cache.stats()['refreshes'] == 2
+
+    def test_not_refreshed_outside_window(self):
+        callable = mock.Mock()
+        callable.side_effect = lambda *args: (datetime.datetime.utcnow() + datetime.timedelta(hours=1), uuid.uuid4())
+
+        fn = cache(refresh_ahead=10)(callable)
+        fn('key')
+        fn('key')
+
+        assert fn.refresher.executor is None
+        assert len(callable.call_args_list) == 1
+
+    def test_refresh_error_keeps_value(self):
+        callable = mock.Mock()
+        callable.side_effect = lambda *args: (datetime.datetime.utcnow() + datetime.timedelta(seconds=5), uuid.uuid4())
+
+        fn = cache(refresh_ahead=10)(callable)
+        result1 = fn('key')
+
+        callable.side_effect = RuntimeError('Temporary error')
+        with mock.patch('tinyauth.utils.cache.logger') as logger:
+            assert fn('key') == result1
+            self.wait_for_refresh(fn)
+
+        assert logger.warning.call_count == 1
+        assert fn('key') == result1
+
+    def test_refresh_context(self):
+        entered = []
+
+        @contextlib.contextmanager
+        def context():
+            entered.append(threading.current_thread().name)
+            yield
+
+        callable = mock.Mock()
+        callable.side_effect = lambda *args: (datetime.datetime.utcnow() + datetime.timedelta(seconds=5), uuid.uuid4())
+
+        fn = cache(refresh_ahead=10, refresh_context=context)(callable)
+        fn('key')
+        fn('key')
+        self.wait_for_refresh(fn)
+
+        assert len(entered) == 1
+        assert entered[0].startswith('tinyauth-refresh')
+
+
+class TestRefresher(unittest.TestCase):
+
+    def test_bounded(self):
+        release = threading.Event()
+        refresher = Refresher(10, max_workers=1, max_pending=2)
+
+        assert refresher.submit('key1', release.wait)
+        assert not refresher.submit('key1', release.wait)
+        assert refresher.submit('key2', release.wait)
+        assert not refresher.submit('key3', release.wait)
+
+        release.set()
+        for i in range(100):
+            if not refresher.pending:
+                break
+            time.sleep(0.01)
+
+        assert refresher.pending == set()
+        assert refresher.submit('key3', release.wait)
+
+
+class NotFound(Exception):
+    pass
+
+
+class TestNegativeCache(unittest.TestCase):
+
+    def test_error_cached(self):
+        callable = mock.Mock()
+        callable.side_effect = NotFound('key')
+        fn = cache(negative=NotFound)(callable)
+
+        self.assertRaises(NotFound, fn, 'key')
+        self.assertRaises(NotFound, fn, 'key')
+
+        assert len(callable.call_args_list) == 1
+        assert fn.negative_cache.stats()['hits'] == 1
+
+    def test_other_errors_not_cached(self):
+        callable = mock.Mock()
+        callable.side_effect = RuntimeError('Temporary error')
+        fn = cache(negative=NotFound)(callable)
+
+        self.assertRaises(RuntimeError, fn, 'key')
+        self.assertRaises(RuntimeError, fn, 'key')
+
+        assert len(callable.call_args_list) == 2
+
+    def test_error_expires(self):
+        callable = mock.Mock()
+        callable.side_effect = NotFound('key')
+        fn = cache(negative=NotFound, negative_ttl=0)(callable)
+
+        self.assertRaises(NotFound, fn, 'key')
+        self.assertRaises(NotFound, fn, 'key')
+
+        assert len(callable.call_args_list) == 2
+
+    def test_size_limit(self):
+        callable = mock.Mock()
+        callable.side_effect = NotFound('key')
+        fn = cache(negative=NotFound, negative_size=1)(callable)
+
+        self.assertRaises(NotFound, fn, 'key1')
+        self.assertRaises(NotFound, fn, 'key2')
+        self.assertRaises(NotFound, fn, 'key1')
+
+        assert len(callable.call_args_list) == 3
+        assert fn.negative_cache.stats()['evictions'] == 2
+
+    def test_not_served_stale(self):
+        expires = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+
+        callable = mock.Mock()
+        callable.side_effect = lambda *args: (expires, uuid.uuid4())
+        fn = cache(negative=NotFound)(callable)
+        fn('key')
+
+        # A key that has gone away shouldn't keep working off a stale entry
+        callable.side_effect = NotFound('key')
+        self.assertRaises(NotFound, fn, 'key')
+
+        assert fn.cache.stats()['size'] == 0
+        assert fn.cache.stats()['stale'] == 0
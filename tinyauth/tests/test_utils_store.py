@@ -0,0 +1,102 @@
+import datetime
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from tinyauth.utils.store import SqliteStore
+
+
+class TestSqliteStore(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'cache.db')
+
+    def test_get_missing(self):
+        store = SqliteStore(self.path)
+        assert store.get('key') is None
+
+    def test_set_and_get(self):
+        expires = datetime.datetime.utcnow().replace(microsecond=0) + datetime.timedelta(hours=1)
+
+        store = SqliteStore(self.path)
+        store.set('key', {'Statement': []}, expires)
+
+        assert store.get('key') == (expires, {'Statement': []})
+
+    def test_survives_reopen(self):
+        expires = datetime.datetime.utcnow().replace(microsecond=0) + datetime.timedelta(hours=1)
+        SqliteStore(self.path).set('key', {'Statement': []}, expires)
+
+        assert SqliteStore(self.path).get('key') == (expires, {'Statement': []})
+
+    def test_expired(self):
+        store = SqliteStore(self.path)
+        store.set('key', {'Statement': []}, datetime.datetime.utcnow() - datetime.timedelta(hours=1))
+
+        assert store.get('key') is None
+
+    def test_purged_on_open(self):
+        SqliteStore(self.path).set('key', {}, datetime.datetime.utcnow() - datetime.timedelta(hours=1))
+        SqliteStore(self.path)
+
+        conn = sqlite3.connect(self.path)
+        assert conn.execute('SELECT COUNT(*) FROM entries').fetchone() == (0, )
+
+    def test_errors_are_a_miss(self):
+        store = SqliteStore(self.path)
+
+        with mock.patch.object(store, '_connect') as connect:
+            connect.side_effect = sqlite3.OperationalError('database is locked')
+            with mock.patch('tinyauth.utils.store.logger') as logger:
+                store.set('key', {}, datetime.datetime.utcnow() + datetime.timedelta(hours=1))
+                assert store.get('key') is None
+
+        assert logger.warning.call_count == 2
+
+    def test_delete_identities(self):
+        expires = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+        store = SqliteStore(self.path)
+        store.set('a', 1, expires, identity='charles')
+        store.set('b', 2, expires, identity='freddy')
+        store.delete_identities(['charles'])
+
+        assert store.get('a') is None
+        assert store.get('b')[1] == 2
+
+    def test_clear_keeps_entries_without_identity(self):
+        expires = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+        store = SqliteStore(self.path)
+        store.set('a', 1, expires, identity='charles')
+        store.set('cursor', 5, expires)
+        store.clear()
+
+        assert store.get('a') is None
+        assert store.get('cursor')[1] == 5
+
+    def test_old_schema_is_dropped(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute('CREATE TABLE entries (key TEXT PRIMARY KEY, value TEXT, expires INTEGER)')
+        conn.commit()
+        conn.close()
+        os.chmod(self.path, 0o600)
+
+        store = SqliteStore(self.path)
+        store.set('a', 1, datetime.datetime.utcnow() + datetime.timedelta(hours=1), identity='charles')
+        assert store.get('a')[1] == 1
+
+    def test_files_are_private(self):
+        SqliteStore(self.path).set('a', 1, datetime.datetime.utcnow() + datetime.timedelta(hours=1))
+        for suffix in ('', '-wal', '-shm'):
+            assert os.stat(self.path + suffix).st_mode & 0o077 == 0
+
+    def test_readable_file_is_refused(self):
+        open(self.path, 'w').close()
+        os.chmod(self.path, 0o644)
+        with self.assertRaises(ValueError):
+            SqliteStore(self.path)
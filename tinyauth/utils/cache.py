@@ -1,52 +1,419 @@
 import collections
+import concurrent.futures
+import contextlib
+import copy
 import datetime
 import functools
+import logging
+import threading
+import time
+
+logger = logging.getLogger('tinyauth.cache')
 
 
 class Cache(object):
 
-    def __init__(self, max_size=1000):
+    '''
+    A thread-safe LRU cache where every entry carries its own expiry
+
+    Expired entries are kept around so they can be served if refreshing them
+    fails. They are dropped once they have been stale for `max_stale` seconds,
+    either lazily when they are looked up or by a sweep that runs at most
+    every `sweep_interval` seconds. With `max_stale=None` a stale entry is
+    only dropped when it becomes the least recently used one.
+    '''
+
+    def __init__(self, max_size=1000, max_stale=None, sweep_interval=60):
         super().__init__()
         self.max_size = max_size
+        self.max_stale = max_stale
+        self.sweep_interval = sweep_interval
         self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.last_sweep = time.monotonic()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.stale = 0
+        self.coalesced = 0
+        self.refreshes = 0
+
+    def _deadline(self, expiry):
+        # Expiry times come from HTTP headers and the database as UTC datetimes,
+        # but are tracked on the monotonic clock so lookups don't need the wall
+        # clock and aren't affected by it jumping
+        if expiry is None:
+            return float('inf')
+        return time.monotonic() + (expiry - datetime.datetime.utcnow()).total_seconds()
+
+    def _is_dead(self, deadline, now):
+        return self.max_stale is not None and deadline + self.max_stale <= now
+
+    def _sweep(self, now):
+        if now - self.last_sweep < self.sweep_interval:
+            return
+        self.last_sweep = now
+
+        if self.max_stale is None:
+            return
+
+        dead = [key for key, (value, deadline) in self.cache.items() if self._is_dead(deadline, now)]
+        for key in dead:
+            del self.cache[key]
+        self.expirations += len(dead)
 
     def set(self, key, value, expiry):
-        self.cache[key] = (value, expiry)
-        for i in range(max(0, len(self.cache) - self.max_size)):
-            self.cache.popitem(last=False)
+        deadline = self._deadline(expiry)
+
+        with self.lock:
+            self.cache[key] = (value, deadline)
+            self.cache.move_to_end(key)
+
+            overflow = max(0, len(self.cache) - self.max_size)
+            for i in range(overflow):
+                self.cache.popitem(last=False)
+            self.evictions += overflow
+
+            self._sweep(time.monotonic())
 
     def get(self, key):
-        value, expiry = self.cache[key]
-        expired = expiry <= datetime.datetime.utcnow()
-        return expired, value
+        expires_in, value = self.lookup(key)
+        return expires_in <= 0, value
+
+    def lookup(self, key):
+        '''
+        Like `get`, but returns how many seconds the entry is still fresh for
+
+        This is negative for entries that have already expired.
+        '''
+        now = time.monotonic()
+
+        with self.lock:
+            self._sweep(now)
+
+            try:
+                value, deadline = self.cache[key]
+            except KeyError:
+                self.misses += 1
+                raise
+
+            if self._is_dead(deadline, now):
+                del self.cache[key]
+                self.expirations += 1
+                self.misses += 1
+                raise KeyError(key)
+
+            self.cache.move_to_end(key)
+
+            if deadline <= now:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return deadline - now, value
+
+    def served_stale(self):
+        with self.lock:
+            self.stale += 1
+
+    def served_coalesced(self):
+        with self.lock:
+            self.coalesced += 1
+
+    def refreshed(self):
+        with self.lock:
+            self.refreshes += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.cache.pop(key, None)
+
+    def delete_where(self, predicate):
+        with self.lock:
+            keys = [key for key in self.cache if predicate(key)]
+            for key in keys:
+                del self.cache[key]
+        return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.cache),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'stale': self.stale,
+                'coalesced': self.coalesced,
+                'refreshes': self.refreshes,
+            }
+
+
+class _Flight(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight(object):
+
+    '''
+    Make sure only one call per key is in progress at any time
+    '''
+
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, fn):
+        '''
+        Call `fn` unless a call for `key` is already in progress
+
+        Returns `(True, value)` to the caller that made the call, and
+        `(False, flight)` to everyone else, who can `wait` on the flight.
+        '''
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight:
+                return False, flight
+            flight = self.flights[key] = _Flight()
+
+        try:
+            flight.value = fn()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+        return True, flight.value
+
+    def wait(self, flight):
+        flight.done.wait()
+        if flight.error:
+            raise flight.error
+        return flight.value
+
+
+class Refresher(object):
+
+    '''
+    Run refreshes on a bounded pool of background threads
+
+    Entries are refreshed once they are due to expire within `window` seconds.
+    `context` is called in the thread that queues the refresh, and should
+    return a context manager the refresh then runs in.
 
+    A key is only queued once at a time, and no more than `max_pending` keys
+    are queued at all. Refreshes beyond that are dropped, and the entry will
+    be refreshed by the first caller to see it expire instead.
+    '''
 
-def cache(**kwargs):
+    def __init__(self, window, context=None, max_workers=4, max_pending=100):
+        self.window = window
+        self.context = context
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def submit(self, key, fn):
+        with self.lock:
+            if key in self.pending or len(self.pending) >= self.max_pending:
+                return False
+            self.pending.add(key)
+
+            # Started on first use so that no threads exist before workers fork
+            if not self.executor:
+                self.executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix='tinyauth-refresh',
+                )
+
+        self.executor.submit(self._run, key, fn)
+        return True
+
+    def _run(self, key, fn):
+        try:
+            fn()
+        except Exception:
+            logger.warning('Background refresh of %r failed', key, exc_info=True)
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+
+
+class NegativeCache(object):
+
+    '''
+    Remember errors that are answers rather than failures, like a key not existing
+
+    They are raised again for `ttl` seconds without calling the wrapped
+    function. Each time that happens counts as a hit in `stats()`.
+    '''
+
+    def __init__(self, errors, ttl=30, max_size=10000):
+        self.errors = errors
+        self.ttl = ttl
+        self.cache = Cache(max_size=max_size, max_stale=0)
+
+    def check(self, key):
+        try:
+            expires_in, error = self.cache.lookup(key)
+        except KeyError:
+            return
+
+        if expires_in > 0:
+            raise copy.copy(error)
+
+    def add(self, key, error):
+        self.cache.set(key, error, datetime.datetime.utcnow() + datetime.timedelta(seconds=self.ttl))
+
+    def stats(self):
+        return self.cache.stats()
+
+
+_IN_FLIGHT = object()
+
+
+def _load(cache, negative, f, args, kwargs):
+    try:
+        expires, value = f(*args, **kwargs)
+    except Exception as e:
+        if negative and isinstance(e, negative.errors):
+            negative.add(args, e)
+            cache.delete(args)
+        raise
+
+    cache.set(args, value, expires)
+    return value
+
+
+def _refresh(cache, negative, flights, f, args, kwargs, wait):
+    if not flights:
+        return _load(cache, negative, f, args, kwargs)
+
+    leader, result = flights.do(args, lambda: _load(cache, negative, f, args, kwargs))
+    if leader:
+        return result
+    if not wait:
+        return _IN_FLIGHT
+
+    cache.served_coalesced()
+    return flights.wait(result)
+
+
+def _refresh_ahead(cache, negative, flights, refresher, f, args, kwargs):
+    context = refresher.context() if refresher.context else contextlib.ExitStack()
+
+    def refresh():
+        with context:
+            _refresh(cache, negative, flights, f, args, kwargs, wait=False)
+
+    if refresher.submit(args, refresh):
+        cache.refreshed()
+
+
+def _cached_call(cache, negative, flights, refresher, f, args, kwargs):
+    if negative:
+        negative.check(args)
+
+    try:
+        expires_in, cache_value = cache.lookup(args)
+    except KeyError:
+        return _refresh(cache, negative, flights, f, args, kwargs, wait=True)
+
+    if expires_in > 0:
+        if refresher and expires_in <= refresher.window:
+            _refresh_ahead(cache, negative, flights, refresher, f, args, kwargs)
+        return cache_value
+
+    try:
+        value = _refresh(cache, negative, flights, f, args, kwargs, wait=False)
+    except Exception as e:
+        if negative and isinstance(e, negative.errors):
+            raise
+        value = _IN_FLIGHT
+
+    # The refresh failed, or somebody else is already doing it
+    if value is _IN_FLIGHT:
+        cache.served_stale()
+        return cache_value
+
+    return value
+
+
+def cache(
+    single_flight=True,
+    refresh_ahead=None,
+    refresh_context=None,
+    refresh_workers=4,
+    negative=None,
+    negative_ttl=30,
+    negative_size=10000,
+    **kwargs
+):
+    '''
+    Cache the result of a function that returns an `(expiry, value)` tuple
+
+    With `single_flight` only one call per key is in progress at a time. Other
+    callers get the stale value if there is one, otherwise they wait for the
+    call in progress and share its result.
+
+    With `refresh_ahead` an entry that will expire within that many seconds is
+    refreshed in the background, while callers keep getting the current value.
+
+    Exceptions of the types in `negative` are cached for `negative_ttl`
+    seconds, in a separate cache of up to `negative_size` entries. They are
+    never hidden by a stale value, and drop the key from the main cache.
+    '''
     cache = Cache(**kwargs)
+    flights = SingleFlight() if single_flight else None
+    refresher = None
+    if refresh_ahead:
+        refresher = Refresher(refresh_ahead, context=refresh_context, max_workers=refresh_workers)
+    negative_cache = None
+    if negative:
+        negative_cache = NegativeCache(negative, ttl=negative_ttl, max_size=negative_size)
+
+    def prime(expires, value, *args):
+        '''
+        Store a value that was fetched some other way, e.g. in bulk
+        '''
+        cache.set(args, value, expires)
+        if negative_cache:
+            negative_cache.cache.delete(args)
+
+    def invalidate(predicate):
+        '''
+        Drop every entry whose arguments match `predicate`
+        '''
+        if negative_cache:
+            negative_cache.cache.delete_where(predicate)
+        return cache.delete_where(predicate)
 
     def decorator(f):
         @functools.wraps(f)
         def wrapper(*args, **kwargs):
-            try:
-                expired, cache_value = cache.get(args)
-                should_raise = False
-            except KeyError:
-                cache_value = None
-                expired = True
-                should_raise = True
-
-            if not expired:
-                return cache_value
+            return _cached_call(cache, negative_cache, flights, refresher, f, args, kwargs)
 
-            try:
-                expires, value = f(*args, **kwargs)
-            except Exception as e:
-                if not should_raise:
-                    return cache_value
-                raise
+        wrapper.prime = prime
+        wrapper.invalidate = invalidate
 
-            cache.set(args, value, expires)
-            return value
+        wrapper.cache = cache
+        wrapper.negative_cache = negative_cache
+        wrapper.refresher = refresher
 
         return wrapper
 
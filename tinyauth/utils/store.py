@@ -0,0 +1,124 @@
+import calendar
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger('tinyauth.store')
+
+# Bump this when the layout of the file changes. Files with any other
+# version are emptied and recreated, as they only ever hold cached data.
+SCHEMA_VERSION = 2
+
+
+class SqliteStore(object):
+
+    '''
+    A persistent key/value store where every entry carries its own expiry
+
+    This is a second tier behind the in-memory caches of the proxy backend so
+    that a restarted node can answer from what it already knew instead of
+    asking the upstream about every active user at once. The file is opened in
+    WAL mode so that all workers on a host can share it.
+
+    The store is only ever an optimisation, so errors are logged and treated
+    as a miss. Opening it raises if the file can't be created or is readable
+    by others, so that the caller can carry on without a store.
+    '''
+
+    def __init__(self, path, timeout=1):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+
+        # The file holds credentials and policies, so create it (and the files
+        # sqlite keeps beside it in WAL mode) readable by this user only
+        for suffix in ('', '-wal', '-shm'):
+            os.close(os.open(path + suffix, os.O_RDWR | os.O_CREAT, 0o600))
+            if os.stat(path + suffix).st_mode & 0o077:
+                raise ValueError(f'{path + suffix} must not be readable by group or others')
+
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            if conn.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+                conn.execute('DROP TABLE IF EXISTS entries')
+                conn.execute(f'PRAGMA user_version={SCHEMA_VERSION}')
+            conn.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, expires INTEGER, identity TEXT)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_entries_expires ON entries (expires)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_entries_identity ON entries (identity)')
+        self.purge()
+
+    def _connect(self):
+        # sqlite connections can't be shared between threads, or survive a fork
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = self.local.conn = sqlite3.connect(self.path, timeout=self.timeout)
+            self.local.pid = os.getpid()
+        return conn
+
+    def _now(self):
+        return calendar.timegm(datetime.datetime.utcnow().utctimetuple())
+
+    def get(self, key):
+        '''
+        Returns `(expires, value)`, or `None` if there is no unexpired entry
+        '''
+        try:
+            row = self._connect().execute(
+                'SELECT expires, value FROM entries WHERE key = ? AND expires > ?',
+                (key, self._now()),
+            ).fetchone()
+        except sqlite3.Error:
+            logger.warning('Unable to read %r from %s', key, self.path, exc_info=True)
+            return None
+
+        if not row:
+            return None
+
+        expires, value = row
+        return datetime.datetime.utcfromtimestamp(expires), json.loads(value)
+
+    def set(self, key, value, expires, identity=None):
+        '''
+        Store `value` until `expires`
+
+        Entries stored with an `identity` can be dropped with `delete_identities`.
+        '''
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO entries (key, value, expires, identity) VALUES (?, ?, ?, ?)',
+                    (key, json.dumps(value), calendar.timegm(expires.utctimetuple()), identity),
+                )
+        except sqlite3.Error:
+            logger.warning('Unable to write %r to %s', key, self.path, exc_info=True)
+
+    def delete_identities(self, identities):
+        identities = list(identities)
+        try:
+            with self._connect() as conn:
+                for i in range(0, len(identities), 500):
+                    batch = identities[i:i + 500]
+                    conn.execute(
+                        'DELETE FROM entries WHERE identity IN ({})'.format(', '.join('?' for _ in batch)),
+                        batch,
+                    )
+        except sqlite3.Error:
+            logger.warning('Unable to delete identities from %s', self.path, exc_info=True)
+
+    def clear(self):
+        # Entries without an identity, like the change feed cursor, are kept
+        try:
+            with self._connect() as conn:
+                conn.execute('DELETE FROM entries WHERE identity IS NOT NULL')
+        except sqlite3.Error:
+            logger.warning('Unable to clear %s', self.path, exc_info=True)
+
+    def purge(self):
+        try:
+            with self._connect() as conn:
+                conn.execute('DELETE FROM entries WHERE expires <= ?', (self._now(), ))
+        except sqlite3.Error:
+            logger.warning('Unable to purge %s', self.path, exc_info=True)